@@ -0,0 +1,333 @@
+# F:\Learning_journal_at_CUHK\FTEC5610_Computational_Finance\Assignment\Assigenment2-3\batch_solver.py
+# Batch pricing and solving: many term-sheet variants in one job, on one worker pool, on shared paths.
+#
+# solver_i.py, solver_ii.py, solver_iii.py and validator.py run their cases one after another, each with its own workers and paths.
+# Here every request (a price, or a solve for CP, K0, KI or AC at a target margin) is put in one list:
+#   - requests whose paths are the same (same S0, drift r_g, volatility and num_paths) form one path group.
+#     The barriers, the strike, the coupon and the discount rate only change the payoff, so a group simulates every block
+#     of paths once and evaluates the payoff of all its requests on it.
+#   - price and CP requests need one pass: PV = A + CP * B on fixed paths, so the CP of a margin is (target - A) / B.
+#   - K0 / KI / AC solves advance together in rounds; every round is one pass in which each open solve prices one guess.
+#   - all tasks of a round (every group, every block range) go to one PricingPool, and every group reads its normals from one
+#     SharedNormals buffer generated once for the whole batch (the largest group's num_paths // 2 pairs, 216 MB at 300,000 paths).
+# All groups use the same CRN seed, so a batch gives the same numbers as the single-request solvers with that seed.
+#
+#     requests = [
+#         {'name': 'Q1(i)', 'solve_for': 'CP', 'target_margin': 0.012},
+#         {'name': 'Q2-B', 'solve_for': 'KI', 'target_margin': 0.012, 'CP': 3.358654},
+#         {'name': 'vol 55%', 'CP': 3.45, 'overrides': {'sigma_stock': 0.55}},
+#     ]
+#     rows = run_batch(requests, hkd_params_prod, seed=42)
+#     print(format_results_table(rows))
+
+import numpy as np
+import multiprocessing
+import time
+
+from calculate_fair_value import (DEFAULT_BLOCK_PAIRS, T_EXPIRY, N_STEPS, PricingPool, SharedNormals, attach_shared_normals, get_rates,
+                                  iter_normal_blocks, iter_shared_normal_blocks, payoff_components_block, simulate_paths_block)
+from param_solver import BRACKET_SEARCH_PATHS, PARAM_DOMAINS, bracket_search_steps
+
+# Variables a request can solve for (None prices the request at its CP)
+SOLVE_VARIABLES = (None, 'CP', 'K0', 'KI', 'AC')
+
+# K0 / KI / AC solves stop when their bracket is narrower than this, or after BATCH_MAX_ROUNDS rounds.
+# A solve starts at the request's value of the parameter and searches its domain (request 'domain', default PARAM_DOMAINS).
+BATCH_XTOL = 1e-6
+BATCH_MAX_ROUNDS = 100
+
+
+# Worker task: simulate the paths of one block range once and evaluate every payoff of the group on them.
+# evaluations is a list of (r_disc, params); returns one dict of affine moments per evaluation
+# (count, a_sum, b_sum, a_sum_sq, ab_sum, b_sum_sq), like run_simulation_chunk_vectorized.
+# With a SharedNormals handle the normals are read from the buffer, otherwise they are generated from the seed (the same numbers).
+def run_batch_chunk(args):
+    num_pairs, S0, r_g, sigma, seed, first_block, block_pairs, evaluations, shared_normals = args
+    dt = T_EXPIRY / N_STEPS
+    moments = [{'count': 0, 'a_sum': 0.0, 'b_sum': 0.0, 'a_sum_sq': 0.0, 'ab_sum': 0.0, 'b_sum_sq': 0.0} for _ in evaluations]
+
+    if shared_normals is not None:
+        normal_blocks = iter_shared_normal_blocks(attach_shared_normals(shared_normals), num_pairs, block_pairs, first_block)
+    else:
+        normal_blocks = iter_normal_blocks(num_pairs, block_pairs, seed, first_block, N_STEPS)
+    for Z in normal_blocks:
+        pair_a = [0.0] * len(evaluations)
+        pair_b = [0.0] * len(evaluations)
+        for z_block in (Z, -Z): # antithetic pair, the paths are simulated once for all evaluations
+            S_paths = simulate_paths_block(z_block, S0, r_g, sigma, dt)
+            for index, (r_disc, params) in enumerate(evaluations):
+                principal_pv, coupon_annuity = payoff_components_block(S_paths, r_disc, params)
+                pair_a[index] = pair_a[index] + 0.5 * principal_pv
+                pair_b[index] = pair_b[index] + 0.5 * coupon_annuity
+
+        for index, moment in enumerate(moments):
+            a, b = pair_a[index], pair_b[index]
+            moment['count'] += Z.shape[0]
+            moment['a_sum'] += np.sum(a)
+            moment['b_sum'] += np.sum(b)
+            moment['a_sum_sq'] += np.sum(a ** 2)
+            moment['ab_sum'] += np.sum(a * b)
+            moment['b_sum_sq'] += np.sum(b ** 2)
+    return moments
+
+
+# Fair value and standard error at CP_rate from the affine moments of one evaluation
+def affine_fair_value(moment, CP_rate):
+    count = moment['count']
+    mean = (moment['a_sum'] + CP_rate * moment['b_sum']) / count
+    mean_sq = (moment['a_sum_sq'] + 2.0 * CP_rate * moment['ab_sum'] + CP_rate ** 2 * moment['b_sum_sq']) / count
+    return mean, np.sqrt(max(mean_sq - mean ** 2, 0.0) / count)
+
+
+# Check a request and fill in its defaults: name, product_type, params (base params updated by the overrides), rates
+def prepare_request(index, request, base_params):
+    solve_for = request.get('solve_for')
+    if solve_for not in SOLVE_VARIABLES:
+        raise ValueError(f"solve_for must be one of {SOLVE_VARIABLES}")
+    if solve_for is not None and request.get('target_margin') is None:
+        raise ValueError(f"Request {index} solves for {solve_for}, it needs a target_margin")
+    if solve_for != 'CP' and request.get('CP') is None:
+        raise ValueError(f"Request {index} needs a coupon CP (in %)")
+
+    params = dict(request.get('params') or base_params, **request.get('overrides', {}))
+    product_type = request.get('product_type', 'HKD')
+    r_g, r_disc = get_rates(params, product_type)
+    return {'name': request.get('name', f"request {index}"), 'product_type': product_type, 'solve_for': solve_for,
+            'target_margin': request.get('target_margin'), 'CP': request.get('CP'), 'params': params,
+            'r_g': r_g, 'r_disc': r_disc, 'domain': request.get('domain')}
+
+
+# Requests with the same paths share one group: (S0, r_g, sigma_stock, num_paths)
+def path_group_key(prepared):
+    params = prepared['params']
+    return (params['S0'], prepared['r_g'], params['sigma_stock'], params['num_paths'])
+
+
+# One K0 / KI / AC solve, advanced one guess per round: a generator that yields (kind, guess) and is sent the error of the guess.
+# kind is 'search' for the guesses of the cheap bracket walk of param_solver.py (priced on BRACKET_SEARCH_PATHS paths),
+# and 'full' for the guesses priced on the request's num_paths.
+# Returns (StopIteration value) (root, status), status 'ok' or 'no root in domain'.
+def batch_solve_steps(start, lowest, highest, xtol=BATCH_XTOL):
+    # 1. Walk from the original value until the error changes sign
+    search = bracket_search_steps(start, lowest, highest)
+    try:
+        guess = next(search)
+        while True:
+            error = yield 'search', guess
+            guess = search.send(error)
+    except StopIteration as stop:
+        bracket = stop.value
+    if bracket is None:
+        return None, 'no root in domain'
+
+    # 2. Check the bracket on the full path count, widen it (by its width, towards the smaller error) if the sign change is lost
+    (low, _), (high, _) = bracket
+    error_low = yield 'full', low
+    error_high = yield 'full', high
+    while error_low * error_high > 0:
+        if (low, high) == (lowest, highest):
+            return None, 'no root in domain'
+        width = high - low
+        if abs(error_low) < abs(error_high):
+            low = max(low - width, lowest)
+            error_low = yield 'full', low
+        else:
+            high = min(high + width, highest)
+            error_high = yield 'full', high
+
+    # 3. Narrow it with the Illinois variant of regula falsi; a step that did not halve the bracket is followed by a bisection
+    last_width = None
+    kept = None # the end the last step kept
+    while high - low >= xtol:
+        width = high - low
+        if last_width is not None and width > 0.5 * last_width:
+            guess = 0.5 * (low + high)
+        else:
+            guess = low - error_low * (high - low) / (error_high - error_low)
+        last_width = width
+        error = yield 'full', guess
+        if error == 0:
+            return guess, 'ok'
+        if error * error_low < 0:
+            high, error_high = guess, error
+            if kept == 'low':
+                error_low *= 0.5 # the same end kept twice: halve its error, so a flat or curved side cannot stall the search
+            kept = 'low'
+        else:
+            low, error_low = guess, error
+            if kept == 'high':
+                error_high *= 0.5
+            kept = 'high'
+    return 0.5 * (low + high), 'ok'
+
+
+# Run one pass: price the evaluations of every path group on its shared paths, all groups on one PricingPool.
+# evaluations_by_group maps a group key to a list of (r_disc, params); returns the same mapping to the list of moments.
+# shared_normals is the SharedNormals handle the workers read the normals from (None: every task generates them from the seed)
+def run_batch_pass(pool, evaluations_by_group, seed, block_pairs, num_cores, shared_normals=None):
+    tasks = []
+    for key, evaluations in evaluations_by_group.items():
+        S0, r_g, sigma, num_paths = key
+        num_pairs = num_paths // 2
+        num_blocks = -(-num_pairs // block_pairs)
+        blocks_per_task = -(-num_blocks // num_cores)
+        for first_block in range(0, num_blocks, blocks_per_task):
+            pairs_to_run = min(blocks_per_task * block_pairs, num_pairs - first_block * block_pairs)
+            tasks.append((key, (pairs_to_run, S0, r_g, sigma, seed, first_block, block_pairs, evaluations, shared_normals)))
+
+    results = pool.map(run_batch_chunk, [task for _, task in tasks])
+
+    moments_by_group = {}
+    for (key, _), task_moments in zip(tasks, results):
+        combined = moments_by_group.setdefault(key, [dict.fromkeys(moment, 0.0) for moment in task_moments])
+        for total, moment in zip(combined, task_moments):
+            for name, value in moment.items():
+                total[name] += value
+    return moments_by_group
+
+
+# Price and solve a list of requests (see the top of this file) in one job.
+# base_params are the parameters a request's overrides apply to; seed is the CRN seed of every group (drawn if not given).
+# Returns one row (dict) per request, in request order:
+#   name, product_type, solve_for, target_margin, CP, K0, KI, AC (the solved value filled in), fair_value, stderr (HKD),
+#   margin (1 - fair_value / NOM), status ('ok' or 'no root in domain'), group (index of the path group), num_paths
+def run_batch(requests, base_params, seed=None, num_cores=None, block_pairs=DEFAULT_BLOCK_PAIRS, xtol=BATCH_XTOL,
+              max_rounds=BATCH_MAX_ROUNDS):
+    if seed is None:
+        seed = np.random.SeedSequence().entropy
+    num_cores = num_cores or multiprocessing.cpu_count()
+    prepared = [prepare_request(index, request, base_params) for index, request in enumerate(requests)]
+
+    group_keys = []
+    for request in prepared:
+        request['group_key'] = path_group_key(request)
+        if request['group_key'] not in group_keys:
+            group_keys.append(request['group_key'])
+
+    # Barrier / strike solves, started at the request's value of the parameter
+    solves = {}
+    for index, request in enumerate(prepared):
+        if request['solve_for'] in ('K0', 'KI', 'AC'):
+            lowest, highest = request['domain'] or PARAM_DOMAINS[request['solve_for']]
+            solves[index] = batch_solve_steps(request['params'][request['solve_for']], lowest, highest, xtol)
+    next_steps = {index: next(solve) for index, solve in solves.items()}
+    outcomes = {}
+
+    # The pool is started before the buffer, so its workers share this process's resource tracker (see PricingPool).
+    # The path groups only differ in the number of pairs, so the largest one's normals serve them all.
+    max_pairs = max(key[3] for key in group_keys) // 2
+    with PricingPool(base_params, num_cores=num_cores, block_pairs=block_pairs) as pool, \
+            SharedNormals(max_pairs, seed, block_pairs) as shared_normals:
+        # Pass 1: every request at its own parameters (prices, CP solves, and the moments reported with each row)
+        evaluations_by_group = {}
+        evaluation_slots = []
+        for request in prepared:
+            evaluations = evaluations_by_group.setdefault(request['group_key'], [])
+            evaluation_slots.append(len(evaluations))
+            evaluations.append((request['r_disc'], request['params']))
+        moments_by_group = run_batch_pass(pool, evaluations_by_group, seed, block_pairs, num_cores, shared_normals.handle)
+        own_moments = [moments_by_group[request['group_key']][slot] for request, slot in zip(prepared, evaluation_slots)]
+
+        # Rounds: each open solve prices its next guess, all guesses of a round share one pass
+        last_moments = {}
+        for _ in range(max_rounds):
+            if not next_steps:
+                break
+            evaluations_by_group = {}
+            round_slots = {}
+            for index, (kind, guess) in next_steps.items():
+                request = prepared[index]
+                key = request['group_key']
+                if kind == 'search':
+                    # The bracket walk runs on a smaller group with the same drift and volatility
+                    key = key[:3] + (min(BRACKET_SEARCH_PATHS, key[3]),)
+                evaluations = evaluations_by_group.setdefault(key, [])
+                round_slots[index] = (kind, key, len(evaluations))
+                evaluations.append((request['r_disc'], dict(request['params'], **{request['solve_for']: guess})))
+
+            moments_by_group = run_batch_pass(pool, evaluations_by_group, seed, block_pairs, num_cores, shared_normals.handle)
+            for index, (kind, key, slot) in round_slots.items():
+                request = prepared[index]
+                moment = moments_by_group[key][slot]
+                fair_value, _ = affine_fair_value(moment, request['CP'] / 100.0)
+                if kind == 'full':
+                    last_moments[index] = moment
+                try:
+                    next_steps[index] = solves[index].send(fair_value - request['params']['NOM'] * (1.0 - request['target_margin']))
+                except StopIteration as stop:
+                    outcomes[index] = stop.value
+                    del next_steps[index]
+
+    # The results table
+    rows = []
+    for index, request in enumerate(prepared):
+        params = request['params']
+        row = {'name': request['name'], 'product_type': request['product_type'], 'solve_for': request['solve_for'],
+               'target_margin': request['target_margin'], 'CP': request['CP'],
+               'K0': params['K0'], 'KI': params['KI'], 'AC': params['AC'], 'status': 'ok',
+               'group': group_keys.index(request['group_key']), 'num_paths': params['num_paths']}
+        moment = own_moments[index]
+
+        if request['solve_for'] == 'CP':
+            target_fv = params['NOM'] * (1.0 - request['target_margin'])
+            row['CP'] = 100.0 * (target_fv - moment['a_sum'] / moment['count']) / (moment['b_sum'] / moment['count'])
+        elif index in solves:
+            root, row['status'] = outcomes.get(index, (None, f"not converged after {max_rounds} rounds"))
+            if root is not None:
+                row[request['solve_for']] = root
+                # The moments of the last guess, which is within xtol of the root
+                moment = last_moments[index]
+
+        row['fair_value'], row['stderr'] = affine_fair_value(moment, row['CP'] / 100.0)
+        row['margin'] = 1.0 - row['fair_value'] / params['NOM']
+        rows.append(row)
+    return rows
+
+
+# Plain-text table of run_batch rows
+def format_results_table(rows):
+    header = f"{'name':<22}{'type':<8}{'solve':<7}{'CP %':>11}{'K0':>10}{'KI':>10}{'AC':>10}{'fair value':>14}{'stderr':>9}{'margin %':>10}{'group':>7}  status"
+    lines = [header, "-" * len(header)]
+    for row in rows:
+        lines.append(f"{row['name']:<22}{row['product_type']:<8}{row['solve_for'] or '-':<7}{row['CP']:>11.6f}{row['K0']:>10.6f}"
+                     f"{row['KI']:>10.6f}{row['AC']:>10.6f}{row['fair_value']:>14,.2f}{row['stderr']:>9,.2f}"
+                     f"{100.0 * row['margin']:>10.4f}{row['group']:>7}  {row['status']}")
+    return "\n".join(lines)
+
+
+if __name__ == "__main__":
+
+    multiprocessing.freeze_support()
+
+    hkd_params_prod = {
+        'NOM': 100000.0, 'r_f': 0.0287, 'sigma_stock': 0.6039, 'S0': 11.08,
+        'time_points': np.array([1/12, 2/12, 3/12, 4/12, 5/12, 0.5]),
+        'num_paths': 300000,
+        'K0': 0.96, 'KI': 0.92, 'AC': 0.99,
+        # Quanto keys, used by the 'Quanto' requests
+        'r_d': 0.0169, 'sigma_fx': 0.074, 'rho': 0.42
+    }
+    CP1_VALUE = 3.458654
+    CP_NEW = CP1_VALUE - 0.10
+
+    # The whole assignment (Q1, Q2, Q3) and a few term-sheet variants in one job
+    requests = [
+        {'name': 'Q1(i)', 'solve_for': 'CP', 'target_margin': 0.012},
+        {'name': 'Q1(ii)', 'solve_for': 'CP', 'target_margin': 0.016},
+        {'name': 'Q2-A', 'solve_for': 'K0', 'target_margin': 0.012, 'CP': CP_NEW},
+        {'name': 'Q2-B', 'solve_for': 'KI', 'target_margin': 0.012, 'CP': CP_NEW},
+        {'name': 'Q2-C', 'solve_for': 'AC', 'target_margin': 0.012, 'CP': CP_NEW},
+        {'name': 'Q3(i)', 'product_type': 'Quanto', 'solve_for': 'CP', 'target_margin': 0.012},
+        {'name': 'Q3(ii)', 'product_type': 'Quanto', 'solve_for': 'CP', 'target_margin': 0.016},
+        {'name': 'Q1 at CP1', 'CP': CP1_VALUE},
+        {'name': 'KI 80%', 'CP': CP1_VALUE, 'overrides': {'KI': 0.80}},
+        {'name': 'AC 100%, K0 100%', 'solve_for': 'CP', 'target_margin': 0.012, 'overrides': {'AC': 1.00, 'K0': 1.00}},
+        {'name': 'vol 50%', 'solve_for': 'CP', 'target_margin': 0.012, 'overrides': {'sigma_stock': 0.50}},
+        {'name': 'vol 50%, KI solve', 'solve_for': 'KI', 'target_margin': 0.012, 'CP': CP_NEW, 'overrides': {'sigma_stock': 0.50}},
+    ]
+
+    print(f"--- Batch: {len(requests)} requests on {multiprocessing.cpu_count()} cpu(s) ---")
+    start_time = time.time()
+    rows = run_batch(requests, hkd_params_prod)
+    print(format_results_table(rows))
+    print(f"Total time: {time.time() - start_time:.2f} seconds")
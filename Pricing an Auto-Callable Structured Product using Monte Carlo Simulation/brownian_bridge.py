@@ -0,0 +1,162 @@
+# F:\Learning_journal_at_CUHK\FTEC5610_Computational_Finance\Assignment\Assigenment2-3\brownian_bridge.py
+# Coarse-grid pricing of the autocall: exact lognormal steps between a few monitoring nodes plus a Brownian-bridge correction.
+#
+# The daily engine needs N=180 steps because knock-in and auto-call are monitored on every day.
+# Here the stock is only simulated on the coupon dates and `substeps` nodes inside every coupon period, with the exact GBM step
+#     S(t + h) = S(t) * exp((r_g - sigma^2 / 2) h + sigma sqrt(h) Z)
+# Between two nodes the log-price is a Brownian bridge, so the chance that a barrier was crossed between the nodes is known:
+#     P(cross) = exp(-2 ln(H / S_a) ln(H / S_b) / (sigma^2 h))     (both nodes on the same side of the barrier H)
+# Instead of drawing the crossings we take their conditional expectation on every path (survival weights), which also lowers the variance.
+#
+# The product is monitored daily, not continuously, so both barriers are moved away from the spot by the
+# Broadie-Glasserman-Kou continuity correction exp(+-0.5826 sigma sqrt(1 day)) before the bridge formula is used.
+# The accrued coupon of a call inside an interval uses the expected first-passage time of the bridge, rounded up by half a day
+# (the call happens on the first monitoring *day* after the crossing). It has a closed form (see bridge_expected_hitting_fraction),
+# and the whole block is evolved in log-prices, so one interval costs a handful of array passes on every path.
+#
+# Approximations (see the bias table in ReadThisFirst.md):
+#   * the knock-in and auto-call crossings inside one interval are treated as independent
+#   * the discount factor of a call is taken at the expected call time
+
+import numpy as np
+from scipy.special import erfcx # scaled complementary error function exp(x^2) erfc(x), stable for large x
+
+# Broadie-Glasserman-Kou constant: -zeta(1/2) / sqrt(2 pi)
+BGK_BETA = 0.5826
+
+
+# Build the coarse time grid: every coupon period is cut into `substeps` equal intervals
+# Returns the node times (M + 1,), and for every interval its coupon period start / end and whether it is inside the auto-call window
+def build_bridge_grid(time_points, substeps, T):
+    coupon_times = np.sort(np.asarray(time_points, dtype=float))
+    period_boundaries = np.union1d([0.0, T], coupon_times)
+
+    node_times = [0.0]
+    period_start = []
+    period_end = []
+    for start, end in zip(period_boundaries[:-1], period_boundaries[1:]):
+        for j in range(1, substeps + 1):
+            node_times.append(start + (end - start) * j / substeps)
+            period_start.append(start)
+            period_end.append(end)
+
+    node_times = np.array(node_times)
+    period_start = np.array(period_start)
+    period_end = np.array(period_end)
+    # First auto-call date (Dc): the first coupon date; the calls of an interval can only happen after it
+    in_autocall_window = period_start >= coupon_times[0] - 1e-12
+    return node_times, period_start, period_end, in_autocall_window
+
+
+# Probability that a Brownian bridge (in log-price) crosses a barrier, both nodes on the same side of it.
+# d_a, d_b >= 0 are the log distances of the two nodes to the barrier, e.g. |ln(H / S_a)| and |ln(H / S_b)|.
+def bridge_crossing_probability(d_a, d_b, sigma, h):
+    return np.exp(-2.0 * d_a * d_b / (sigma ** 2 * h))
+
+
+# Expected first-passage time of the bridge to the barrier, as a fraction of the interval, given that it crosses.
+# d_a, d_b >= 0 are the log distances of the nodes to the barrier (by reflection the end node may be on either side).
+# The first-passage density of the bridge at time u * h is proportional to
+#     u^(-3/2) exp(-d_a^2 / (2 sigma^2 h u)) (1 - u)^(-1/2) exp(-d_b^2 / (2 sigma^2 h (1 - u)))
+# and the drift cancels in the bridge. Writing the bridge as a time-changed Brownian motion, s = u h / (1 - u), the passage
+# becomes an inverse-Gaussian hitting time, and E[u] = sqrt(pi) x_a erfcx(x_a + x_b) with x = d / (sigma sqrt(2 h)).
+def bridge_expected_hitting_fraction(d_a, d_b, sigma, h):
+    scale = sigma * np.sqrt(2.0 * h)
+    x_a = d_a / scale
+    return np.sqrt(np.pi) * x_a * erfcx(x_a + d_b / scale)
+
+
+# Price a block of antithetic pairs on the coarse grid. Z has shape (num_pairs, M), M = number of grid intervals.
+# Returns (pair_principal_pv, pair_coupon_annuity), the same affine split as the daily engine: PV = a + CP_rate * b
+def bridge_affine_pairs_block(Z, r_g, r_disc, params, substeps, T, N):
+    NOM = params['NOM']
+    S0 = params['S0']
+    sigma = params['sigma_stock']
+
+    node_times, period_start, period_end, in_window = build_bridge_grid(params['time_points'], substeps, T)
+    h = np.diff(node_times)
+    monitoring_dt = T / N # the product is monitored once per day
+
+    P_K = S0 * params['KI'] # Knock-in Price
+    P_C = S0 * params['AC'] # Auto-Call Price
+    K = S0 * params['K0'] # Strike Price at Maturity
+    # The barriers in log-price; the continuity-corrected ones are used for the crossings between the nodes
+    log_P_K = np.log(P_K)
+    log_P_C = np.log(P_C)
+    log_L_shift = log_P_K - BGK_BETA * sigma * np.sqrt(monitoring_dt)
+    log_H_shift = log_P_C + BGK_BETA * sigma * np.sqrt(monitoring_dt)
+
+    # Coupons of a path alive at expiry (the coupon dates before expiry plus the final coupon), as in the daily engine
+    coupon_times = np.asarray(params['time_points'], dtype=float)
+    alive_annuity = NOM * np.exp(-r_disc * T) + np.sum(NOM * np.exp(-r_disc * coupon_times[coupon_times < T - 1e-12]))
+
+    # Both halves of the antithetic pairs are priced in one pass: rows [0, pairs) are Z, rows [pairs, 2 pairs) are -Z.
+    # Every step below works on all the intervals at once, shape (paths, M); only the call survival is a cumulative product.
+    num_pairs = Z.shape[0]
+
+    # Exact GBM steps between the nodes, kept in log-prices (the barrier tests and the bridge only need log distances)
+    drift = np.log(S0) + np.cumsum((r_g - 0.5 * sigma ** 2) * h)
+    shocks = np.cumsum(sigma * np.sqrt(h) * Z, axis=1)
+    X_nodes = np.empty((2 * num_pairs, len(node_times)))
+    X_nodes[:, 0] = np.log(S0)
+    np.add(drift, shocks, out=X_nodes[:num_pairs, 1:])
+    np.subtract(drift, shocks, out=X_nodes[num_pairs:, 1:])
+    X_a, X_b = X_nodes[:, :-1], X_nodes[:, 1:] # the start and the end node of every interval
+    # Log distances of every node above the shifted knock-in barrier and below the shifted auto-call barrier.
+    # Nodes between a barrier and its shifted level are clamped onto it (distance 0), which gives a crossing probability of 1.
+    above_low = np.maximum(X_nodes - log_L_shift, 0.0)
+    below_high = np.maximum(log_H_shift - X_nodes, 0.0)
+
+    # Knock-in: certain if the end node (a monitoring day) is below P_K, otherwise the bridge crossing probability
+    # (a zero distance of the end node gives a crossing probability of 1)
+    p_down = bridge_crossing_probability(above_low[:, :-1], above_low[:, 1:] * (X_b >= log_P_K), sigma, h)
+    knock_in_probability = 1.0 - np.prod(1.0 - p_down, axis=1)
+
+    # Auto-call inside the intervals of the auto-call window: certain if the end node is at or above P_C,
+    # otherwise the bridge probability
+    window = np.flatnonzero(in_window)
+    h_w = h[window]
+    start_w, end_w = node_times[window], node_times[window + 1]
+    X_b_w = X_b[:, window]
+    node_call = X_b_w >= log_P_C
+    p_hit = bridge_crossing_probability(below_high[:, window], below_high[:, window + 1], sigma, h_w)
+    q_call = np.maximum(p_hit, node_call)
+
+    # Expected call time inside the interval: the bridge first passage rounded up to the next monitoring day,
+    # or the end node itself for a node call that the bridge did not cross before
+    hit_fraction = bridge_expected_hitting_fraction(below_high[:, window], np.abs(log_H_shift - X_b_w), sigma, h_w)
+    hit_time = np.minimum(start_w + hit_fraction * h_w + 0.5 * monitoring_dt, end_w)
+    call_time = hit_time + node_call * (1.0 - p_hit) * (end_w - hit_time) # node call: p_hit * hit_time + (1 - p_hit) * end
+
+    # Accrued interest = NOM * CP% * (time since the preceding coupon date) / (length of the coupon period)
+    accrual_fraction = (call_time - period_start[window]) / (period_end[window] - period_start[window])
+
+    # The first auto-call date (Dc) is itself a monitoring day: a path at or above P_C on it is called there
+    # and, as in the daily engine, earns the whole first coupon period
+    first_day_call = X_a[:, window[0]] >= log_P_C
+    q_call[:, 0] = np.maximum(q_call[:, 0], first_day_call)
+    call_time[:, 0] = np.where(first_day_call, start_w[0], call_time[:, 0])
+    accrual_fraction[:, 0] = np.where(first_day_call, 1.0, accrual_fraction[:, 0])
+
+    # Probability of being called in each interval = probability of surviving the intervals before it * q_call
+    not_called = 1.0 - q_call
+    survival_before = np.ones_like(q_call)
+    np.cumprod(not_called[:, :-1], axis=1, out=survival_before[:, 1:])
+    called_discounted = survival_before * q_call * np.exp(-r_disc * call_time)
+    survival = survival_before[:, -1] * not_called[:, -1] # probability that the path is alive at expiry
+
+    principal_pv = NOM * np.sum(called_discounted, axis=1)
+    coupon_annuity = NOM * np.sum(called_discounted * accrual_fraction, axis=1)
+
+    # Paths alive at expiry: final coupon plus NOM, or NOM * S_M / K if knocked in and S_M < K
+    discount_factor_expiry = np.exp(-r_disc * T)
+    S_M = np.exp(X_nodes[:, -1])
+    principal_payoff = NOM - knock_in_probability * NOM * np.maximum(K - S_M, 0.0) / K
+    principal_pv += survival * principal_payoff * discount_factor_expiry
+    coupon_annuity += survival * alive_annuity
+
+    # Average each path with its antithetic partner
+    pair_principal_pv = 0.5 * (principal_pv[:num_pairs] + principal_pv[num_pairs:])
+    pair_coupon_annuity = 0.5 * (coupon_annuity[:num_pairs] + coupon_annuity[num_pairs:])
+
+    return pair_principal_pv, pair_coupon_annuity
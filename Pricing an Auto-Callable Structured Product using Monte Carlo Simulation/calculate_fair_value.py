@@ -2,18 +2,458 @@
 # In this simulation, we use Antithetic Variates with Multiprocessing to speed up the Monte Carlo simulation.
 
 import numpy as np
+import os
 import warnings
 import multiprocessing # Import this module for parallel processing
 import time
+import tracemalloc # Used to measure the peak memory of one path block
+from statistics import NormalDist # Used for the confidence interval of a pricing result
+from multiprocessing import resource_tracker, shared_memory # Used to share one pre-generated normal matrix between the workers
+from brownian_bridge import bridge_affine_pairs_block, build_bridge_grid
+from numba_kernel import NUMBA_AVAILABLE, autocall_pairs_kernel
+from qmc_sampler import DEFAULT_QMC_REPLICATES, iter_sobol_normal_blocks
+from control_variates import CONTROL_VARIATES, control_variate_means, control_variate_values
+from greeks import GREEK_NAMES, greek_pairs_block
+from importance_sampling import choose_importance_shift, importance_pairs_block
+from telemetry import instrumented_map, phase, profiling_active, record, run_profiled, telemetry_enabled, timed_blocks
 
 warnings.filterwarnings('ignore')
 
+T_EXPIRY = 0.5 # Refer to: Expiry date (T): t + 1/2 year
+N_STEPS = 180 # Refer to: For example, if the expiry date of the product is 6 months, use 180 time steps.
+
+# Engines that can run one worker chunk. 'numpy' is the batched engine, 'numba' the compiled per-path kernel (numba_kernel.py,
+# falls back to 'numpy' when numba is not installed), 'loop' is the original path-by-path engine kept as reference.
+BACKENDS = ('numpy', 'numba', 'loop')
+
+# The numpy engine streams the paths of a chunk in blocks of this many antithetic pairs.
+# One block of 8,192 pairs needs about 50 MB, however large num_paths is (a dense (300000, 181) array is about 430 MB).
+DEFAULT_BLOCK_PAIRS = 8192
+
+# Path schemes of the numpy engine:
+#   'euler'  - the additive Euler step on every day (the original scheme, N = 180 steps)
+#   'exact'  - the exact lognormal step on every day (N = 180 steps, no discretisation bias in the stock)
+#   'bridge' - exact lognormal steps on the coupon dates plus `substeps` nodes per coupon period, with a Brownian-bridge
+#              correction for the barrier crossings between the nodes (see brownian_bridge.py)
+SCHEMES = ('euler', 'exact', 'bridge')
+DEFAULT_SUBSTEPS = 2
+
+# Where the normal shocks come from:
+#   'random' - pseudo-random normals (np.random), one stream per block
+#   'sobol'  - randomized QMC: scrambled Sobol points with Brownian-bridge path construction (see qmc_sampler.py)
+SAMPLERS = ('random', 'sobol')
+
+# Floating-point type of the normals and the paths of the numpy engine ('euler' / 'exact' schemes, 'random' sampler).
+# 'float32' halves the memory of a block and the bytes every elementwise step moves; the payoff (discounting, redemption)
+# and the running sums of the moments stay in float64. A float32 run draws float32 normals from the same block streams,
+# so it is reproducible with a seed but does not see the float64 numbers rounded. On a SharedNormals buffer it does:
+# the float64 normals are rounded to float32 block by block, so both dtypes price the same scenarios (see precision_check.py).
+DTYPES = ('float64', 'float32')
+
+
+# Build the discrete schedule of the product (the same numbers the loop engine computes inside the path loop)
+def build_step_schedule(params, T=T_EXPIRY, N=N_STEPS):
+    dt = T / N
+    # coupon_times / T * N converts every coupon date into a discrete time step
+    coupon_steps = (params['time_points'] / T * N).astype(int)
+    # First auto-call date (Dc): t + 1/12 year
+    first_autocall_step = coupon_steps[0]
+    # [0, 30, 60, 90, 120, 150, 180], the "boundary points" of every interest period
+    all_period_boundaries = np.union1d([0, N], coupon_steps).astype(int)
+    return dt, coupon_steps, first_autocall_step, all_period_boundaries
+
+
+# Generate a whole block of GBM paths at once.
+# Z has shape (num_paths, N), the returned S_paths has shape (num_paths, N + 1) with S_paths[:, 0] = S0
+def simulate_paths_block(Z, S0, r_g, sigma, dt):
+    # Refer to: dS = r_g S dt + \sigma S Z \sqrt{dt}
+    # S[i+1] = S[i] + r_g S[i] dt + sigma S[i] Z[i] sqrt(dt) = S[i] * (1 + r_g dt + sigma Z[i] sqrt(dt)),
+    # so the whole path is S0 times the cumulative product of the daily growth factors.
+    # The coefficients take the dtype of Z: a float64 scalar would turn a float32 block into float64
+    growth = Z.dtype.type(1.0 + r_g * dt) + Z.dtype.type(sigma * np.sqrt(dt)) * Z
+    S_paths = np.empty((Z.shape[0], Z.shape[1] + 1), dtype=Z.dtype)
+    S_paths[:, 0] = S0
+    np.cumprod(growth, axis=1, out=S_paths[:, 1:])
+    S_paths[:, 1:] *= S0
+    return S_paths
+
+
+# Same as simulate_paths_block, with the exact lognormal step instead of the Euler step:
+# S[i+1] = S[i] * exp((r_g - sigma^2 / 2) dt + sigma Z[i] sqrt(dt))
+def simulate_paths_block_exact(Z, S0, r_g, sigma, dt):
+    log_growth = Z.dtype.type((r_g - 0.5 * sigma ** 2) * dt) + Z.dtype.type(sigma * np.sqrt(dt)) * Z
+    S_paths = np.empty((Z.shape[0], Z.shape[1] + 1), dtype=Z.dtype)
+    S_paths[:, 0] = S0
+    np.cumsum(log_growth, axis=1, out=S_paths[:, 1:])
+    np.exp(S_paths[:, 1:], out=S_paths[:, 1:])
+    S_paths[:, 1:] *= S0
+    return S_paths
+
+
+# Times of the steps of a scheme (t_1, ..., t_N): every day, or the nodes of the coarse grid of the bridge scheme
+def scheme_step_times(params, scheme='euler', substeps=DEFAULT_SUBSTEPS):
+    if scheme not in SCHEMES:
+        raise ValueError(f"scheme must be one of {SCHEMES}")
+    if scheme == 'bridge':
+        if substeps < 1:
+            raise ValueError("substeps must be a positive number of nodes per coupon period")
+        return build_bridge_grid(params['time_points'], substeps, T_EXPIRY)[0][1:]
+    return T_EXPIRY / N_STEPS * np.arange(1, N_STEPS + 1)
+
+
+# Number of normals one path of a scheme needs: one per day, or one per interval of the coarse grid of the bridge scheme
+def scheme_num_steps(params, scheme='euler', substeps=DEFAULT_SUBSTEPS):
+    return len(scheme_step_times(params, scheme, substeps))
+
+
+# The coupons of the dates before expiry plus the final coupon, all discounted (the annuity of a path alive at expiry)
+def alive_coupon_annuity(params, r_disc, T=T_EXPIRY, N=N_STEPS):
+    dt, coupon_steps, first_autocall_step, all_period_boundaries = build_step_schedule(params, T, N)
+    alive_annuity = params['NOM'] * np.exp(-r_disc * T)
+    for coupon_step in coupon_steps[coupon_steps < N]:
+        alive_annuity += params['NOM'] * np.exp(-r_disc * coupon_step * dt)
+    return alive_annuity
+
+
+# Evaluate the autocall payoff of every path in a block.
+# The fair value of a path is affine in the coupon rate: PV = principal_pv + CP_rate * coupon_annuity
+#   principal_pv:   discounted NOM paid at auto-call, or the discounted principal / redemption paid at expiry
+#   coupon_annuity: discounted coupons and accrued coupon, per unit of CP_rate
+def payoff_components_block(S_paths, r_disc, params, T=T_EXPIRY):
+    NOM = params['NOM']
+    S0 = params['S0']
+
+    N = S_paths.shape[1] - 1
+    dt, coupon_steps, first_autocall_step, all_period_boundaries = build_step_schedule(params, T, N)
+
+    P_K = S0 * params['KI'] # Knock-in Price
+    P_C = S0 * params['AC'] # Auto-Call Price
+    K = S0 * params['K0'] # Strike Price at Maturity
+
+    # B. Knock-in: the row-wise minimum of the path is below the knock-in price
+    knock_in_occurred = np.min(S_paths[:, 1:], axis=1) < P_K
+
+    # C. Auto-call: the first step on or after first_autocall_step where the price reaches P_C.
+    # argmax on a boolean mask returns the first True, rows without any True are not called at all.
+    call_mask = S_paths[:, first_autocall_step:] >= P_C
+    terminated_early = call_mask.any(axis=1)
+    call_step = first_autocall_step + np.argmax(call_mask, axis=1)
+
+    # Auto-called paths: NOM + accrued interest, discounted from the call date.
+    # As in the loop engine, the auto-call payoff *replaces* the path cost (path_total_cost = payoff * discount_factor),
+    # so coupons of the dates before the call do not enter the PV of a called path.
+    # Accrued interest = NOM * CP% * num_days / total_days within the current interest period
+    period_index = np.searchsorted(all_period_boundaries, call_step, side='left') - 1
+    preceding_coupon_step = all_period_boundaries[period_index]
+    next_coupon_step = all_period_boundaries[period_index + 1]
+    accrual_fraction = (call_step - preceding_coupon_step) / (next_coupon_step - preceding_coupon_step)
+    call_discount = np.exp(-r_disc * call_step * dt)
+
+    # Paths alive at expiry: final coupon plus NOM, or NOM * S_M / K if knocked in and S_M < K
+    discount_factor_expiry = np.exp(-r_disc * T)
+    S_M = S_paths[:, N].astype(np.float64) # the redemption is computed in float64 whatever the dtype of the paths
+    principal_payoff = np.where(knock_in_occurred & (S_M < K), NOM * S_M / K, NOM)
+
+    alive_annuity = alive_coupon_annuity(params, r_disc, T, N)
+
+    principal_pv = np.where(terminated_early, NOM * call_discount, principal_payoff * discount_factor_expiry)
+    coupon_annuity = np.where(terminated_early, NOM * accrual_fraction * call_discount, alive_annuity)
+
+    return principal_pv, coupon_annuity
+
+
+# Price one block of antithetic pairs without fixing the coupon. Z has shape (num_pairs, scheme_num_steps(params, scheme, substeps)).
+# Returns (pair_principal_pv, pair_coupon_annuity), each averaged over Z and -Z, so the pair PV is pair_principal_pv + CP_rate * pair_coupon_annuity
+# timings (a dict, see telemetry.py) collects the time of the path generation and of the payoff evaluation
+def affine_pairs_block(Z, r_g, r_disc, params, scheme='euler', substeps=DEFAULT_SUBSTEPS, timings=None):
+    if scheme == 'bridge':
+        with phase(timings, 'kernel'):
+            return bridge_affine_pairs_block(Z, r_g, r_disc, params, substeps, T_EXPIRY, N_STEPS)
+
+    dt = T_EXPIRY / N_STEPS
+    simulate_paths = simulate_paths_block_exact if scheme == 'exact' else simulate_paths_block
+    pair_principal_pv = np.zeros(Z.shape[0])
+    pair_coupon_annuity = np.zeros(Z.shape[0])
+    for z_block in (Z, -Z): # antithetic pair
+        with phase(timings, 'paths'):
+            S_paths = simulate_paths(z_block, params['S0'], r_g, params['sigma_stock'], dt)
+        with phase(timings, 'payoff'):
+            principal_pv, coupon_annuity = payoff_components_block(S_paths, r_disc, params)
+        pair_principal_pv += 0.5 * principal_pv
+        pair_coupon_annuity += 0.5 * coupon_annuity
+    return pair_principal_pv, pair_coupon_annuity
+
+
+# Same as affine_pairs_block, with the compiled kernel of numba_kernel.py (daily 'euler' or 'exact' steps)
+def numba_affine_pairs_block(Z, r_g, r_disc, params, scheme='euler'):
+    S0 = params['S0']
+    dt, coupon_steps, first_autocall_step, all_period_boundaries = build_step_schedule(params, T_EXPIRY, Z.shape[1])
+    pair_principal_pv = np.empty(Z.shape[0])
+    pair_coupon_annuity = np.empty(Z.shape[0])
+    autocall_pairs_kernel(np.ascontiguousarray(Z), S0, r_g, params['sigma_stock'], dt, scheme == 'exact', params['NOM'],
+                          S0 * params['KI'], S0 * params['AC'], S0 * params['K0'], r_disc, T_EXPIRY,
+                          first_autocall_step, all_period_boundaries, alive_coupon_annuity(params, r_disc, T_EXPIRY, Z.shape[1]),
+                          pair_principal_pv, pair_coupon_annuity)
+    return pair_principal_pv, pair_coupon_annuity
+
+
+# Compile the kernel (or load it from the numba cache) in this process before the workers start,
+# so workers forked afterwards inherit the compiled kernel instead of loading it again on every pricing call
+def warm_up_numba_backend(params):
+    numba_affine_pairs_block(np.zeros((1, N_STEPS)), 0.0, 0.0, params)
+
+
+# Price one block of antithetic pairs. Z has shape (num_pairs, N); returns the PV of every pair, averaged over Z and -Z
+def price_pairs_block(Z, CP_rate, r_g, r_disc, params, scheme='euler', substeps=DEFAULT_SUBSTEPS):
+    pair_principal_pv, pair_coupon_annuity = affine_pairs_block(Z, r_g, r_disc, params, scheme, substeps)
+    return pair_principal_pv + CP_rate * pair_coupon_annuity
+
+
+# Random numbers of a run.
+# Without a seed the normals come from the global np.random stream (the stream the loop engine always used).
+# With a seed, every block of block_pairs pairs has its own stream spawned from the seed by its global block index,
+# so the normals of a run are the same for every call and do not depend on how the blocks are split between cores.
+# This is what Common Random Numbers (CRN) needs: reusing the seed for every guess of a solve makes the objective deterministic.
+def block_normal_generator(seed, block_index):
+    return np.random.default_rng(np.random.SeedSequence(seed, spawn_key=(block_index,)))
+
+
+# Yield the normals of num_pairs antithetic pairs, one (pairs_in_block, N) array per block, starting at global block first_block.
+# dtype is 'float64' or 'float32' (seeded float32 blocks are drawn in float32 by the block's generator).
+def iter_normal_blocks(num_pairs, block_pairs=DEFAULT_BLOCK_PAIRS, seed=None, first_block=0, N=N_STEPS, dtype='float64'):
+    pairs_done = 0
+    block_index = first_block
+    while pairs_done < num_pairs:
+        pairs_in_block = min(block_pairs, num_pairs - pairs_done)
+        if seed is None:
+            # Drawing (pairs_in_block, N) blocks one after another consumes the random stream in the same order as the loop engine
+            Z = np.random.standard_normal((pairs_in_block, N)).astype(dtype, copy=False)
+        else:
+            Z = block_normal_generator(seed, block_index).standard_normal((pairs_in_block, N), dtype=dtype)
+        yield Z
+        pairs_done += pairs_in_block
+        block_index += 1
+
+
+# Batched engine: stream the antithetic pairs of this chunk in blocks of (block_pairs, N + 1) arrays.
+# Only running moments of the pair PVs are kept, so the memory does not grow with num_pairs.
+# Besides the PV moments we keep the moments of the affine parts a (principal PV) and b (coupon annuity),
+# so the mean and variance of the PV at *any* coupon rate can be recovered from one pass.
+# With control variates (a tuple of names from CONTROL_VARIATES) the sums of the controls, of their cross products
+# and of their products with the PV, a and b are kept as well (c_sum, cc_sum, cy_sum, ca_sum, cb_sum).
+# With greeks (the product type, see greeks.py) the sums and squares of the pair Greeks are kept (greek_sum, greek_sum_sq).
+# With importance_shift (the daily shift theta, see importance_sampling.py) a and b are the likelihood-ratio weighted parts,
+# and the pair likelihood ratio is kept as the control (c_sum, ...) with mean 1.
+# With dtype='float32' the normals and the paths are float32; the pair parts a and b and all the sums are float64.
+# timings (a dict, telemetry on) collects the time of every phase of the chunk (see telemetry.PHASES).
+def run_simulation_chunk_vectorized(num_pairs, CP_rate, r_g, r_disc, params, block_pairs=DEFAULT_BLOCK_PAIRS, seed=None, first_block=0,
+                                   normal_blocks=None, scheme='euler', substeps=DEFAULT_SUBSTEPS, backend='numpy', control_variates=None,
+                                   greeks=None, importance_shift=None, dtype='float64', timings=None):
+    moments = {'sum': 0.0, 'sum_sq': 0.0, 'count': 0,
+               'a_sum': 0.0, 'b_sum': 0.0, 'a_sum_sq': 0.0, 'ab_sum': 0.0, 'b_sum_sq': 0.0}
+    peak_block_bytes = 0
+
+    # Measure the first (and largest) block with tracemalloc, numpy reports its array allocations to it
+    was_tracing = tracemalloc.is_tracing()
+    if not was_tracing:
+        tracemalloc.start()
+    tracemalloc.reset_peak()
+    baseline_bytes = tracemalloc.get_traced_memory()[0]
+
+    # normal_blocks can bring the normals from elsewhere (e.g. a SharedNormals buffer), otherwise they are generated here
+    if normal_blocks is None:
+        normal_blocks = iter_normal_blocks(num_pairs, block_pairs, seed, first_block, scheme_num_steps(params, scheme, substeps), dtype)
+    if timings is not None:
+        normal_blocks = timed_blocks(normal_blocks, timings)
+    if control_variates:
+        step_times = scheme_step_times(params, scheme, substeps)
+    if greeks:
+        schedule = build_step_schedule(params, T_EXPIRY, N_STEPS)
+        moments['greek_names'] = GREEK_NAMES[greeks]
+
+    for Z in normal_blocks:
+        if importance_shift is not None:
+            with phase(timings, 'kernel'):
+                a, b, w = importance_pairs_block(Z, importance_shift, r_g, r_disc, params, scheme)
+        elif backend == 'numba':
+            with phase(timings, 'kernel'):
+                a, b = numba_affine_pairs_block(Z, r_g, r_disc, params, scheme)
+        else:
+            a, b = affine_pairs_block(Z, r_g, r_disc, params, scheme, substeps, timings)
+        pair_pv = a + CP_rate * b
+
+        if moments['count'] == 0:
+            peak_block_bytes = tracemalloc.get_traced_memory()[1] - baseline_bytes
+            if not was_tracing:
+                tracemalloc.stop()
+
+        with phase(timings, 'moments'):
+            moments['sum'] += np.sum(pair_pv)
+            moments['sum_sq'] += np.sum(pair_pv ** 2)
+            moments['count'] += Z.shape[0]
+            moments['a_sum'] += np.sum(a)
+            moments['b_sum'] += np.sum(b)
+            moments['a_sum_sq'] += np.sum(a ** 2)
+            moments['ab_sum'] += np.sum(a * b)
+            moments['b_sum_sq'] += np.sum(b ** 2)
+
+        if control_variates or importance_shift is not None:
+            with phase(timings, 'controls'):
+                C = w[:, None] if importance_shift is not None else control_variate_values(Z, step_times, r_g, r_disc, params, control_variates)
+                for key, value in (('c_sum', np.sum(C, axis=0)), ('cc_sum', C.T @ C), ('cy_sum', C.T @ pair_pv),
+                                   ('ca_sum', C.T @ a), ('cb_sum', C.T @ b)):
+                    moments[key] = moments.get(key, 0.0) + value
+
+        if greeks:
+            with phase(timings, 'greeks'):
+                G = greek_pairs_block(Z, CP_rate, r_g, r_disc, params, greeks, schedule, scheme)
+                moments['greek_sum'] = moments.get('greek_sum', 0.0) + np.sum(G, axis=0)
+                moments['greek_sum_sq'] = moments.get('greek_sum_sq', 0.0) + np.sum(G ** 2, axis=0)
+
+    moments['peak_block_bytes'] = peak_block_bytes
+    return moments
+
+
+# Pre-generated normal shocks in shared memory.
+# When many product variants (Q1 / Q2 / Q3, solver guesses) are priced on the same scenarios, the normals are generated once
+# into a multiprocessing.shared_memory buffer; the workers attach to it without copying and each prices its own slice of rows.
+# The buffer is filled block by block with iter_normal_blocks, so a run on SharedNormals(num_pairs, seed) uses exactly the
+# normals of a seeded run with the same seed and block_pairs.
+#
+#     with SharedNormals(150000, seed=42) as normals:
+#         fv_hkd = calculate_fair_value(3.45, hkd_params_prod, 'HKD', shared_normals=normals)
+#         fv_quanto = calculate_fair_value(3.26, quanto_params_prod, 'Quanto', shared_normals=normals)
+class SharedNormals:
+
+    def __init__(self, num_pairs, seed=None, block_pairs=DEFAULT_BLOCK_PAIRS, N=N_STEPS):
+        if seed is None:
+            seed = np.random.SeedSequence().entropy
+        self.seed = seed
+        self.block_pairs = block_pairs
+        self.shape = (num_pairs, N)
+        self._shm = shared_memory.SharedMemory(create=True, size=max(1, num_pairs * N * np.dtype(np.float64).itemsize))
+        self.array = np.ndarray(self.shape, dtype=np.float64, buffer=self._shm.buf)
+
+        row = 0
+        for Z in iter_normal_blocks(num_pairs, block_pairs, seed, 0, N):
+            self.array[row:row + Z.shape[0]] = Z
+            row += Z.shape[0]
+
+    # What a worker needs to attach to the buffer: (name, shape)
+    @property
+    def handle(self):
+        return (self._shm.name, self.shape)
+
+    # Release this process's view and remove the buffer
+    def close(self):
+        if self._shm is not None:
+            self.array = None
+            self._shm.close()
+            self._shm.unlink()
+            self._shm = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+        return False
+
+
+# The SharedNormals buffer this worker is attached to, kept between tasks: {'name': ..., 'shm': ..., 'array': ...}
+_attached_normals = {}
+
+
+# Attach (once per buffer) to a SharedNormals buffer and return its (num_pairs, N) array, without copying
+def attach_shared_normals(handle):
+    name, shape = handle
+    if _attached_normals.get('name') != name:
+        if _attached_normals:
+            # A new buffer replaces the old one, release the old mapping
+            _attached_normals['array'] = None
+            _attached_normals['shm'].close()
+        shm = shared_memory.SharedMemory(name=name)
+        _attached_normals.update({'name': name, 'shm': shm, 'array': np.ndarray(shape, dtype=np.float64, buffer=shm.buf)})
+    return _attached_normals['array']
+
+
+# Yield the rows of this chunk from a shared normal matrix, in (block_pairs, N) views (zero copy for float64,
+# a float32 copy of each block for dtype='float32')
+def iter_shared_normal_blocks(normals, num_pairs, block_pairs, first_block, dtype='float64'):
+    first_pair = first_block * block_pairs
+    for start in range(first_pair, first_pair + num_pairs, block_pairs):
+        yield normals[start:min(start + block_pairs, first_pair + num_pairs)].astype(dtype, copy=False)
+
+
+# Static product parameters of a PricingPool worker. They are sent once, when the worker starts (see init_pricing_worker).
+_worker_params = None
+
+
+def init_pricing_worker(params):
+    global _worker_params
+    _worker_params = params
+
+
 # This fuction is a process worker MC simulation chunk, which will be run by one CPU core.
+# It returns a dict with the sum, sum of squares and count of the antithetic pair PVs and the peak memory of one block in bytes.
+# The numpy engine also returns the moments of the affine parts (a_sum, b_sum, a_sum_sq, ab_sum, b_sum_sq).
 def run_simulation_chunk(args):
 
     # Unpack arguments
     # num_paires is the number of antithetic pairs to simulate in this chunk
-    num_pairs, CP_rate, r_g, r_disc, params = args
+    # engine_options holds the engine settings, e.g. {'backend': 'numpy', 'block_pairs': 8192, 'seed': 42, 'first_block': 0, 'scheme': 'euler'}
+    num_pairs, CP_rate, r_g, r_disc, params = args[:5]
+    engine_options = args[5] if len(args) > 5 else {}
+
+    # Profiled solve (telemetry.profiled_solve): run this task under cProfile and send the statistics back with the moments
+    if engine_options.get('profile'):
+        moments, profile_stats = run_profiled(run_simulation_chunk, args[:5] + (dict(engine_options, profile=False),))
+        moments['profile'] = profile_stats
+        return moments
+    chunk_start = time.perf_counter()
+    timings = {} if engine_options.get('telemetry') else None
+
+    if params is None:
+        # PricingPool task: the static parameters already live in this worker, only the overrides travel with the task
+        params = dict(_worker_params, **engine_options.get('param_overrides', {}))
+
+    block_pairs = engine_options.get('block_pairs', DEFAULT_BLOCK_PAIRS)
+    seed = engine_options.get('seed')
+    first_block = engine_options.get('first_block', 0)
+
+    # With a SharedNormals handle the normals are read from shared memory instead of being generated by this worker
+    normal_blocks = None
+    if engine_options.get('shared_normals') is not None:
+        normals = attach_shared_normals(engine_options['shared_normals'])
+        normal_blocks = iter_shared_normal_blocks(normals, num_pairs, block_pairs, first_block, engine_options.get('dtype', 'float64'))
+
+    # Sobol sampler: this chunk is one whole randomized QMC replicate
+    if engine_options.get('sampler', 'random') == 'sobol':
+        times = scheme_step_times(params, engine_options.get('scheme', 'euler'), engine_options.get('substeps', DEFAULT_SUBSTEPS))
+        normal_blocks = iter_sobol_normal_blocks(num_pairs, block_pairs, seed, engine_options['replicate'], times,
+                                                 engine_options.get('first_pair', 0))
+
+    if engine_options.get('backend', 'numpy') == 'loop':
+        moments = run_simulation_chunk_loop(num_pairs, CP_rate, r_g, r_disc, params, block_pairs, seed, first_block, normal_blocks)
+    else:
+        moments = run_simulation_chunk_vectorized(num_pairs, CP_rate, r_g, r_disc, params, block_pairs, seed, first_block, normal_blocks,
+                                                  engine_options.get('scheme', 'euler'), engine_options.get('substeps', DEFAULT_SUBSTEPS),
+                                                  engine_options.get('backend', 'numpy'), engine_options.get('control_variates'),
+                                                  engine_options.get('greeks'), engine_options.get('importance_shift'),
+                                                  engine_options.get('dtype', 'float64'), timings)
+    if engine_options.get('importance_shift') is not None:
+        moments['importance_shift'] = engine_options['importance_shift']
+        moments['importance_pilot_reduction'] = engine_options.get('importance_pilot_reduction')
+    if timings is not None:
+        # This worker's share of the call, collected by telemetry.instrumented_map
+        moments['telemetry'] = {'pid': os.getpid(), 'first_block': first_block, 'pairs': num_pairs, 'paths': 2 * num_pairs,
+                                'chunk_time': time.perf_counter() - chunk_start, 'timings': timings}
+    return moments
+
+
+# The original path-by-path engine. It is slow, but it follows the term sheet line by line, so we keep it as the reference implementation.
+def run_simulation_chunk_loop(num_pairs, CP_rate, r_g, r_disc, params, block_pairs=DEFAULT_BLOCK_PAIRS, seed=None, first_block=0,
+                              normal_blocks=None):
     
     NOM = params['NOM']
     S0 = params['S0']
@@ -23,8 +463,8 @@ def run_simulation_chunk(args):
     KI_pct = params['KI']
     AC_pct = params['AC']
 
-    T = 0.5 # Refer to: Expiry date (T): t + 1/2 year
-    N = 180 # Refer to: For example, if the expiry date of the product is 6 months, use 180 time steps.
+    T = T_EXPIRY # Refer to: Expiry date (T): t + 1/2 year
+    N = N_STEPS # Refer to: For example, if the expiry date of the product is 6 months, use 180 time steps.
     dt = T / N # dt is crucial for GBM path generation
     
     # Retrieves the time_points array from the params dictionary and stores it in the coupon_times variable for later use
@@ -46,127 +486,124 @@ def run_simulation_chunk(args):
     # Strick Price at Maturity
     K = S0 * K0_pct
     
-    # Accumulator for this chunk's total payoff
-    chunk_payoff_accumulator = 0.0
+    # Accumulators for this chunk's antithetic pair payoffs
+    pair_sum = 0.0
+    pair_sum_sq = 0.0
 
     # genrate antithetic variable paths
-    for _ in range(num_pairs):
-        
-        # generate Z, representing the "random shock"  for each day of the stock's future 180-day path
-        Z = np.random.standard_normal(N)
-        paths_Z = [Z, -Z] # antithetic pair
+    # the normals come in the same blocks (and, with a seed, the same streams) as in the numpy engine
+    if normal_blocks is None:
+        normal_blocks = iter_normal_blocks(num_pairs, block_pairs, seed, first_block)
+    for Z_block in normal_blocks:
+        for Z in Z_block:
+            # Z is the "random shock" for each day of the stock's future 180-day path
+            paths_Z = [Z, -Z] # antithetic pair
+            pair_total_cost = 0.0
         
-        # calculate the payoff for both paths in the antithetic pair
-        for z_vector in paths_Z:
+            # calculate the payoff for both paths in the antithetic pair
+            for z_vector in paths_Z:
             
-            path_total_cost = 0.0
-            knock_in_occurred = False
-            product_terminated_early = False
-
-            # A. generate the stock pirce path
-            # Refer to: dS = r_g S dt + \sigma S Z \sqrt{dt}
-            S_path = np.zeros(N + 1) # We need to store 181 price points. Points 1 to 180: The future 180 simulated daily prices.
-            S_path[0] = S0 # Initial the first price
-            # calculate every day point price
-            for i in range(N):
-                dS = r_g * S_path[i] * dt + sigma * S_path[i] * z_vector[i] * np.sqrt(dt) # z_vector[i] is the random shock for day i
-                S_path[i+1] = S_path[i] + dS # later date prce is previous date price + change
-            # When we simulate every path, we can then use every path to calculate the payoff.
-
-            # B. Check: Knock-in event
-            if np.min(S_path[1:]) < P_K:
-                knock_in_occurred = True
-
-            # C. Check each step for auto-call and coupon payments
-            for step in range(1, N + 1):
-                # price
-                current_price = S_path[step]
-                # transform step to annual time
-                current_time = step * dt
-
-                # Check for auto-call
-                # This part is to simulate Early termination condition
-                # auto call condition, the two condition must be simultaneously sastisfied: 
-                # (1) Is today (step) on or after the first_autocall_step (day 30)? 
-                # (2) Is the current_price greater than or equal to the auto-call price (P_C)?
-                if step >= first_autocall_step and current_price >= P_C:
-                    # Tell the code that this path has "terminated early".
-                    product_terminated_early = True
-                    # Investor will receive NOM first, then based on it, we can add interest.
-                    payoff = NOM
+                path_total_cost = 0.0
+                knock_in_occurred = False
+                product_terminated_early = False
+
+                # A. generate the stock pirce path
+                # Refer to: dS = r_g S dt + \sigma S Z \sqrt{dt}
+                S_path = np.zeros(N + 1) # We need to store 181 price points. Points 1 to 180: The future 180 simulated daily prices.
+                S_path[0] = S0 # Initial the first price
+                # calculate every day point price
+                for i in range(N):
+                    dS = r_g * S_path[i] * dt + sigma * S_path[i] * z_vector[i] * np.sqrt(dt) # z_vector[i] is the random shock for day i
+                    S_path[i+1] = S_path[i] + dS # later date prce is previous date price + change
+                # When we simulate every path, we can then use every path to calculate the payoff.
+
+                # B. Check: Knock-in event
+                if np.min(S_path[1:]) < P_K:
+                    knock_in_occurred = True
+
+                # C. Check each step for auto-call and coupon payments
+                for step in range(1, N + 1):
+                    # price
+                    current_price = S_path[step]
+                    # transform step to annual time
+                    current_time = step * dt
+
+                    # Check for auto-call
+                    # This part is to simulate Early termination condition
+                    # auto call condition, the two condition must be simultaneously sastisfied: 
+                    # (1) Is today (step) on or after the first_autocall_step (day 30)? 
+                    # (2) Is the current_price greater than or equal to the auto-call price (P_C)?
+                    if step >= first_autocall_step and current_price >= P_C:
+                        # Tell the code that this path has "terminated early".
+                        product_terminated_early = True
+                        # Investor will receive NOM first, then based on it, we can add interest.
+                        payoff = NOM
                     
-                    # The accrued interest refer to:
-                    # Investor receives NOM + accrued interest... Accrued interest = NOM * CP% * num_days / total_days, where num_days = number of days between the call date and the coupon date immediately preceding the call date total_days = number of days between the coupon dates immediately preceding and following the call date
-
-                    # Becauese there are different coupon periods and action, we have to calculate wchih coupon period we are in.
-                    period_index = np.searchsorted(all_period_boundaries, step, side='left') - 1
-                    # Find the preceding and next coupon step boundaries
-                    preceding_coupon_step = all_period_boundaries[period_index]
-                    next_coupon_step = all_period_boundaries[period_index + 1]
+                        # The accrued interest refer to:
+                        # Investor receives NOM + accrued interest... Accrued interest = NOM * CP% * num_days / total_days, where num_days = number of days between the call date and the coupon date immediately preceding the call date total_days = number of days between the coupon dates immediately preceding and following the call date
+
+                        # Becauese there are different coupon periods and action, we have to calculate wchih coupon period we are in.
+                        period_index = np.searchsorted(all_period_boundaries, step, side='left') - 1
+                        # Find the preceding and next coupon step boundaries
+                        preceding_coupon_step = all_period_boundaries[period_index]
+                        next_coupon_step = all_period_boundaries[period_index + 1]
                     
-                    # denominator: how many days have actually passed within this period?
-                    num_steps = step - preceding_coupon_step
-                    # nominator: what is the total length of this interest period?
-                    total_steps = next_coupon_step - preceding_coupon_step
+                        # denominator: how many days have actually passed within this period?
+                        num_steps = step - preceding_coupon_step
+                        # nominator: what is the total length of this interest period?
+                        total_steps = next_coupon_step - preceding_coupon_step
                     
-                    # Nominal * CouponRate * (Days_Passed / Total_Days)
-                    accrued_interest = NOM * CP_rate * (num_steps / total_steps)
-                    # NOM + Accurued Interest
-                    payoff += accrued_interest
+                        # Nominal * CouponRate * (Days_Passed / Total_Days)
+                        accrued_interest = NOM * CP_rate * (num_steps / total_steps)
+                        # NOM + Accurued Interest
+                        payoff += accrued_interest
                     
-                    # Discount from current to present
-                    discount_factor = np.exp(-r_disc * current_time)
-                    path_total_cost = payoff * discount_factor
-                    break 
-
-                # This part is to simulate Coupons to be paid to investor in 6 coupon dates
-                # calculate the coupon payment if the date is a coupon date
-                if step in coupon_steps and step < N: # The last coupon payment at expiry is handled separately in the next section
-                    payoff = NOM * CP_rate # NOM * CP%
-                    discount_factor = np.exp(-r_disc * current_time) # transdorm to present value
-                    path_total_cost += payoff * discount_factor # accumulate the coupon payment
-
-            # This part is to simulate Payoff at expiry if the product has not terminated early, the terminated date is defined as before.
-            if not product_terminated_early: # If the product is not terminated early
-                T_expiry = T # Sets a variable T_expiry to the total tenor T (which is 0.5 years).
-                discount_factor_expiry = np.exp(-r_disc * T_expiry) # Discount factor from expiry to present
-                S_M = S_path[N] # Gets the final step (step 180, N=180) price from the simulation path S_path.
-
-                payoff_coupon = NOM * CP_rate # Calculates the final coupon amount.
-                path_total_cost += payoff_coupon * discount_factor_expiry # Add to the cosy total cost
-
-                principal_payoff = 0.0
-                if not knock_in_occurred: # knock_in_occurred is checked in section B, where check the whole fluctuation path
-                    principal_payoff = NOM # Refer to: If a knock-in event has not occurred, then investor receives NOM
-                else: # If a knock-in event has occurred
-                    if S_M >= K:
-                        principal_payoff = NOM # Refer to: if... S_M is greater than or equal to the strike price K, ... receives NOM
-                    else:
-                        principal_payoff = NOM * S_M / K # Refer to: The investor receives NOM * S_M / K”
-                
-                # Finally, add the principal payoff at expiry to the total cost
-                path_total_cost += principal_payoff * discount_factor_expiry
+                        # Discount from current to present
+                        discount_factor = np.exp(-r_disc * current_time)
+                        path_total_cost = payoff * discount_factor
+                        break 
 
-            # E. Accumulate the total cost for this path into the chunk accumulator, for the MC average calculation later
-            chunk_payoff_accumulator += path_total_cost
-    
-    # return the total payoff accumulated in this chunk
-    return chunk_payoff_accumulator
+                    # This part is to simulate Coupons to be paid to investor in 6 coupon dates
+                    # calculate the coupon payment if the date is a coupon date
+                    if step in coupon_steps and step < N: # The last coupon payment at expiry is handled separately in the next section
+                        payoff = NOM * CP_rate # NOM * CP%
+                        discount_factor = np.exp(-r_disc * current_time) # transdorm to present value
+                        path_total_cost += payoff * discount_factor # accumulate the coupon payment
 
+                # This part is to simulate Payoff at expiry if the product has not terminated early, the terminated date is defined as before.
+                if not product_terminated_early: # If the product is not terminated early
+                    T_expiry = T # Sets a variable T_expiry to the total tenor T (which is 0.5 years).
+                    discount_factor_expiry = np.exp(-r_disc * T_expiry) # Discount factor from expiry to present
+                    S_M = S_path[N] # Gets the final step (step 180, N=180) price from the simulation path S_path.
 
-# Calculate fair value through Monte Carlo simulation with Antithetic Variates and Multiprocessing
-def calculate_fair_value(CP_guess, params, product_type='HKD'): 
-    # product_type can be 'HKD' or 'Quanto'
-    # CP_guess is a persentage, which is a guess of the coupon rate, beacause we guess and validate the coupon, and finally find the right coupon
+                    payoff_coupon = NOM * CP_rate # Calculates the final coupon amount.
+                    path_total_cost += payoff_coupon * discount_factor_expiry # Add to the cosy total cost
 
-    # load the nomber of paths
-    num_paths = params['num_paths']
-    
-    # Becaues we ues antithetic variates, each "pair" consists of 2 paths
-    num_pairs = num_paths // 2 
+                    principal_payoff = 0.0
+                    if not knock_in_occurred: # knock_in_occurred is checked in section B, where check the whole fluctuation path
+                        principal_payoff = NOM # Refer to: If a knock-in event has not occurred, then investor receives NOM
+                    else: # If a knock-in event has occurred
+                        if S_M >= K:
+                            principal_payoff = NOM # Refer to: if... S_M is greater than or equal to the strike price K, ... receives NOM
+                        else:
+                            principal_payoff = NOM * S_M / K # Refer to: The investor receives NOM * S_M / K”
+                
+                    # Finally, add the principal payoff at expiry to the total cost
+                    path_total_cost += principal_payoff * discount_factor_expiry
+
+                # E. Accumulate the total cost for this path into the pair total, for the MC average calculation later
+                pair_total_cost += path_total_cost
+
+            # The average of the two antithetic paths is one independent sample
+            pair_sum += pair_total_cost / 2
+            pair_sum_sq += (pair_total_cost / 2) ** 2
     
-    CP_rate = CP_guess / 100.0 # Because CP_guess is given in percentage, we need to convert it to decimal for calculation
+    # return the moments accumulated in this chunk (the loop engine keeps only one path in memory, so no block is reported)
+    return {'sum': pair_sum, 'sum_sq': pair_sum_sq, 'count': num_pairs, 'peak_block_bytes': 0}
+
 
+# Drift used to simulate the stock and rate used to discount the payoff
+def get_rates(params, product_type):
     if product_type == 'HKD':
         # Refer to: We can set $r_g = r_f$... $r_{disc} = r_f$
         r_g = params['r_f'] 
@@ -177,48 +614,523 @@ def calculate_fair_value(CP_guess, params, product_type='HKD'):
         r_disc = params['r_d']
     else:
         raise ValueError("product_type in this senario must be 'HKD' or 'Quanto'")
+    return r_g, r_disc
 
-    # Excute the parallel simulations
-    num_cores = multiprocessing.cpu_count() # Get the number of available CPU cores
-    # Ensure at least one pair per core
-    pairs_per_core = max(1, num_pairs // num_cores) 
+
+# Moments of a run that label it instead of being added up
+RUN_LABELS = ('greek_names', 'importance_shift', 'importance_pilot_reduction')
+
+
+# Add up the moments returned by the workers (peak memory is a maximum, not a sum, and the RUN_LABELS are copied)
+def combine_chunk_results(results):
+    combined = {}
+    for result in results:
+        for key, value in result.items():
+            if key == 'peak_block_bytes':
+                combined[key] = max(combined.get(key, 0), value)
+            elif key in RUN_LABELS:
+                combined[key] = value
+            else:
+                combined[key] = combined.get(key, 0) + value
+    return combined
+
+
+# Check the engine settings and cut the run into one task per worker.
+# The pairs are cut into blocks of block_pairs, and each worker takes a contiguous range of whole blocks.
+# Every block keeps its global index, so its random stream is the same whatever the number of workers is.
+# With sampler='sobol' the run is cut into qmc_replicates tasks instead, one per scrambled Sobol sequence.
+# first_pair starts the run after the first pairs of the stream (a multiple of block_pairs, or of qmc_replicates for Sobol),
+# which lets an adaptive run add batches that continue exactly where the previous batch stopped.
+# task_params is what the tasks carry as params: the full dict, or None for PricingPool workers that hold the static params.
+def build_pricing_tasks(CP_guess, params, product_type, backend, block_pairs, seed, return_affine, num_workers,
+                        task_params, param_overrides=None, shared_normals=None, scheme='euler', substeps=DEFAULT_SUBSTEPS,
+                        sampler='random', qmc_replicates=DEFAULT_QMC_REPLICATES, control_variates=None, first_pair=0, greeks=False,
+                        importance_shift=None, importance_pilot_reduction=None, dtype='float64'):
+    # load the nomber of paths
+    num_paths = params['num_paths']
     
-    # (num_pairs, CP_rate, r_g, r_disc, params)
-    args_list = []
+    # Becaues we ues antithetic variates, each "pair" consists of 2 paths
+    num_pairs = num_paths // 2 
     
-    # Allocate pairs to each core
-    remaining_pairs = num_pairs
-    for i in range(num_cores):
-        # Ensure the last core takes any remaining pairs
-        pairs_to_run = min(pairs_per_core, remaining_pairs)
-        if i == num_cores - 1: # The last core to take all remaining pairs
-            pairs_to_run = remaining_pairs
-            
-        if pairs_to_run > 0:
-            args_list.append((pairs_to_run, CP_rate, r_g, r_disc, params)) # Add the argument tuple for this core, except the last core
-            remaining_pairs -= pairs_to_run
-        
-        if remaining_pairs <= 0:
-            break
-            
+    CP_rate = CP_guess / 100.0 # Because CP_guess is given in percentage, we need to convert it to decimal for calculation
+
+    r_g, r_disc = get_rates(params, product_type)
+
+    if backend not in BACKENDS:
+        raise ValueError(f"backend must be one of {BACKENDS}")
+    if backend == 'numba' and not NUMBA_AVAILABLE:
+        # numba is optional, the numpy engine gives the same prices
+        print("numba is not installed, the numpy backend is used instead")
+        backend = 'numpy'
+    if backend == 'numba' and scheme == 'bridge':
+        raise ValueError("The numba backend runs the daily 'euler' and 'exact' schemes, use the numpy backend for 'bridge'")
+    if return_affine and backend == 'loop':
+        raise ValueError("return_affine needs the numpy backend, the loop engine does not split the payoff into A and B")
+    if block_pairs < 1:
+        raise ValueError("block_pairs must be a positive number of antithetic pairs")
+    num_steps = scheme_num_steps(params, scheme, substeps)
+    if scheme != 'euler' and backend == 'loop':
+        raise ValueError("The loop engine only runs the Euler scheme")
+    if sampler not in SAMPLERS:
+        raise ValueError(f"sampler must be one of {SAMPLERS}")
+    if sampler == 'sobol':
+        if shared_normals is not None:
+            raise ValueError("The Sobol sampler generates its own points, it cannot read a SharedNormals buffer")
+        if qmc_replicates < 2 or num_pairs < qmc_replicates:
+            raise ValueError("The Sobol sampler needs at least 2 replicates and one pair per replicate")
+    control_means = None
+    if control_variates:
+        # control_variates=True uses all the controls
+        control_variates = CONTROL_VARIATES if control_variates is True else tuple(control_variates)
+        if any(control not in CONTROL_VARIATES for control in control_variates):
+            raise ValueError(f"control_variates must be taken from {CONTROL_VARIATES}")
+        if backend == 'loop':
+            raise ValueError("control_variates need the numpy or numba backend")
+        control_means = control_variate_means(r_g, r_disc, params, control_variates)
+    if greeks and (backend == 'loop' or scheme == 'bridge'):
+        raise ValueError("greeks need the numpy or numba backend and the daily 'euler' or 'exact' scheme")
+    if importance_shift is not None:
+        if backend != 'numpy' or scheme == 'bridge' or sampler != 'random':
+            raise ValueError("importance_shift needs the numpy backend, the daily 'euler' or 'exact' scheme and the 'random' sampler")
+        if control_variates or greeks:
+            raise ValueError("importance_shift cannot be combined with control_variates or greeks")
+    if dtype not in DTYPES:
+        raise ValueError(f"dtype must be one of {DTYPES}")
+    if dtype != 'float64':
+        if backend != 'numpy' or scheme == 'bridge' or sampler != 'random':
+            raise ValueError(f"dtype='{dtype}' needs the numpy backend, the daily 'euler' or 'exact' scheme and the 'random' sampler")
+        if control_variates or greeks or importance_shift is not None:
+            raise ValueError(f"dtype='{dtype}' cannot be combined with control_variates, greeks or importance_shift")
+    if shared_normals is not None:
+        # The normals come from the shared buffer, so its seed and block layout are the ones of this run
+        if first_pair + num_pairs > shared_normals.shape[0]:
+            raise ValueError("The SharedNormals buffer is too small for num_paths")
+        if shared_normals.shape[1] != num_steps:
+            raise ValueError(f"The SharedNormals buffer has {shared_normals.shape[1]} steps per path, the '{scheme}' scheme needs {num_steps}")
+        seed = shared_normals.seed
+        block_pairs = shared_normals.block_pairs
+    if seed is None:
+        # A fresh seed for this call. Each block still gets its own stream, so forked workers never repeat each other's normals.
+        seed = np.random.SeedSequence().entropy
+    if importance_shift == 'auto':
+        importance_shift, importance_pilot_reduction = choose_importance_shift(CP_rate, r_g, r_disc, params, seed, scheme, num_steps)
+    if importance_shift is not None and importance_shift != 0.0:
+        # The likelihood ratio is the control, with mean 1
+        control_means = np.ones(1)
+    else:
+        importance_shift = None
+
+    num_blocks = -(-num_pairs // block_pairs) # ceil division
+    blocks_per_worker = -(-num_blocks // num_workers)
+    block_offset = first_pair // block_pairs
+
+    # (pairs_to_run, first_block, replicate) of every task
+    if sampler == 'sobol':
+        # Every replicate gets the same number of points, so the replicate means are identically distributed
+        task_layout = [(num_pairs // qmc_replicates, 0, replicate) for replicate in range(qmc_replicates)]
+    else:
+        task_layout = [(min(blocks_per_worker * block_pairs, num_pairs - first_block * block_pairs), block_offset + first_block, None)
+                       for first_block in range(0, num_blocks, blocks_per_worker)]
+
+    # (num_pairs, CP_rate, r_g, r_disc, params, engine_options)
+    args_list = []
+    for pairs_to_run, first_block, replicate in task_layout:
+        engine_options = {'backend': backend, 'block_pairs': block_pairs, 'seed': seed, 'first_block': first_block,
+                          'scheme': scheme, 'substeps': substeps, 'sampler': sampler}
+        if replicate is not None:
+            engine_options['replicate'] = replicate
+            engine_options['first_pair'] = first_pair // qmc_replicates
+        if control_means is not None:
+            engine_options['control_variates'] = control_variates
+        if greeks:
+            engine_options['greeks'] = product_type
+        if importance_shift is not None:
+            engine_options['importance_shift'] = importance_shift
+            engine_options['importance_pilot_reduction'] = importance_pilot_reduction
+        if dtype != 'float64':
+            engine_options['dtype'] = dtype
+        if telemetry_enabled():
+            engine_options['telemetry'] = True
+        if profiling_active():
+            engine_options['profile'] = True
+        if param_overrides:
+            engine_options['param_overrides'] = param_overrides
+        if shared_normals is not None:
+            engine_options['shared_normals'] = shared_normals.handle
+        args_list.append((pairs_to_run, CP_rate, r_g, r_disc, task_params, engine_options))
+
+    return args_list, seed, block_pairs, control_means
+
+
+# The result of a pricing run.
+# It is a float (the fair value), so it can be used wherever the plain fair value was used (brentq objectives, arithmetic,
+# f"{fv:,.2f}"), and it also carries the error of the estimate:
+#
+#     fv = calculate_fair_value(3.45, hkd_params_prod)
+#     fv.mean, fv.stderr, fv.ci, fv.num_paths, fv.wall_time
+#     print(fv.summary())
+# With greeks=True it also carries fv.greeks and fv.greek_stderr ({name: value}, see greeks.py).
+class PricingResult(float):
+
+    def __new__(cls, mean, stderr, num_paths, wall_time, stats=None, confidence=0.95):
+        result = super().__new__(cls, mean)
+        result.mean = float(mean)
+        result.stderr = float(stderr) # standard error of the mean (antithetic pairs, or QMC replicates)
+        result.num_paths = int(num_paths)
+        result.wall_time = float(wall_time) # seconds
+        result.stats = stats # the moments of the run, see finish_pricing
+        result.confidence = confidence
+        return result
+
+    # Keep the extra fields when the result is pickled (e.g. sent to another process)
+    def __reduce__(self):
+        return (PricingResult, (self.mean, self.stderr, self.num_paths, self.wall_time, self.stats, self.confidence))
+
+    # Normal-approximation confidence interval of the fair value, (low, high)
+    @property
+    def ci(self):
+        z = NormalDist().inv_cdf(0.5 + self.confidence / 2.0)
+        return (self.mean - z * self.stderr, self.mean + z * self.stderr)
+
+    # Standard error as a percentage of the fair value
+    @property
+    def stderr_pct(self):
+        return 100.0 * self.stderr / abs(self.mean) if self.mean else float('inf')
+
+    # The Greeks of a greeks=True run ({name: value}) and their standard errors, None otherwise
+    @property
+    def greeks(self):
+        return (self.stats or {}).get('greeks')
+
+    @property
+    def greek_stderr(self):
+        return (self.stats or {}).get('greek_stderr')
+
+    def summary(self):
+        low, high = self.ci
+        return (f"{self.mean:,.2f} +/- {self.stderr:,.2f} (stderr {self.stderr_pct:.4f}%), "
+                f"{self.confidence:.0%} CI [{low:,.2f}, {high:,.2f}], {self.num_paths:,} paths, {self.wall_time:.2f} s")
+
+
+# Combine the worker results into the fair value (or the affine pair (A, B)), optionally with the stats of the run
+# With control_means (the closed-form means of the controls) the fair value, A and B are the control-variate estimates.
+# The fair value is returned as a PricingResult; start_time is when the run started (for its wall time).
+def finish_pricing(results, block_pairs, seed, return_stats, return_affine, sampler='random', control_means=None, start_time=None):
+    # Combine the running moments of all workers
+    stats = combine_chunk_results(results)
+    stats['block_pairs'] = block_pairs
+    stats['seed'] = seed
+    stats['sampler'] = sampler
+    stats['wall_time'] = time.time() - start_time if start_time is not None else 0.0
+
+    # Standard error of the fair value (at CP_guess)
+    if sampler == 'sobol':
+        # The pairs of one Sobol sequence are not independent; the replicate means are, so the error comes from their spread
+        replicate_means = np.array([result['sum'] / result['count'] for result in results])
+        stats['stderr'] = np.std(replicate_means, ddof=1) / np.sqrt(len(replicate_means))
+    else:
+        pair_variance = max(stats['sum_sq'] / stats['count'] - (stats['sum'] / stats['count']) ** 2, 0.0)
+        stats['stderr'] = np.sqrt(pair_variance / stats['count'])
+
+    # Greeks (greeks=True): mean and standard error of the pair Greeks, from the replicate means for Sobol
+    if 'greek_sum' in stats:
+        greek_means = stats['greek_sum'] / stats['count']
+        if sampler == 'sobol':
+            replicate_greeks = np.array([result['greek_sum'] / result['count'] for result in results])
+            greek_stderr = np.std(replicate_greeks, axis=0, ddof=1) / np.sqrt(len(replicate_greeks))
+        else:
+            greek_stderr = np.sqrt(np.maximum(stats['greek_sum_sq'] / stats['count'] - greek_means ** 2, 0.0) / stats['count'])
+        stats['greeks'] = dict(zip(stats['greek_names'], greek_means))
+        stats['greek_stderr'] = dict(zip(stats['greek_names'], greek_stderr))
+
+    # Average cost across all simulated paths (= average over all antithetic pairs)
+    average_cost = stats['sum'] / stats['count']
+    # PV = A + CP_rate * B: A is the discounted principal / redemption, B the discounted coupon and accrued-coupon annuity
+    # (the loop engine does not split the payoff, it returns no a_sum / b_sum; return_affine and control variates reject it)
+    affine = (stats['a_sum'] / stats['count'], stats['b_sum'] / stats['count']) if 'a_sum' in stats else None
+
+    if 'importance_shift' in stats:
+        # Importance sampling always regresses out its likelihood ratio (mean 1): the weighted estimate on its own is much noisier
+        # than plain antithetic pairs, so it is never returned (stats['stderr_without_cv'] keeps its error for comparison)
+        control_means = np.ones(1)
+    if control_means is not None:
+        # Regression control variates: Y_cv = mean(Y) - beta^T (mean(C) - mu), beta = Cov(C, C)^-1 Cov(C, Y)
+        count = stats['count']
+        c_mean = stats['c_sum'] / count
+        c_cov = stats['cc_sum'] / count - np.outer(c_mean, c_mean)
+        beta = np.linalg.solve(c_cov, stats['cy_sum'] / count - c_mean * average_cost)
+        beta_a = np.linalg.solve(c_cov, stats['ca_sum'] / count - c_mean * affine[0])
+        beta_b = np.linalg.solve(c_cov, stats['cb_sum'] / count - c_mean * affine[1])
+
+        stats['stderr_without_cv'] = stats['stderr']
+        stats['cv_beta'] = beta
+        if sampler == 'sobol':
+            # Adjust every replicate mean with the pooled beta, the spread of the adjusted means is the error
+            adjusted_means = np.array([result['sum'] / result['count'] - beta @ (result['c_sum'] / result['count'] - control_means)
+                                       for result in results])
+            stats['stderr'] = np.std(adjusted_means, ddof=1) / np.sqrt(len(adjusted_means))
+        else:
+            # Residual variance of the pair PVs after the regression
+            pair_variance = max(stats['sum_sq'] / count - average_cost ** 2 - beta @ (stats['cy_sum'] / count - c_mean * average_cost), 0.0)
+            stats['stderr'] = np.sqrt(pair_variance / count)
+
+        average_cost -= beta @ (c_mean - control_means)
+        affine = (affine[0] - beta_a @ (c_mean - control_means), affine[1] - beta_b @ (c_mean - control_means))
+
+    if return_affine:
+        return (affine, stats) if return_stats else affine
+
+    # Each antithetic pair is two paths
+    result = PricingResult(average_cost, stats['stderr'], 2 * stats['count'], stats['wall_time'], stats)
+    if return_stats:
+        return result, stats
+    return result
+
+
+# Calculate fair value through Monte Carlo simulation with Antithetic Variates and Multiprocessing
+def calculate_fair_value(CP_guess, params, product_type='HKD', backend='numpy', block_pairs=DEFAULT_BLOCK_PAIRS, return_stats=False, seed=None,
+                         return_affine=False, pool=None, shared_normals=None, scheme='euler', substeps=DEFAULT_SUBSTEPS,
+                         sampler='random', qmc_replicates=DEFAULT_QMC_REPLICATES, control_variates=None, target_stderr=None,
+                         max_paths=None, greeks=False, importance_shift=None, dtype='float64'):
+    # product_type can be 'HKD' or 'Quanto'
+    # backend can be 'numpy' (batched engine), 'numba' (compiled per-path kernel, numpy if numba is missing) or 'loop' (original path-by-path engine)
+    # scheme can be 'euler', 'exact' or 'bridge' (numpy backend only); substeps is the number of bridge nodes per coupon period
+    # sampler can be 'random' (pseudo-random normals) or 'sobol' (randomized QMC with qmc_replicates scrambled Sobol sequences)
+    # control_variates is a tuple of control names from CONTROL_VARIATES (or True for all of them); the fair value is then the
+    # regression-adjusted estimate, and stats['stderr'] its standard error (numpy / numba backends)
+    # target_stderr switches to an error-targeted run: path batches are added until the standard error is at most target_stderr (HKD)
+    # or max_paths (default: params['num_paths']) is reached; the PricingResult reports the paths actually used
+    # greeks=True computes delta, gamma, vega and rho (and rho_d for Quanto) on the same paths, with standard errors (see greeks.py)
+    # importance_shift draws the daily normals from N(theta, 1) and weights each path by its likelihood ratio (see importance_sampling.py):
+    # a float theta, or 'auto' to choose theta by a pilot run; stats['importance_shift'] is the shift used
+    # (absent when 'auto' found no shift that beats plain antithetic pairs, the run is then plain antithetic)
+    # dtype='float32' generates the normals and evolves the paths in float32 (numpy backend, 'euler' / 'exact' schemes);
+    # the payoff discounting and the accumulated moments stay in float64. With shared_normals the float64 normals are rounded.
+    # block_pairs is the number of antithetic pairs the numpy engine keeps in memory at once
+    # The fair value is returned as a PricingResult: a float with .mean, .stderr, .ci, .num_paths and .wall_time
+    # return_stats=True returns (fair_value, stats), where stats holds the pair moments, the standard error and the peak memory per block
+    # seed fixes the normals of the run (Common Random Numbers): the same seed gives the same paths for every CP and any core count
+    # return_affine=True returns the pair (A, B) with Fair_Value(CP) = A + CP% / 100 * B on these paths, instead of the fair value
+    # pool is an optional PricingPool; its workers are reused instead of starting a new multiprocessing.Pool for this call
+    # shared_normals is an optional SharedNormals buffer; the workers read their normals from it instead of generating them
+    # CP_guess is a persentage, which is a guess of the coupon rate, beacause we guess and validate the coupon, and finally find the right coupon
+
+    if pool is not None:
+        return pool.price(CP_guess, params=params, product_type=product_type, backend=backend, block_pairs=block_pairs,
+                          return_stats=return_stats, seed=seed, return_affine=return_affine, shared_normals=shared_normals,
+                          scheme=scheme, substeps=substeps, sampler=sampler, qmc_replicates=qmc_replicates,
+                          control_variates=control_variates, target_stderr=target_stderr, max_paths=max_paths, greeks=greeks,
+                          importance_shift=importance_shift, dtype=dtype)
+
+    if target_stderr is not None:
+        # The batches of an error-targeted run reuse one pool of workers
+        with PricingPool(params, product_type, backend=backend, block_pairs=block_pairs) as adaptive_pool:
+            return adaptive_pool.price(CP_guess, return_stats=return_stats, seed=seed, return_affine=return_affine,
+                                       shared_normals=shared_normals, scheme=scheme, substeps=substeps, sampler=sampler,
+                                       qmc_replicates=qmc_replicates, control_variates=control_variates,
+                                       target_stderr=target_stderr, max_paths=max_paths, greeks=greeks,
+                                       importance_shift=importance_shift, dtype=dtype)
+
+    # Excute the parallel simulations
+    start_time = time.time()
+    num_cores = multiprocessing.cpu_count() # Get the number of available CPU cores
+    args_list, seed, block_pairs, control_means = build_pricing_tasks(CP_guess, params, product_type, backend, block_pairs, seed,
+                                                                      return_affine, num_cores, task_params=params,
+                                                                      shared_normals=shared_normals, scheme=scheme, substeps=substeps,
+                                                                      sampler=sampler, qmc_replicates=qmc_replicates,
+                                                                      control_variates=control_variates, greeks=greeks,
+                                                                      importance_shift=importance_shift, dtype=dtype)
+    if args_list[0][5]['backend'] == 'numba':
+        warm_up_numba_backend(params)
 
-    total_payoff_accumulator = 0.0
-    
     try:
+        startup_start = time.perf_counter()
         with multiprocessing.Pool(processes=num_cores) as pool:
-            results = pool.map(run_simulation_chunk, args_list) # Run simulations in parallel across multiple CPU cores
-        
-        # grand total discounted cost of all 300,000 paths
-        total_payoff_accumulator = sum(results)
+            startup_time = time.perf_counter() - startup_start
+            # Run simulations in parallel across multiple CPU cores (with the telemetry records of the call when it is on)
+            results = instrumented_map(pool.map, run_simulation_chunk, args_list, startup_time)
 
     except Exception as e:
+        # Re-raise: a fair value of 0 (or the wrong shape for return_affine / return_stats) would look like a price to the solvers
         print(f"There are some error in parallel simulations: {e}")
-        return 0.0
+        raise
 
-    # Average cost across all simulated paths
-    average_cost = total_payoff_accumulator / (num_pairs * 2) 
-    
-    return average_cost
+    return finish_pricing(results, block_pairs, seed, return_stats, return_affine, sampler, control_means, start_time)
+
+
+# A long-lived pool of pricing workers, reused across pricing calls.
+# calculate_fair_value starts and stops a multiprocessing.Pool on every call, and a brentq solve calls it 10-20 times.
+# PricingPool starts the workers once and sends them the static product parameters once (pool initializer);
+# each price request only carries the coupon, the rates, the engine options and the parameters that differ from the static ones.
+#
+#     with PricingPool(hkd_params_prod, 'HKD') as pricing_pool:
+#         fv = pricing_pool.price(3.45, seed=42)
+#         fv_new_ki = pricing_pool.price(3.35, overrides={'KI': 0.80}, seed=42)
+class PricingPool:
+
+    def __init__(self, params, product_type='HKD', num_cores=None, backend='numpy', block_pairs=DEFAULT_BLOCK_PAIRS):
+        self.params = dict(params)
+        self.product_type = product_type
+        self.num_cores = num_cores or multiprocessing.cpu_count()
+        self.backend = backend
+        self.block_pairs = block_pairs
+        if backend == 'numba' and NUMBA_AVAILABLE:
+            warm_up_numba_backend(self.params)
+        if os.name == 'posix':
+            # Start the resource tracker before the workers are forked, so they share it with this process. A SharedNormals
+            # buffer created later is then tracked once; otherwise every worker that attaches to it starts its own tracker,
+            # which reports the buffer as leaked (and unlinks it a second time) when the worker exits.
+            resource_tracker.ensure_running()
+        start_time = time.perf_counter()
+        self._pool = multiprocessing.Pool(processes=self.num_cores, initializer=init_pricing_worker, initargs=(self.params,))
+        self.startup_time = time.perf_counter() - start_time
+        record('pool_start', cores=self.num_cores, startup_time=self.startup_time)
+
+    # Price the product with the static parameters updated by overrides (e.g. {'KI': 0.80}).
+    # params can be given instead of overrides: the keys that differ from the static parameters are sent as overrides.
+    # The other arguments are the same as in calculate_fair_value; backend and block_pairs default to the pool settings.
+    def price(self, CP_guess, overrides=None, params=None, product_type=None, backend=None, block_pairs=None,
+              return_stats=False, seed=None, return_affine=False, shared_normals=None, scheme='euler', substeps=DEFAULT_SUBSTEPS,
+              sampler='random', qmc_replicates=DEFAULT_QMC_REPLICATES, control_variates=None, target_stderr=None, max_paths=None,
+              greeks=False, importance_shift=None, dtype='float64'):
+        if self._pool is None:
+            raise RuntimeError("This PricingPool is closed")
+        start_time = time.time()
+
+        overrides = dict(overrides or {})
+        if params is not None:
+            for key, value in params.items():
+                if key not in self.params or not np.array_equal(value, self.params[key]):
+                    overrides[key] = value
+        run_params = dict(self.params, **overrides)
+        product_type = product_type or self.product_type
+        backend = backend or self.backend
+        block_pairs = block_pairs or self.block_pairs
+
+        if target_stderr is not None:
+            return self._price_to_target(CP_guess, run_params, overrides, product_type, backend, block_pairs, return_stats, seed,
+                                         return_affine, shared_normals, scheme, substeps, sampler, qmc_replicates, control_variates,
+                                         target_stderr, max_paths, start_time, greeks, importance_shift, dtype)
+
+        args_list, seed, block_pairs, control_means = build_pricing_tasks(CP_guess, run_params, product_type, backend, block_pairs, seed,
+                                                                          return_affine, self.num_cores, task_params=None,
+                                                                          param_overrides=overrides, shared_normals=shared_normals,
+                                                                          scheme=scheme, substeps=substeps, sampler=sampler,
+                                                                          qmc_replicates=qmc_replicates, control_variates=control_variates,
+                                                                          greeks=greeks, importance_shift=importance_shift, dtype=dtype)
+        results = instrumented_map(self._pool.map, run_simulation_chunk, args_list)
+        return finish_pricing(results, block_pairs, seed, return_stats, return_affine, sampler, control_means, start_time)
+
+    # Error-targeted run: add batches of paths until the standard error of the fair value is at most target_stderr,
+    # or max_paths (default: num_paths) is reached. The batches continue the same random stream (whole blocks, or whole rounds
+    # of the Sobol replicates), so with a seed the result equals a fixed run with the number of paths actually used.
+    def _price_to_target(self, CP_guess, run_params, overrides, product_type, backend, block_pairs, return_stats, seed,
+                         return_affine, shared_normals, scheme, substeps, sampler, qmc_replicates, control_variates,
+                         target_stderr, max_paths, start_time, greeks=False, importance_shift=None, dtype='float64'):
+        if target_stderr <= 0:
+            raise ValueError("target_stderr must be positive")
+        if shared_normals is not None:
+            block_pairs = shared_normals.block_pairs
+            seed = shared_normals.seed
+        # One seed and one pilot for all the batches: the shift is chosen once, every batch continues the same stream
+        if seed is None:
+            seed = np.random.SeedSequence().entropy
+        importance_pilot_reduction = None
+        if importance_shift == 'auto' and sampler == 'random' and backend == 'numpy':
+            r_g, r_disc = get_rates(run_params, product_type)
+            importance_shift, importance_pilot_reduction = choose_importance_shift(CP_guess / 100.0, r_g, r_disc, run_params, seed,
+                                                                                   scheme, scheme_num_steps(run_params, scheme, substeps))
+        max_pairs = (max_paths or run_params['num_paths']) // 2
+
+        # Batch sizes are multiples of batch_unit pairs; the first batch is one block per worker
+        batch_unit = qmc_replicates if sampler == 'sobol' else block_pairs
+        max_pairs = max_pairs // qmc_replicates * qmc_replicates if sampler == 'sobol' else max_pairs
+        batch_pairs = min(max_pairs, -(-self.num_cores * block_pairs // batch_unit) * batch_unit)
+
+        results = []
+        pairs_done = 0
+        batches = 0
+        while True:
+            batch_params = dict(run_params, num_paths=2 * batch_pairs)
+            args_list, seed, block_pairs, control_means = build_pricing_tasks(CP_guess, batch_params, product_type, backend, block_pairs,
+                                                                              seed, return_affine, self.num_cores, task_params=None,
+                                                                              param_overrides=overrides, shared_normals=shared_normals,
+                                                                              scheme=scheme, substeps=substeps, sampler=sampler,
+                                                                              qmc_replicates=qmc_replicates,
+                                                                              control_variates=control_variates, first_pair=pairs_done,
+                                                                              greeks=greeks, importance_shift=importance_shift,
+                                                                              importance_pilot_reduction=importance_pilot_reduction,
+                                                                              dtype=dtype)
+            batch_results = instrumented_map(self._pool.map, run_simulation_chunk, args_list)
+            if sampler == 'sobol' and results:
+                # Extend every replicate with its new points
+                results = [combine_chunk_results([old, new]) for old, new in zip(results, batch_results)]
+            else:
+                results += batch_results
+            pairs_done += batch_pairs
+            batches += 1
+
+            fair_value, stats = finish_pricing(results, block_pairs, seed, True, False, sampler, control_means, start_time)
+            if stats['stderr'] <= target_stderr or pairs_done >= max_pairs:
+                break
+
+            # Pairs needed for the target if the error falls like 1 / sqrt(paths), with 10% to spare
+            needed_pairs = int(pairs_done * (stats['stderr'] / target_stderr) ** 2 * 1.1)
+            batch_pairs = -(-max(needed_pairs - pairs_done, batch_unit) // batch_unit) * batch_unit
+            if sampler == 'sobol':
+                # The QMC error falls faster than 1 / sqrt(paths), so the estimate overshoots: at most double the points per batch
+                batch_pairs = min(batch_pairs, pairs_done)
+            batch_pairs = min(batch_pairs, max_pairs - pairs_done)
+
+        value, stats = finish_pricing(results, block_pairs, seed, True, return_affine, sampler, control_means, start_time)
+        stats['target_stderr'] = target_stderr
+        stats['target_reached'] = stats['stderr'] <= target_stderr
+        stats['batches'] = batches
+        return (value, stats) if return_stats else value
+
+    # Run the tasks of another engine on these workers (e.g. batch_solver.run_batch_chunk), the tasks carry their own parameters.
+    # A task can read a SharedNormals buffer with attach_shared_normals(handle); the results come back in task order.
+    def map(self, worker, tasks):
+        if self._pool is None:
+            raise RuntimeError("This PricingPool is closed")
+        return instrumented_map(self._pool.map, worker, tasks)
+
+    # Stop the workers and wait for them to exit
+    def close(self):
+        if self._pool is not None:
+            self._pool.close()
+            self._pool.join()
+            self._pool = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is not None and self._pool is not None:
+            # Something went wrong in the caller, do not wait for the queued tasks
+            self._pool.terminate()
+            self._pool.join()
+            self._pool = None
+        self.close()
+        return False
+
+
+# Solve the coupon directly from one simulation pass.
+# On a fixed path set the fair value is affine in the coupon rate, PV = A + CP_rate * B, so the CP that meets a target margin is
+# CP% = 100 * (target_fv - A) / B, no root finding needed.
+# target_margin can be a single margin (e.g. 0.012) or a list of margins, which are all solved from the same pass.
+def solve_cp_direct(params, product_type, target_margin, seed=None, pool=None, **engine_kwargs):
+    (A, B), stats = calculate_fair_value(0.0, params, product_type, return_stats=True, return_affine=True, seed=seed, pool=pool,
+                                         **engine_kwargs)
+    if B <= 0:
+        raise ValueError("The coupon annuity B is not positive, the coupon cannot be solved")
+
+    margins = np.atleast_1d(target_margin)
+    solved_cp = [100.0 * (params['NOM'] * (1.0 - margin) - A) / B for margin in margins]
+
+    if np.ndim(target_margin) == 0:
+        return solved_cp[0]
+    return solved_cp
 
 if __name__ == "__main__":
     
@@ -238,7 +1150,7 @@ if __name__ == "__main__":
     print(f"The programme is running {hkd_params_test['num_paths']} MC simulation with {multiprocessing.cpu_count()} cpu(s)...")
     
     start_time = time.time()
-    fair_value = calculate_fair_value(test_cp, hkd_params_test, product_type='HKD')
+    fair_value, stats = calculate_fair_value(test_cp, hkd_params_test, product_type='HKD', return_stats=True)
     end_time = time.time()
     
     fv_percent = (fair_value / hkd_params_test['NOM']) * 100.0
@@ -246,4 +1158,6 @@ if __name__ == "__main__":
     print(f"Total time cost: {end_time - start_time:.2f} seconds")
     print(f"Test Fair Value: {fair_value:,.2f} HKD")
     print(f"Test Fair Value persentage: {fv_percent:.4f} %")
+    print(f"Standard error: {fair_value.stderr:,.2f} HKD ({fair_value.stderr_pct:.4f}%), 95% CI: [{fair_value.ci[0]:,.2f}, {fair_value.ci[1]:,.2f}]")
+    print(f"Peak memory per block ({stats['block_pairs']} pairs): {stats['peak_block_bytes'] / 2**20:.1f} MB")
     print("-" * 50)
\ No newline at end of file
@@ -0,0 +1,71 @@
+# F:\Learning_journal_at_CUHK\FTEC5610_Computational_Finance\Assignment\Assigenment2-3\control_variates.py
+# Control variates for the autocall pricer: simple payoffs on the same normals whose expectations are known in closed form.
+#
+# A control C with known mean mu is regressed out of the path PV Y:
+#     Y_cv = mean(Y) - beta^T (mean(C) - mu),   beta = Cov(C, C)^-1 Cov(C, Y)
+# which is unbiased for any beta and has the smallest variance for the regression beta.
+#
+# The controls are built on the exact lognormal stock driven by the same Brownian path as the simulated stock,
+#     S~(t) = S0 * exp((r_g - sigma^2 / 2) t + sigma W(t)),   W(t) = sum of sqrt(h_i) Z_i up to t
+# so their means are exact for every scheme (the Euler stock is not lognormal, but S~ is, and it follows the Euler stock closely).
+# A daily-monitored down-and-in put has no closed-form price, so it would bias the estimate; the put below is on S~(T) only.
+#   'stock' - the discounted S~ on every coupon date (one control per date), mean S0 * exp((r_g - r_disc) t)
+#   'put'   - the discounted European put on S~(T) struck at K = K0 * S0, Black-Scholes price
+
+import numpy as np
+from scipy.special import ndtr # standard normal CDF
+
+CONTROL_VARIATES = ('stock', 'put')
+
+
+# Times on which the 'stock' control is observed: the coupon dates
+def _control_dates(params):
+    return np.sort(np.asarray(params['time_points'], dtype=float))
+
+
+# Control values of a block of antithetic pairs. Z has shape (num_pairs, N), step_times are the times t_1..t_N of its columns.
+# Returns a (num_pairs, num_controls) array, averaged over Z and -Z like the pair PVs.
+def control_variate_values(Z, step_times, r_g, r_disc, params, controls):
+    S0 = params['S0']
+    sigma = params['sigma_stock']
+    step_times = np.asarray(step_times, dtype=float)
+    step_sizes = np.diff(np.concatenate([[0.0], step_times]))
+
+    # W(t) on the coupon dates (W(T) is the last one) is a weighted sum of the normals: W_dates = Z @ weights
+    dates = _control_dates(params)
+    date_columns = np.array([np.argmin(np.abs(step_times - date)) for date in dates])
+    weights = np.sqrt(step_sizes)[:, None] * (np.arange(len(step_times))[:, None] <= date_columns[None, :])
+    W_dates = Z @ weights
+
+    pair_values = []
+    for sign in (1.0, -1.0): # antithetic pair
+        S_dates = S0 * np.exp((r_g - 0.5 * sigma ** 2) * dates + sigma * sign * W_dates)
+        columns = []
+        for control in controls:
+            if control == 'stock':
+                columns.append(S_dates * np.exp(-r_disc * dates))
+            elif control == 'put':
+                K = S0 * params['K0']
+                columns.append((np.exp(-r_disc * dates[-1]) * np.maximum(K - S_dates[:, -1], 0.0))[:, None])
+        pair_values.append(np.hstack(columns))
+    return 0.5 * (pair_values[0] + pair_values[1])
+
+
+# Closed-form means of the controls, in the column order of control_variate_values
+def control_variate_means(r_g, r_disc, params, controls):
+    S0 = params['S0']
+    sigma = params['sigma_stock']
+    dates = _control_dates(params)
+    T = dates[-1]
+
+    means = []
+    for control in controls:
+        if control == 'stock':
+            means.extend(S0 * np.exp((r_g - r_disc) * dates))
+        elif control == 'put':
+            # Black-Scholes put with growth rate r_g and discount rate r_disc
+            K = S0 * params['K0']
+            d1 = (np.log(S0 / K) + (r_g + 0.5 * sigma ** 2) * T) / (sigma * np.sqrt(T))
+            d2 = d1 - sigma * np.sqrt(T)
+            means.append(np.exp(-r_disc * T) * (K * ndtr(-d2) - S0 * np.exp(r_g * T) * ndtr(-d1)))
+    return np.array(means)
@@ -0,0 +1,314 @@
+# F:\Learning_journal_at_CUHK\FTEC5610_Computational_Finance\Assignment\Assigenment2-3\greeks.py
+# Greeks of the autocall from the pricing pass itself: pathwise derivatives of a smoothed payoff.
+#
+# The autocall payoff is not smooth in the path: the auto-call and the knock-in are indicators (S >= P_C, S < P_K), so the plain
+# pathwise derivative misses the value that jumps when a path crosses a barrier. The daily likelihood-ratio weight of the spot,
+# Z_1 / (S0 sigma sqrt(dt)), is unbiased but its variance grows like 1 / dt, i.e. 180 times that of a terminal weight.
+# So the indicators are replaced by logistic functions of width GREEK_SMOOTHING * barrier, and the derivative of the smoothed payoff
+# is taken path by path (the redemption NOM * min(S_T / K, 1) is continuous, its kink is handled exactly):
+#   c_n = logistic((S_n - P_C) / w_C)   probability of a call on day n (from the first auto-call date on)
+#   d_n = logistic((P_K - S_n) / w_K)   probability of a knock-in on day n
+#   PV  = sum_n s_{n-1} c_n V_n + s_N V_T,   s_n = prod_{m<=n} (1 - c_m) (survival),   k = prod_n (1 - d_n) (no knock-in)
+#   V_n = discounted NOM * (1 + CP * accrual_n),   V_T = discounted NOM * (1 - (1 - k) max(1 - S_T / K, 0)) + CP * alive annuity
+# dPV/dS_n is one backward cumulative sum over the days, and every Greek is sum_n dPV/dS_n * dS_n/dtheta
+# (plus the explicit discounting for the rates). The smoothing adds a small bias, checked against CRN finite differences
+# of the pair PVs on the same paths (validate_greeks).
+#
+#   delta  dPV/dS0 (HKD per 1 HKD of spot), with the barriers and the strike fixed in HKD (their level at the trade date)
+#   gamma  d2PV/dS0^2, the second derivative of the smoothed PV along the spot (the path scaled by S0), from the same pass
+#   vega   dPV/dsigma_stock (per 1.00 of volatility); for the Quanto product the drift r_f + rho sigma_S sigma_fx moves as well
+#   rho    dPV/dr_f (per 1.00 of rate); HKD: drift and discounting, Quanto: the drift only
+#   rho_d  Quanto only: dPV/dr_d, the CNY discounting
+#
+#     fv = calculate_fair_value(3.45, hkd_params_prod, 'HKD', seed=42, greeks=True)
+#     fv.greeks['delta'], fv.greek_stderr['delta']
+
+import numpy as np
+
+GREEK_NAMES = {'HKD': ('delta', 'gamma', 'vega', 'rho'), 'Quanto': ('delta', 'gamma', 'vega', 'rho', 'rho_d')}
+
+# Width of the logistic barrier indicators, as a fraction of the barrier. Smaller is less biased but noisier;
+# one day moves the stock by sigma * sqrt(dt), about 3% here. The call smoothing acts on every one of the ~150 callable days,
+# so its bias compounds: at 1% the vega and rho are off by 2-3%, at 0.3% they agree with the finite differences.
+# Going below 0.3% does not buy accuracy: on 100,000 paths the standard error of the delta gap to the finite differences doubles
+# at 0.15% (about 25 -> 49 HKD) and quadruples at 0.075%, while the CRN finite-difference delta itself moves by about 120 HKD
+# between a 1% and a 0.5% spot bump. validate_greeks estimates the smoothing bias on the same pairs and flags a gap it does not explain.
+GREEK_SMOOTHING = 0.003
+
+# The Greeks of a block are taken on sub-blocks of this many pairs: the gradient needs a few dozen (pairs, N) temporaries,
+# which stay in the CPU cache at this size (about 1.5x faster than on a whole DEFAULT_BLOCK_PAIRS block)
+GREEK_SUB_BLOCK_PAIRS = 256
+
+
+# The logistic function and log(1 - logistic) of x from one exponential: with e = exp(-|x|),
+# logistic(x) = 1 / (1 + e) or e / (1 + e), log(1 - logistic(x)) = -max(x, 0) - log(1 + e)
+def logistic_and_log_complement(x):
+    e = np.exp(-np.abs(x))
+    inverse = 1.0 / (1.0 + e)
+    return np.where(x >= 0.0, inverse, e * inverse), -np.maximum(x, 0.0) - np.log1p(e)
+
+
+# Sensitivities of the smoothed PV of every path.
+# S has shape (paths, N): the prices of days 1..N. schedule is build_step_schedule(params).
+# Returns (dPV/dS_n with shape (paths, N), the explicit dPV/dr_disc of every path, unsmoothed, d2PV/dlambda^2 of every path)
+# where lambda scales the whole path (S -> lambda S at lambda = 1, i.e. a move of the spot): the spot curvature of the gamma.
+# It is taken in the same pass from the derivatives of the logistic weights, so no bumped path has to be priced again.
+def smoothed_payoff_gradient(S, CP_rate, r_disc, params, schedule, smoothing=GREEK_SMOOTHING):
+    NOM = params['NOM']
+    S0 = params['S0']
+    dt, coupon_steps, first_autocall_step, all_period_boundaries = schedule
+    N = S.shape[1]
+    T = N * dt
+    P_K = S0 * params['KI'] # Knock-in Price
+    P_C = S0 * params['AC'] # Auto-Call Price
+    K = S0 * params['K0'] # Strike Price at Maturity
+
+    # Cash flow of a call on day n, and its derivative in the discount rate
+    steps = np.arange(1, N + 1)
+    times = steps * dt
+    period_index = np.searchsorted(all_period_boundaries, steps, side='left') - 1
+    accrual_fraction = (steps - all_period_boundaries[period_index]) / (all_period_boundaries[period_index + 1] - all_period_boundaries[period_index])
+    call_value = np.exp(-r_disc * times) * NOM * (1.0 + CP_rate * accrual_fraction)
+    callable_day = steps >= first_autocall_step
+
+    # Smoothed auto-call: log(1 - c) = -log(1 + e^x) is kept in log form, the survival is its cumulative sum
+    call_width = smoothing * P_C
+    c, log_not_called = logistic_and_log_complement((S - P_C) / call_width)
+    c *= callable_day
+    log_survival = np.cumsum(log_not_called * callable_day, axis=1)
+    survival_after = np.exp(log_survival)
+    survival_before = np.hstack([np.ones((S.shape[0], 1)), survival_after[:, :-1]])
+    survival_expiry = survival_after[:, -1]
+    call_weight = survival_before * c
+    # Along lambda: u_n = (lambda S_n - P_C) / w_C moves by u' = S_n / w_C, so c' = c (1 - c) u', c'' = c (1 - c) (1 - 2c) u'^2,
+    # log(1 - c)' = -c u', log(1 - c)'' = -c (1 - c) u'^2, and the survival s = exp(cumsum log(1 - c)) has s' = s L', s'' = s (L'^2 + L'')
+    call_speed = S / call_width
+    call_slope = c * (1.0 - c)
+    call_slope_1 = call_slope * call_speed # c'
+    log_survival_1 = np.cumsum(-c * call_speed, axis=1)
+    log_survival_2 = np.cumsum(-call_slope_1 * call_speed, axis=1)
+    survival_after_1 = survival_after * log_survival_1
+    survival_after_2 = survival_after * (log_survival_1 ** 2 + log_survival_2)
+
+    # Smoothed knock-in (KI = 0 never knocks in)
+    if P_K > 0:
+        knock_width = smoothing * P_K
+        d, log_no_knock = logistic_and_log_complement((P_K - S) / knock_width)
+        no_knock_in = np.exp(np.sum(log_no_knock, axis=1))
+        d_log_no_knock_in = d / knock_width # d log(1 - d_n) / dS_n
+        # Along lambda (y_n = (P_K - lambda S_n) / w_K): log k' = sum d_n S_n / w_K, log k'' = -sum d_n (1 - d_n) (S_n / w_K)^2
+        knock_speed = S / knock_width
+        log_no_knock_1 = np.einsum('ij,ij->i', d, knock_speed)
+        log_no_knock_2 = -np.einsum('ij,ij->i', d * (1.0 - d), knock_speed ** 2)
+    else:
+        no_knock_in = np.ones(S.shape[0])
+        d_log_no_knock_in = np.zeros_like(S)
+        log_no_knock_1 = log_no_knock_2 = np.zeros(S.shape[0])
+
+    # Expiry value of a path alive at T
+    S_T = S[:, -1]
+    redemption_loss = np.maximum(1.0 - S_T / K, 0.0)
+    discount_expiry = np.exp(-r_disc * T)
+    coupon_times = coupon_steps[coupon_steps < N] * dt
+    alive_annuity = NOM * discount_expiry + np.sum(NOM * np.exp(-r_disc * coupon_times))
+    d_alive_annuity = -NOM * T * discount_expiry - np.sum(NOM * coupon_times * np.exp(-r_disc * coupon_times))
+    principal = NOM * (1.0 - (1.0 - no_knock_in) * redemption_loss)
+    expiry_value = discount_expiry * principal + CP_rate * alive_annuity
+
+    # dPV/dS_n = d log(1 - c_n)/dS_n * (value paid after day n) + s_{n-1} dc_n/dS_n V_n + s_N dV_T/dS_n
+    weighted_calls = call_weight * call_value
+    value_after = np.cumsum(weighted_calls[:, ::-1], axis=1)[:, ::-1] - weighted_calls + (survival_expiry * expiry_value)[:, None]
+    gradient = (survival_before * call_slope * call_value - c * value_after) / call_width
+    gradient += (survival_expiry * discount_expiry * NOM * no_knock_in * redemption_loss)[:, None] * d_log_no_knock_in
+    gradient[:, -1] += survival_expiry * discount_expiry * NOM * (1.0 - no_knock_in) * np.where(S_T < K, 1.0 / K, 0.0)
+
+    # Second derivative along lambda, PV'' = sum_n V_n (s_{n-1} c_n)'' + (s_N V_T)''. The redemption kink max(1 - S_T / K, 0) has
+    # its exact slope in the gradient; its curvature is a point mass at S_T = K, spread here by a logistic of the same relative width
+    # (without it the gamma would miss the convexity of the put sold at K).
+    # sum_n V_n (s''_{n-1} c_n + 2 s'_{n-1} c'_n + s_{n-1} c''_n), with s_0 = 1 (so s'_0 = s''_0 = 0)
+    calls_2 = (np.einsum('ij,ij->i', survival_after_2[:, :-1], c[:, 1:] * call_value[1:])
+               + 2.0 * np.einsum('ij,ij->i', survival_after_1[:, :-1], call_slope_1[:, 1:] * call_value[1:])
+               + np.einsum('ij,ij->i', survival_before, call_slope_1 * (1.0 - 2.0 * c) * call_speed * call_value))
+    knock_1 = no_knock_in * log_no_knock_1
+    knock_2 = no_knock_in * (log_no_knock_1 ** 2 + log_no_knock_2)
+    redemption_1 = -np.where(S_T < K, S_T / K, 0.0)
+    strike_width = smoothing * K
+    in_the_money = logistic_and_log_complement((K - S_T) / strike_width)[0]
+    redemption_2 = S_T ** 2 / (K * strike_width) * in_the_money * (1.0 - in_the_money)
+    expiry_value_1 = discount_expiry * NOM * (knock_1 * redemption_loss - (1.0 - no_knock_in) * redemption_1)
+    expiry_value_2 = discount_expiry * NOM * (knock_2 * redemption_loss + 2.0 * knock_1 * redemption_1 - (1.0 - no_knock_in) * redemption_2)
+    spot_curvature = (calls_2 + survival_after_2[:, -1] * expiry_value
+                      + 2.0 * survival_after_1[:, -1] * expiry_value_1 + survival_expiry * expiry_value_2)
+
+    # The discount rate does not move the path, so dPV/dr_disc needs no smoothing: it is taken on the payoff of the engine
+    # (payoff_components_block), -t * cash flow of the call date or of the expiry
+    call_mask = (S >= P_C) & callable_day
+    terminated_early = call_mask.any(axis=1)
+    call_index = np.argmax(call_mask, axis=1)
+    knock_in_occurred = np.min(S, axis=1) < P_K
+    principal_expiry = NOM * (1.0 - knock_in_occurred * redemption_loss)
+    d_r_disc = np.where(terminated_early, -times[call_index] * call_value[call_index],
+                        -T * discount_expiry * principal_expiry + CP_rate * d_alive_annuity)
+    return gradient, d_r_disc, spot_curvature
+
+
+# The Greeks of a block of antithetic pairs. Z has shape (num_pairs, N) (daily 'euler' or 'exact' steps).
+# Returns a (num_pairs, len(GREEK_NAMES[product_type])) array, every column averaged over Z and -Z like the pair PVs.
+def greek_pairs_block(Z, CP_rate, r_g, r_disc, params, product_type, schedule, scheme='euler', smoothing=GREEK_SMOOTHING):
+    if Z.shape[0] > GREEK_SUB_BLOCK_PAIRS:
+        return np.vstack([greek_pairs_block(Z[row:row + GREEK_SUB_BLOCK_PAIRS], CP_rate, r_g, r_disc, params, product_type, schedule,
+                                            scheme, smoothing) for row in range(0, Z.shape[0], GREEK_SUB_BLOCK_PAIRS)])
+    S0 = params['S0']
+    sigma = params['sigma_stock']
+    dt = schedule[0]
+    times = dt * np.arange(1, Z.shape[1] + 1)
+
+    pair_greeks = 0.0
+    for z_block in (Z, -Z): # antithetic pair
+        # The paths (as in simulate_paths_block / simulate_paths_block_exact) and d log S_n / d sigma, d log S_n / d r_g
+        if scheme == 'exact':
+            S = S0 * np.exp(np.cumsum((r_g - 0.5 * sigma ** 2) * dt + sigma * np.sqrt(dt) * z_block, axis=1))
+            d_log_S_sigma = np.cumsum(-sigma * dt + np.sqrt(dt) * z_block, axis=1)
+            d_log_S_r = np.broadcast_to(times, S.shape)
+        else:
+            growth = 1.0 + r_g * dt + sigma * np.sqrt(dt) * z_block
+            S = S0 * np.cumprod(growth, axis=1)
+            inverse_growth = 1.0 / growth
+            d_log_S_sigma = np.cumsum(np.sqrt(dt) * z_block * inverse_growth, axis=1)
+            d_log_S_r = np.cumsum(dt * inverse_growth, axis=1)
+
+        gradient, d_r_disc, spot_curvature = smoothed_payoff_gradient(S, CP_rate, r_disc, params, schedule, smoothing)
+        # Every S_n is proportional to the spot: dS_n / dS0 = S_n / S0 (the barriers stay where they are),
+        # so a spot move scales the whole path and d2PV/dS0^2 is the curvature along that scaling over S0^2
+        spot_gradient = gradient * S # dPV/d log S_n
+        delta = np.sum(spot_gradient, axis=1) / S0
+        gamma = spot_curvature / S0 ** 2
+        d_sigma = np.einsum('ij,ij->i', spot_gradient, d_log_S_sigma)
+        d_r_g = np.einsum('ij,ij->i', spot_gradient, d_log_S_r)
+
+        if product_type == 'Quanto':
+            # r_g = r_f + rho sigma_S sigma_fx, r_disc = r_d
+            columns = [delta, gamma, d_sigma + params['rho'] * params['sigma_fx'] * d_r_g, d_r_g, d_r_disc]
+        else:
+            # r_g = r_disc = r_f
+            columns = [delta, gamma, d_sigma, d_r_g + d_r_disc]
+        pair_greeks = pair_greeks + 0.5 * np.column_stack(columns)
+    return pair_greeks
+
+
+# Bumps of the CRN finite differences: relative spot bump, absolute volatility and rate bumps
+FD_BUMPS = {'spot': 0.01, 'sigma': 0.01, 'rate': 0.001}
+
+
+# The same Greeks from CRN finite differences of the pair PVs: every bumped price is evaluated on the same block Z,
+# so the difference is taken pair by pair and its standard error includes the noise of the finite difference itself.
+# The spot bump keeps the barriers and the strike where they are in HKD (K0, KI and AC are rescaled to the bumped spot).
+# Returns a (num_pairs, len(GREEK_NAMES[product_type])) array in the column order of greek_pairs_block.
+def finite_difference_pairs_block(Z, CP_rate, params, product_type, scheme='euler', bumps=FD_BUMPS):
+    from calculate_fair_value import get_rates, price_pairs_block # imported here: calculate_fair_value imports this module
+
+    def price(**changes):
+        bumped = dict(params, **changes)
+        r_g, r_disc = get_rates(bumped, product_type)
+        return price_pairs_block(Z, CP_rate, r_g, r_disc, bumped, scheme)
+
+    S0 = params['S0']
+    h = bumps['spot'] * S0
+    def spot_changes(spot):
+        return {'S0': spot, 'K0': params['K0'] * S0 / spot, 'KI': params['KI'] * S0 / spot, 'AC': params['AC'] * S0 / spot}
+    base = price()
+    up, down = price(**spot_changes(S0 + h)), price(**spot_changes(S0 - h))
+    sigma_bump, rate_bump = bumps['sigma'], bumps['rate']
+
+    columns = [(up - down) / (2.0 * h), (up - 2.0 * base + down) / h ** 2,
+               (price(sigma_stock=params['sigma_stock'] + sigma_bump) - price(sigma_stock=params['sigma_stock'] - sigma_bump)) / (2.0 * sigma_bump),
+               (price(r_f=params['r_f'] + rate_bump) - price(r_f=params['r_f'] - rate_bump)) / (2.0 * rate_bump)]
+    if product_type == 'Quanto':
+        columns.append((price(r_d=params['r_d'] + rate_bump) - price(r_d=params['r_d'] - rate_bump)) / (2.0 * rate_bump))
+    return np.column_stack(columns)
+
+
+# A Greek passes when the gap to the finite difference is within this many of its standard errors,
+# plus this fraction of the finite difference for its own O(bump^2) truncation error (rho_d has no noise at all: about 2e-8)
+NOISE_Z_LIMIT = 3.0
+FD_TRUNCATION_TOLERANCE = 1e-6
+
+
+# Pathwise Greeks against CRN finite differences on the same antithetic pairs (in this process, block by block).
+# The pathwise Greeks are also taken with half the smoothing on the same pairs: if the bias is linear in the width,
+# 2 * (G(smoothing) - G(smoothing / 2)) estimates the smoothing bias G(smoothing) - G(0), with its pairwise standard error.
+# The status of a Greek is 'ok' when the gap is within NOISE_Z_LIMIT standard errors, 'smoothing' when the estimated smoothing bias
+# accounts for the rest of it, and 'MISMATCH' otherwise (neither the noise nor the smoothing explains the gap).
+# Returns {name: (pathwise, its stderr, finite difference, its stderr, stderr of the pairwise gap,
+#                 smoothing bias, its stderr, status)}.
+def validate_greeks(CP_guess, params, product_type, num_pairs, seed=None, scheme='euler', bumps=FD_BUMPS, smoothing=GREEK_SMOOTHING):
+    from calculate_fair_value import build_step_schedule, get_rates, iter_normal_blocks
+
+    CP_rate = CP_guess / 100.0
+    r_g, r_disc = get_rates(params, product_type)
+    schedule = build_step_schedule(params)
+    sums = np.zeros((4, len(GREEK_NAMES[product_type])))
+    sums_sq = np.zeros_like(sums)
+    count = 0
+    for Z in iter_normal_blocks(num_pairs, seed=seed):
+        pathwise = greek_pairs_block(Z, CP_rate, r_g, r_disc, params, product_type, schedule, scheme, smoothing)
+        fd = finite_difference_pairs_block(Z, CP_rate, params, product_type, scheme, bumps)
+        half_smoothed = greek_pairs_block(Z, CP_rate, r_g, r_disc, params, product_type, schedule, scheme, 0.5 * smoothing)
+        for row, values in enumerate((pathwise, fd, fd - pathwise, 2.0 * (pathwise - half_smoothed))):
+            sums[row] += values.sum(axis=0)
+            sums_sq[row] += (values ** 2).sum(axis=0)
+        count += Z.shape[0]
+    means = sums / count
+    stderrs = np.sqrt(np.maximum(sums_sq / count - means ** 2, 0.0) / (count - 1))
+    validation = {}
+    for i, name in enumerate(GREEK_NAMES[product_type]):
+        gap, gap_stderr, bias = means[2, i], stderrs[2, i], means[3, i]
+        if abs(gap) <= NOISE_Z_LIMIT * gap_stderr + FD_TRUNCATION_TOLERANCE * abs(means[1, i]):
+            status = 'ok'
+        elif abs(gap + bias) <= NOISE_Z_LIMIT * np.hypot(gap_stderr, stderrs[3, i]):
+            status = 'smoothing'
+        else:
+            status = 'MISMATCH'
+        validation[name] = (means[0, i], stderrs[0, i], means[1, i], stderrs[1, i], gap_stderr, bias, stderrs[3, i], status)
+    return validation
+
+
+if __name__ == "__main__":
+
+    import multiprocessing
+    import time
+    from calculate_fair_value import calculate_fair_value, PricingPool
+    multiprocessing.freeze_support()
+
+    hkd_params_prod = {
+        'NOM': 100000.0, 'r_f': 0.0287, 'sigma_stock': 0.6039, 'S0': 11.08,
+        'time_points': np.array([1/12, 2/12, 3/12, 4/12, 5/12, 0.5]),
+        'num_paths': 300000,
+        'K0': 0.96, 'KI': 0.92, 'AC': 0.99
+    }
+    quanto_params_prod = dict(hkd_params_prod, r_d=0.0169, sigma_fx=0.074, rho=0.42)
+    seed = 20251017
+
+    # Pathwise Greeks with the price (one pass on the pool)
+    for product_type, params, cp in (('HKD', hkd_params_prod, 3.458654), ('Quanto', quanto_params_prod, 3.26)):
+        with PricingPool(params, product_type) as pool:
+            start_time = time.time()
+            fv = calculate_fair_value(cp, params, product_type, seed=seed, pool=pool)
+            price_time = time.time() - start_time
+            start_time = time.time()
+            fv = calculate_fair_value(cp, params, product_type, seed=seed, pool=pool, greeks=True)
+            greeks_time = time.time() - start_time
+        print(f"--- {product_type} at CP = {cp}%: FV {fv.summary()} ---")
+        print(f"Price alone: {price_time:.2f} s, price with Greeks: {greeks_time:.2f} s")
+        for name in GREEK_NAMES[product_type]:
+            print(f"  {name:<6}{fv.greeks[name]:>16,.3f} +/- {fv.greek_stderr[name]:,.3f}")
+
+        # Validation: CRN finite differences on the same pairs; the gap is measured in its own (pairwise) standard error
+        start_time = time.time()
+        validation = validate_greeks(cp, params, product_type, num_pairs=50000, seed=seed)
+        print(f"CRN finite differences on 100,000 paths ({time.time() - start_time:.2f} s):")
+        print(f"{'Greek':<8}{'pathwise':>14}{'stderr':>10}{'CRN FD':>14}{'stderr':>10}{'gap':>12}{'stderr':>10}"
+              f"{'smoothing bias':>16}{'stderr':>10}  result")
+        for name, (value, stderr, fd_value, fd_stderr, gap_stderr, bias, bias_stderr, status) in validation.items():
+            print(f"{name:<8}{value:>14,.2f}{stderr:>10,.2f}{fd_value:>14,.2f}{fd_stderr:>10,.2f}{fd_value - value:>12,.2f}{gap_stderr:>10,.2f}"
+                  f"{bias:>16,.2f}{bias_stderr:>10,.2f}  {status}")
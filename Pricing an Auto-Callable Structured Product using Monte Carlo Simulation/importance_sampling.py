@@ -0,0 +1,122 @@
+# F:\Learning_journal_at_CUHK\FTEC5610_Computational_Finance\Assignment\Assigenment2-3\importance_sampling.py
+# Importance sampling for the autocall pricer: the normals are shifted towards the knock-in region and every path PV is
+# weighted by its Girsanov likelihood ratio.
+#
+# With KI = 92% and AC = 99% most paths are called within a few months and pay almost the same amount; the variance comes from
+# the minority that knocks in and is redeemed at NOM * S_T / K. Drawing every daily normal from N(theta, 1) instead of N(0, 1)
+# (theta < 0 pushes the stock down) makes those paths common, and the likelihood ratio of a path restores the expectation:
+#     Z'_n = theta + Z_n,   w = prod_n phi(Z'_n) / phi(Z'_n - theta) = exp(-theta * sum_n Z'_n + N theta^2 / 2),   E[PV] = E_theta[w PV]
+# The antithetic partner of a path uses Z''_n = theta - Z_n, which has the same N(theta, 1) law.
+# w has mean 1 whatever theta is, so it is also a control variate: the engine regresses it out (control_means = [1]), which removes
+# the part of the noise that comes from the weight multiplying the large, nearly constant PV of the called paths. This is what makes
+# the shift pay: at theta = -0.08 the weighted PV alone has a standard error of about 400 HKD on 100,000 paths (plain: about 29),
+# after the regression about 13. The regression is therefore not optional: finish_pricing applies it to every importance-sampled run,
+# and the weighted estimate on its own is only reported (stats['stderr_without_cv']), never returned.
+#
+# The shift is chosen by a pilot run: a few thousand pairs on their own CRN stream, priced for each candidate theta, and the
+# theta with the smallest variance of the weighted (and weight-regressed) pair PV is kept. The pilot also prices the plain antithetic
+# estimator on its normals, so it reports the variance reduction factor of the shift. When no shift beats the plain estimator
+# (reduction below 1) 'auto' falls back to theta = 0 and the run is plain antithetic.
+#
+#     fv = calculate_fair_value(3.45, hkd_params_prod, 'HKD', seed=42, importance_shift='auto')
+#     fv.stats['importance_shift'], fv.stats['importance_pilot_reduction'], fv.stats['stderr_without_cv']
+
+import numpy as np
+from scipy.optimize import minimize_scalar
+
+# Pairs of the pilot run, and the range of the daily shift it searches (theta = -0.2 moves the log stock by about -1.1 over 180 days)
+IS_PILOT_PAIRS = 4096
+IS_SHIFT_BOUNDS = (-0.2, 0.0)
+
+# Block index of the pilot's stream under the run's seed; the pricing blocks of a run never get this far
+IS_PILOT_BLOCK = 2 ** 31 - 1
+
+
+# Likelihood ratio of paths driven by shifted normals Z_shifted (each column drawn from N(theta, 1)) against N(0, 1)
+def likelihood_ratio(Z_shifted, theta):
+    return np.exp(-theta * np.sum(Z_shifted, axis=1) + 0.5 * Z_shifted.shape[1] * theta ** 2)
+
+
+# Weighted affine parts of a block of antithetic pairs under the shift theta. Z has shape (num_pairs, N) (daily 'euler' or 'exact').
+# Returns (a, b, w): the pair averages of w * principal_pv, w * coupon_annuity and of the likelihood ratio w itself.
+def importance_pairs_block(Z, theta, r_g, r_disc, params, scheme='euler'):
+    from calculate_fair_value import T_EXPIRY, payoff_components_block, simulate_paths_block, simulate_paths_block_exact
+
+    dt = T_EXPIRY / Z.shape[1]
+    simulate_paths = simulate_paths_block_exact if scheme == 'exact' else simulate_paths_block
+    pair_a = np.zeros(Z.shape[0])
+    pair_b = np.zeros(Z.shape[0])
+    pair_w = np.zeros(Z.shape[0])
+    for z_shifted in (theta + Z, theta - Z): # antithetic pair around the shifted mean
+        S_paths = simulate_paths(z_shifted, params['S0'], r_g, params['sigma_stock'], dt)
+        principal_pv, coupon_annuity = payoff_components_block(S_paths, r_disc, params)
+        w = likelihood_ratio(z_shifted, theta)
+        pair_a += 0.5 * w * principal_pv
+        pair_b += 0.5 * w * coupon_annuity
+        pair_w += 0.5 * w
+    return pair_a, pair_b, pair_w
+
+
+# Variance of the pair estimator under the shift theta, after regressing out the likelihood ratio (plain antithetic for theta = 0)
+def importance_pair_variance(Z, theta, CP_rate, r_g, r_disc, params, scheme='euler'):
+    a, b, w = importance_pairs_block(Z, theta, r_g, r_disc, params, scheme)
+    pair_pv = a + CP_rate * b
+    covariance = np.cov(pair_pv, w)
+    if theta == 0.0 or covariance[1, 1] <= 0.0:
+        return np.var(pair_pv)
+    return covariance[0, 0] - covariance[0, 1] ** 2 / covariance[1, 1]
+
+
+# Pilot run: the daily shift with the smallest pair variance, searched within bounds on IS_PILOT_PAIRS pairs of the seed's pilot stream.
+# Returns (theta, variance reduction factor against the plain antithetic estimator on the same pilot normals).
+# A shift that does not beat the plain estimator (or a search that failed) is returned as (0.0, 1.0): no importance sampling.
+def choose_importance_shift(CP_rate, r_g, r_disc, params, seed=None, scheme='euler', num_steps=180, pilot_pairs=IS_PILOT_PAIRS,
+                            bounds=IS_SHIFT_BOUNDS):
+    from calculate_fair_value import block_normal_generator
+
+    if seed is None:
+        Z = np.random.standard_normal((pilot_pairs, num_steps))
+    else:
+        Z = block_normal_generator(seed, IS_PILOT_BLOCK).standard_normal((pilot_pairs, num_steps))
+
+    plain_variance = importance_pair_variance(Z, 0.0, CP_rate, r_g, r_disc, params, scheme)
+    # The pilot normals are fixed, so the objective is deterministic; the log keeps its scale even across the heavy-tailed shifts
+    search = minimize_scalar(lambda theta: np.log(importance_pair_variance(Z, theta, CP_rate, r_g, r_disc, params, scheme)),
+                             bounds=bounds, method='bounded', options={'xatol': 0.005})
+    reduction = plain_variance / np.exp(search.fun)
+    if not np.isfinite(reduction) or reduction < 1.0:
+        return 0.0, 1.0
+    return float(search.x), float(reduction)
+
+
+if __name__ == "__main__":
+
+    import multiprocessing
+    from calculate_fair_value import calculate_fair_value, PricingPool
+    multiprocessing.freeze_support()
+
+    hkd_params_prod = {
+        'NOM': 100000.0, 'r_f': 0.0287, 'sigma_stock': 0.6039, 'S0': 11.08,
+        'time_points': np.array([1/12, 2/12, 3/12, 4/12, 5/12, 0.5]),
+        'num_paths': 300000,
+        'K0': 0.96, 'KI': 0.92, 'AC': 0.99
+    }
+    quanto_params_prod = dict(hkd_params_prod, r_d=0.0169, sigma_fx=0.074, rho=0.42)
+    seed = 20251017
+
+    # Plain antithetic against importance sampling on the same number of paths; the variance reduction factor is
+    # (plain stderr / IS stderr)^2, and the efficiency gain also accounts for the time of the pilot and the weights
+    print(f"{'case':<26}{'plain FV':>12}{'stderr':>8}{'IS FV':>12}{'stderr':>8}{'shift':>8}{'VR (pilot)':>12}{'VR':>7}{'efficiency':>12}")
+    cases = [('HKD, KI 92% / AC 99%', hkd_params_prod, 'HKD', 3.458654),
+             ('Quanto, KI 92% / AC 99%', quanto_params_prod, 'Quanto', 3.26),
+             ('HKD, KI 70% / AC 110%', dict(hkd_params_prod, KI=0.70, AC=1.10), 'HKD', 3.458654),
+             ('HKD, KI 92% / AC 105%', dict(hkd_params_prod, AC=1.05), 'HKD', 3.458654)]
+    with PricingPool(hkd_params_prod, 'HKD') as pool:
+        for name, params, product_type, cp in cases:
+            plain = calculate_fair_value(cp, params, product_type, seed=seed, pool=pool)
+            weighted = calculate_fair_value(cp, params, product_type, seed=seed, pool=pool, importance_shift='auto')
+            reduction = (plain.stderr / weighted.stderr) ** 2
+            efficiency = reduction * plain.wall_time / weighted.wall_time
+            print(f"{name:<26}{plain.mean:>12,.2f}{plain.stderr:>8.2f}{weighted.mean:>12,.2f}{weighted.stderr:>8.2f}"
+                  f"{weighted.stats.get('importance_shift', 0.0):>8.3f}{weighted.stats.get('importance_pilot_reduction', 1.0):>12.2f}"
+                  f"{reduction:>7.2f}{efficiency:>12.2f}")
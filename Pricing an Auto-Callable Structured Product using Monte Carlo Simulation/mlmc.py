@@ -0,0 +1,209 @@
+# F:\Learning_journal_at_CUHK\FTEC5610_Computational_Finance\Assignment\Assigenment2-3\mlmc.py
+# Multilevel Monte Carlo (Giles) across time-step resolutions of the Euler scheme.
+#
+# With P_l the pair PV of the autocall on an Euler grid of N_l steps (N_0 < N_1 < ... < N_L = 180), the telescoping sum
+#     E[P_L] = E[P_0] + sum_{l=1..L} E[P_l - P_{l-1}]
+# is estimated level by level on independent samples. Level 0 is many cheap coarse paths; level l >= 1 prices each path twice,
+# on its fine grid and on the coarse grid of level l - 1, driven by the same Brownian increments: the coarse normal of a coarse
+# step is the sum of the m = N_l / N_{l-1} fine normals inside it, divided by sqrt(m). The difference of the two is small, so few
+# fine paths are needed. The estimator has the bias of the finest grid only, i.e. it targets the N = 180 price of calculate_fair_value.
+#
+# Sample sizes (Giles 2008): a pilot run estimates the variance V_l and the cost C_l (step evaluations per pair) of every level,
+# and the pairs that reach a standard error eps at the least total cost are
+#     n_l = eps^-2 sqrt(V_l / C_l) sum_k sqrt(V_k C_k)
+# Levels are topped up to these n_l with the updated V_l until none needs more pairs.
+#
+# Caveat: the knock-in and auto-call tests are discontinuous in the path, so a coarse and a fine path that sit on either side of a
+# barrier pay very different amounts, and Var(P_l - P_{l-1}) decays slowly as the grids get finer. For the production term sheet
+# the best ladder is two levels (6, 180), with about 1.5x fewer step evaluations than plain Euler-180 at the same standard error;
+# intermediate levels such as 30 cost more than they save. The saving of MLMC is much larger on smooth payoffs.
+#
+#     fv = mlmc_fair_value(3.458654, hkd_params_prod, 'HKD', target_stderr=30.0, seed=42)
+#     print(format_mlmc_levels(fv))
+
+import numpy as np
+import multiprocessing
+import time
+
+from calculate_fair_value import DEFAULT_BLOCK_PAIRS, T_EXPIRY, N_STEPS, PricingResult, get_rates, payoff_components_block, simulate_paths_block
+
+# Step counts of the levels, coarse to fine. Every level divides the next and keeps the coupon dates on the grid (N multiple of 6).
+MLMC_LEVELS = (6, 180)
+
+# Pairs of the pilot run of every level
+MLMC_PILOT_PAIRS = 8192
+
+# First entry of the spawn key of the MLMC streams; the block streams of calculate_fair_value use (block_index,)
+MLMC_STREAM = 22
+
+
+# Random stream of one block of one level: spawned from the seed by (MLMC_STREAM, level, block_index)
+def level_normal_generator(seed, level, block_index):
+    return np.random.default_rng(np.random.SeedSequence(seed, spawn_key=(MLMC_STREAM, level, block_index)))
+
+
+# Check the ladder of step counts: increasing, ending at N_STEPS, every level a multiple of the one below and of the coupon dates
+def check_levels(levels, params):
+    levels = tuple(int(N) for N in levels)
+    if levels[-1] != N_STEPS:
+        raise ValueError(f"the finest level must have {N_STEPS} steps")
+    for coarse, fine in zip(levels, levels[1:]):
+        if fine <= coarse or fine % coarse:
+            raise ValueError("every level must be a multiple of the previous one and have more steps")
+    for N in levels:
+        steps = params['time_points'] / T_EXPIRY * N
+        if not np.allclose(steps, np.round(steps)):
+            raise ValueError(f"the coupon dates are not on the grid of {N} steps")
+    return levels
+
+
+# Pair PVs of a block on the Euler grid of Z.shape[1] steps (antithetic pair average)
+def euler_pair_pv(Z, CP_rate, r_g, r_disc, params):
+    dt = T_EXPIRY / Z.shape[1]
+    pair_pv = 0.0
+    for z_block in (Z, -Z): # antithetic pair
+        principal_pv, coupon_annuity = payoff_components_block(simulate_paths_block(z_block, params['S0'], r_g, params['sigma_stock'], dt),
+                                                               r_disc, params)
+        pair_pv = pair_pv + 0.5 * (principal_pv + CP_rate * coupon_annuity)
+    return pair_pv
+
+
+# Coupled samples of one level: (fine pair PV, fine - coarse) on the fine normals Z of shape (pairs, N_fine).
+# For level 0 (N_coarse = None) the correction is the fine pair PV itself.
+def level_pairs_block(Z, N_coarse, CP_rate, r_g, r_disc, params):
+    fine = euler_pair_pv(Z, CP_rate, r_g, r_disc, params)
+    if N_coarse is None:
+        return fine, fine
+    m = Z.shape[1] // N_coarse
+    Z_coarse = Z.reshape(Z.shape[0], N_coarse, m).sum(axis=2) / np.sqrt(m) # same Brownian increments, summed over each coarse step
+    return fine, fine - euler_pair_pv(Z_coarse, CP_rate, r_g, r_disc, params)
+
+
+# Worker task: num_pairs coupled pairs of one level from blocks first_block, first_block + 1, ...
+# Returns the moments of the correction (count, sum, sum_sq) and of the fine pair PV (fine_sum, fine_sum_sq).
+def run_level_chunk(args):
+    level, N_fine, N_coarse, num_pairs, CP_rate, r_g, r_disc, params, seed, first_block, block_pairs = args
+    moments = {'count': 0, 'sum': 0.0, 'sum_sq': 0.0, 'fine_sum': 0.0, 'fine_sum_sq': 0.0}
+    pairs_done = 0
+    block_index = first_block
+    while pairs_done < num_pairs:
+        pairs_in_block = min(block_pairs, num_pairs - pairs_done)
+        Z = level_normal_generator(seed, level, block_index).standard_normal((pairs_in_block, N_fine))
+        fine, correction = level_pairs_block(Z, N_coarse, CP_rate, r_g, r_disc, params)
+        moments['count'] += pairs_in_block
+        moments['sum'] += np.sum(correction)
+        moments['sum_sq'] += np.sum(correction ** 2)
+        moments['fine_sum'] += np.sum(fine)
+        moments['fine_sum_sq'] += np.sum(fine ** 2)
+        pairs_done += pairs_in_block
+        block_index += 1
+    return moments
+
+
+# Pairs of every level that reach the standard error target at the least cost (Giles), from the variances and costs per pair
+def optimal_level_pairs(variances, costs, target_stderr):
+    variances = np.maximum(np.asarray(variances, dtype=float), 1e-12)
+    costs = np.asarray(costs, dtype=float)
+    return np.ceil(np.sqrt(variances / costs) * np.sum(np.sqrt(variances * costs)) / target_stderr ** 2).astype(int)
+
+
+# Fair value of the autocall at N = 180 steps by multilevel Monte Carlo, to a standard error of target_stderr (HKD).
+# levels is the ladder of step counts (default MLMC_LEVELS); every level starts with pilot_pairs pairs and is topped up adaptively.
+# Returns a PricingResult; stats['levels'] holds one dict per level (steps, pairs, mean and variance of the correction,
+# cost per pair and total step evaluations), stats['step_evaluations'] the total, and stats['single_level_step_evaluations']
+# the step evaluations plain Euler-180 pairs would need for the same standard error (from the variance of the finest level).
+def mlmc_fair_value(CP_guess, params, product_type='HKD', target_stderr=30.0, levels=MLMC_LEVELS, seed=None, num_cores=None,
+                    pilot_pairs=MLMC_PILOT_PAIRS, block_pairs=DEFAULT_BLOCK_PAIRS, max_rounds=10):
+    start_time = time.time()
+    if target_stderr <= 0:
+        raise ValueError("target_stderr must be positive")
+    levels = check_levels(levels, params)
+    if seed is None:
+        seed = np.random.SeedSequence().entropy
+    num_cores = num_cores or multiprocessing.cpu_count()
+    r_g, r_disc = get_rates(params, product_type)
+    CP_rate = CP_guess / 100.0
+
+    coarse_steps = (None,) + levels[:-1]
+    # Step evaluations per pair: both antithetic paths on the fine grid, and on the coarse grid for levels >= 1
+    costs = np.array([2 * (N + (N_coarse or 0)) for N, N_coarse in zip(levels, coarse_steps)], dtype=float)
+    totals = [{'count': 0, 'sum': 0.0, 'sum_sq': 0.0, 'fine_sum': 0.0, 'fine_sum_sq': 0.0} for _ in levels]
+    next_block = [0] * len(levels)
+    extra_pairs = np.full(len(levels), pilot_pairs)
+
+    with multiprocessing.Pool(processes=num_cores) as pool:
+        for _ in range(max_rounds):
+            # Split the new pairs of every level into whole blocks over the workers
+            tasks = []
+            for level, pairs in enumerate(extra_pairs):
+                num_blocks = -(-int(pairs) // block_pairs)
+                blocks_per_task = max(1, -(-num_blocks // num_cores))
+                for first in range(0, num_blocks, blocks_per_task):
+                    pairs_to_run = min(blocks_per_task * block_pairs, int(pairs) - first * block_pairs)
+                    tasks.append((level, levels[level], coarse_steps[level], pairs_to_run, CP_rate, r_g, r_disc, params, seed,
+                                  next_block[level] + first, block_pairs))
+                next_block[level] += num_blocks
+            for task, moments in zip(tasks, pool.map(run_level_chunk, tasks)):
+                for name, value in moments.items():
+                    totals[task[0]][name] += value
+
+            counts = np.array([total['count'] for total in totals], dtype=float)
+            means = np.array([total['sum'] for total in totals]) / counts
+            variances = np.maximum(np.array([total['sum_sq'] for total in totals]) / counts - means ** 2, 0.0)
+            extra_pairs = np.maximum(optimal_level_pairs(variances, costs, target_stderr) - counts.astype(int), 0)
+            if not extra_pairs.any():
+                break
+
+    stderr = np.sqrt(np.sum(variances / counts))
+    fine = totals[-1]
+    fine_mean = fine['fine_sum'] / fine['count']
+    fine_variance = max(fine['fine_sum_sq'] / fine['count'] - fine_mean ** 2, 0.0)
+    stats = {'levels': [{'steps': N, 'coarse_steps': N_coarse, 'pairs': int(count), 'mean': mean, 'variance': variance,
+                         'cost_per_pair': cost, 'step_evaluations': int(count * cost)}
+                        for N, N_coarse, count, mean, variance, cost in zip(levels, coarse_steps, counts, means, variances, costs)],
+             'stderr': stderr, 'target_stderr': target_stderr, 'target_reached': stderr <= target_stderr, 'seed': seed,
+             'step_evaluations': int(np.sum(counts * costs)),
+             'single_level_step_evaluations': int(np.ceil(fine_variance / target_stderr ** 2) * 2 * N_STEPS)}
+    return PricingResult(np.sum(means), stderr, 2 * int(np.sum(counts)), time.time() - start_time, stats)
+
+
+# Plain-text report of an MLMC run: one row per level, and the step evaluations against single-level Euler-180
+def format_mlmc_levels(result):
+    header = f"{'level':<7}{'steps':>7}{'coupled':>9}{'pairs':>10}{'mean':>14}{'variance':>12}{'steps / pair':>14}{'step evals':>15}"
+    lines = [header, "-" * len(header)]
+    for index, level in enumerate(result.stats['levels']):
+        coupled = f"{level['coarse_steps']}" if level['coarse_steps'] else "-"
+        lines.append(f"{index:<7}{level['steps']:>7}{coupled:>9}{level['pairs']:>10,}{level['mean']:>14,.2f}{level['variance']:>12.3e}"
+                     f"{level['cost_per_pair']:>14,.0f}{level['step_evaluations']:>15,}")
+    total = result.stats['step_evaluations']
+    single = result.stats['single_level_step_evaluations']
+    lines.append(f"MLMC: {total:,} step evaluations; Euler-{N_STEPS} alone: {single:,} for the same stderr ({single / total:.2f}x)")
+    return "\n".join(lines)
+
+
+if __name__ == "__main__":
+
+    from calculate_fair_value import calculate_fair_value
+    multiprocessing.freeze_support()
+
+    hkd_params_prod = {
+        'NOM': 100000.0, 'r_f': 0.0287, 'sigma_stock': 0.6039, 'S0': 11.08,
+        'time_points': np.array([1/12, 2/12, 3/12, 4/12, 5/12, 0.5]),
+        'num_paths': 300000,
+        'K0': 0.96, 'KI': 0.92, 'AC': 0.99
+    }
+    seed = 20251017
+    CP1_VALUE = 3.458654
+    target_stderr = 20.0
+
+    # Reference: plain Euler-180 to the same standard error
+    reference = calculate_fair_value(CP1_VALUE, hkd_params_prod, 'HKD', seed=seed, target_stderr=target_stderr, max_paths=10**7)
+    print(f"Euler-{N_STEPS} reference: {reference.summary()}")
+    print(f"  step evaluations: {reference.num_paths * N_STEPS:,}\n")
+
+    for levels in ((6, 180), (6, 30, 180)):
+        fv = mlmc_fair_value(CP1_VALUE, hkd_params_prod, 'HKD', target_stderr=target_stderr, levels=levels, seed=seed)
+        gap = fv.mean - reference.mean
+        print(f"MLMC {levels}: {fv.summary()}")
+        print(f"  difference to the reference {gap:+,.2f} HKD ({gap / np.hypot(fv.stderr, reference.stderr):+.2f} combined stderr)")
+        print(format_mlmc_levels(fv) + "\n")
@@ -0,0 +1,84 @@
+# F:\Learning_journal_at_CUHK\FTEC5610_Computational_Finance\Assignment\Assigenment2-3\numba_kernel.py
+# Compiled (numba) kernel of the autocall: path generation and payoff evaluation fused in one loop.
+#
+# The numpy engine builds the whole (paths, 181) price array and then looks for the knock-in and the auto-call date.
+# This kernel walks every path day by day, keeps only the current price, and stops the path as soon as it is auto-called,
+# so no per-path array is allocated and a called path does not compute its remaining days.
+# numba is optional: when it is not installed NUMBA_AVAILABLE is False and calculate_fair_value falls back to the numpy engine.
+
+import math
+
+try:
+    from numba import njit
+    NUMBA_AVAILABLE = True
+except ImportError:
+    njit = None
+    NUMBA_AVAILABLE = False
+
+
+# Price one block of antithetic pairs. Z has shape (num_pairs, N), the results are written to a_out / b_out (one value per pair):
+#   a_out: pair average of the discounted principal / redemption
+#   b_out: pair average of the discounted coupon annuity, so the pair PV is a_out + CP_rate * b_out
+# The prices are built in the same order as the numpy engine (cumprod of the Euler growth factors, or cumsum of the exact
+# log-steps, then times S0), so with the same normals both engines see the same prices.
+def autocall_pairs_kernel(Z, S0, r_g, sigma, dt, exact, NOM, P_K, P_C, K, r_disc, T,
+                          first_autocall_step, all_period_boundaries, alive_annuity, a_out, b_out):
+    num_pairs, N = Z.shape
+    vol = sigma * math.sqrt(dt)
+    log_drift = (r_g - 0.5 * sigma * sigma) * dt
+    discount_factor_expiry = math.exp(-r_disc * T)
+
+    for i in range(num_pairs):
+        pair_a = 0.0
+        pair_b = 0.0
+        for sign in (1.0, -1.0): # antithetic pair
+            growth_product = 1.0
+            log_sum = 0.0
+            S = S0
+            knock_in_occurred = False
+            called = False
+
+            for step in range(1, N + 1):
+                z = sign * Z[i, step - 1]
+                if exact:
+                    log_sum += log_drift + vol * z
+                    S = S0 * math.exp(log_sum)
+                else:
+                    # Refer to: dS = r_g S dt + \sigma S Z \sqrt{dt}
+                    growth_product *= 1.0 + r_g * dt + vol * z
+                    S = S0 * growth_product
+
+                # B. Knock-in
+                if S < P_K:
+                    knock_in_occurred = True
+
+                # C. Auto-call: NOM + accrued interest, discounted from the call date, and the path stops here
+                if step >= first_autocall_step and S >= P_C:
+                    # The interest period of the call date: preceding_coupon_step < step <= next_coupon_step
+                    period_index = 0
+                    while all_period_boundaries[period_index + 1] < step:
+                        period_index += 1
+                    preceding_coupon_step = all_period_boundaries[period_index]
+                    next_coupon_step = all_period_boundaries[period_index + 1]
+                    accrual_fraction = (step - preceding_coupon_step) / (next_coupon_step - preceding_coupon_step)
+                    call_discount = math.exp(-r_disc * step * dt)
+                    pair_a += NOM * call_discount
+                    pair_b += NOM * accrual_fraction * call_discount
+                    called = True
+                    break
+
+            if not called:
+                # Expiry: NOM, or NOM * S_M / K if knocked in and S_M < K, plus all the coupons
+                if knock_in_occurred and S < K:
+                    pair_a += NOM * S / K * discount_factor_expiry
+                else:
+                    pair_a += NOM * discount_factor_expiry
+                pair_b += alive_annuity
+
+        a_out[i] = 0.5 * pair_a
+        b_out[i] = 0.5 * pair_b
+
+
+if NUMBA_AVAILABLE:
+    # cache=True keeps the compiled kernel on disk, so the workers do not compile it again on every run
+    autocall_pairs_kernel = njit(cache=True)(autocall_pairs_kernel)
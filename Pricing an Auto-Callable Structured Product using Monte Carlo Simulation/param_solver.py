@@ -0,0 +1,167 @@
+# F:\Learning_journal_at_CUHK\FTEC5610_Computational_Finance\Assignment\Assigenment2-3\param_solver.py
+# Solving for a barrier or the strike (K0, KI or AC) at a target fair value, with the coupon fixed.
+#
+# solve_param() finds a bracket with a cheap walk on BRACKET_SEARCH_PATHS paths (find_bracket, bracket_search_steps), checks it
+# on the full path count and refines it with brentq; every guess is priced on the same CRN seed, on the pool if one is given.
+# solver_ii.py (Q2) and its -cn copy run it; batch_solver.py drives the same bracket walk one guess per round.
+#
+#     with PricingPool(hkd_params_prod, 'HKD') as pool:
+#         found_KI = solve_param('KI', hkd_params_prod, 3.358654, 98800.0, seed=42, pool=pool)
+
+import copy # Used for deep copying the parameter dictionary
+
+import numpy as np
+from scipy.optimize import brentq
+
+from calculate_fair_value import calculate_fair_value
+from telemetry import profiled_solve, record_solver_step # JSONL records / profiler, switched on by the environment
+
+# Domain searched for each parameter (as a fraction of S0). The barriers and the strike cannot be negative
+# (K0 = 0 would divide by zero in the redemption NOM * S_M / K), and 2.0 (200% of S0) caps the search from above.
+PARAM_DOMAINS = {'K0': (0.01, 2.0), 'KI': (0.0, 2.0), 'AC': (0.0, 2.0)}
+
+# Bracket discovery prices on this many paths, starting with steps of BRACKET_INITIAL_STEP that double each time
+BRACKET_SEARCH_PATHS = 20000
+BRACKET_INITIAL_STEP = 0.02
+
+# Define the generic objective function
+def generic_objective_function(param_guess, param_name_to_solve, base_params, fixed_cp, target_fv, seed=None, pool=None):
+    """
+    Generic objective function, used to solve for K0, KI, or AC.
+    
+    param_guess: The new parameter value guessed by the solver (e.g., 0.95)
+    param_name_to_solve: The name of the parameter to modify, which param to search (e.g., 'K0')
+    base_params: Dictionary containing the original K0, KI, AC
+    fixed_cp: The fixed new coupon (CP_new)
+    target_fv: The target fair value (98,800)
+    seed: Common Random Numbers seed, every guess is priced on the same paths
+    pool: optional PricingPool, its workers are reused for every guess
+    :return: Error (FV - Target)
+    """
+    
+    # Create a copy of the parameters to avoid modifying the original dictionary
+    temp_params = copy.deepcopy(base_params)
+    
+    # Set the "guessed value" in the dictionary
+    temp_params[param_name_to_solve] = param_guess
+    
+    # Call the core pricing engine
+    current_fv = calculate_fair_value(
+        CP_guess=fixed_cp, # coupon is fixed
+        params=temp_params, # the 3 changed params
+        product_type='HKD',
+        seed=seed, # same normals for every guess, so the objective is deterministic in the parameter
+        pool=pool # only the changed parameter is sent to the pool workers
+    )
+    
+    # 4. Calculate the error
+    error = current_fv - target_fv
+    
+    print(f"  [Solver Step: {param_name_to_solve}] Guess {param_name_to_solve} = {param_guess: .6f} -> FV: {current_fv/temp_params['NOM'] * 100.0: .4f}% -> Error: {error: .2f}")
+    record_solver_step('solve_param', param_name_to_solve, param_guess, current_fv, error, cp=fixed_cp, target_fv=target_fv, seed=seed)
+    
+    return error
+
+# The walk of the bracket discovery, one guess at a time: a generator that yields the next guess and is sent its error.
+# It walks from start in the direction in which the error falls, doubling the step until the error changes sign;
+# if it reaches the edge of the domain [lowest, highest] it also tries the other direction.
+# Returns (StopIteration value) ((a, error_a), (b, error_b)) with a < b, or None if the error never changes sign.
+def bracket_search_steps(start, lowest, highest, step=BRACKET_INITIAL_STEP):
+    start = min(max(start, lowest), highest)
+    error_start = yield start
+    
+    # A first step decides the direction: towards the smaller error
+    probe = start - step if start - step >= lowest else start + step
+    error_probe = yield probe
+    if error_start * error_probe <= 0:
+        return tuple(sorted([(start, error_start), (probe, error_probe)]))
+    first_direction = np.sign(probe - start) if abs(error_probe) < abs(error_start) else np.sign(start - probe)
+    
+    for direction in (first_direction, -first_direction):
+        # Walk from the start point, or from the probe if it is on this side
+        if np.sign(probe - start) == direction:
+            current, error_current, walk_step = probe, error_probe, 2.0 * step
+        else:
+            current, error_current, walk_step = start, error_start, step
+        while lowest < current < highest:
+            following = min(max(current + direction * walk_step, lowest), highest)
+            error_following = yield following
+            if error_current * error_following <= 0:
+                return tuple(sorted([(current, error_current), (following, error_following)]))
+            current, error_current = following, error_following
+            walk_step *= 2.0
+    return None
+
+
+# Automatic bracket discovery
+def find_bracket(param_name_to_solve, base_params, fixed_cp, target_fv, start=None, seed=None, pool=None,
+                 search_paths=BRACKET_SEARCH_PATHS, step=BRACKET_INITIAL_STEP, domain=None):
+    """
+    Find a range [a, b] of the parameter in which the fair value crosses the target, without hand-picked bounds.
+    Every guess is priced on search_paths paths only (same CRN seed as the refinement), so the search is cheap.
+    
+    start: the first guess (default: the base value of the parameter)
+    step: the first step of the walk (see bracket_search_steps)
+    domain: (lowest, highest) value of the parameter, default PARAM_DOMAINS
+    :return: (a, b), or None if the error has the same sign on the whole walk, i.e. there is no root in the domain
+    """
+    
+    lowest, highest = domain or PARAM_DOMAINS[param_name_to_solve]
+    search_params = dict(base_params, num_paths=search_paths)
+    
+    def search_objective(param_guess):
+        print(f"  [Bracket search, {search_paths:,} paths]", end="")
+        return generic_objective_function(param_guess, param_name_to_solve, search_params, fixed_cp, target_fv, seed, pool)
+    
+    steps = bracket_search_steps(base_params[param_name_to_solve] if start is None else start, lowest, highest, step)
+    try:
+        guess = next(steps)
+        while True:
+            guess = steps.send(search_objective(guess))
+    except StopIteration as stop:
+        bracket = stop.value
+    
+    if bracket is None:
+        print(f"  [Bracket search] No root for {param_name_to_solve} in [{lowest:.4f}, {highest:.4f}]: "
+              f"the fair value stays on one side of the target on the whole domain.")
+        return None
+    return (bracket[0][0], bracket[1][0])
+
+
+# Solve one parameter: cheap bracket discovery, then brentq on the full path count
+def solve_param(param_name_to_solve, base_params, fixed_cp, target_fv, seed=None, pool=None, start=None, xtol=1e-6, domain=None):
+    """
+    Returns the solved parameter, or None if there is no root in the domain (no full-path pricing is spent then).
+    The bracket is checked on base_params['num_paths'] paths; if the extra paths moved the root out of it,
+    it is widened (by its own width, towards the smaller error) within the domain before brentq runs.
+    AUTOCALL_PROFILE=<file> profiles the solve, bracket search included (see telemetry.py).
+    """
+    with profiled_solve(f"solve_param-{param_name_to_solve}"):
+        return _solve_param(param_name_to_solve, base_params, fixed_cp, target_fv, seed, pool, start, xtol, domain)
+
+
+def _solve_param(param_name_to_solve, base_params, fixed_cp, target_fv, seed, pool, start, xtol, domain):
+    bracket = find_bracket(param_name_to_solve, base_params, fixed_cp, target_fv, start, seed, pool, domain=domain)
+    if bracket is None:
+        return None
+    lowest, highest = domain or PARAM_DOMAINS[param_name_to_solve]
+    print(f"  [Bracket search] Found bracket [{bracket[0]:.6f}, {bracket[1]:.6f}], refining on {base_params['num_paths']:,} paths")
+    
+    priced = {} # brentq prices the bracket ends again, reuse the check below
+    def full_objective(param_guess):
+        if param_guess not in priced:
+            priced[param_guess] = generic_objective_function(param_guess, param_name_to_solve, base_params, fixed_cp, target_fv, seed, pool)
+        return priced[param_guess]
+    
+    a, b = bracket
+    while full_objective(a) * full_objective(b) > 0:
+        if (a, b) == (lowest, highest):
+            print(f"  [Bracket search] No root for {param_name_to_solve} in [{lowest:.4f}, {highest:.4f}] on the full path count.")
+            return None
+        width = b - a
+        if abs(full_objective(a)) < abs(full_objective(b)):
+            a = max(a - width, lowest)
+        else:
+            b = min(b + width, highest)
+    
+    return brentq(full_objective, a, b, xtol=xtol)
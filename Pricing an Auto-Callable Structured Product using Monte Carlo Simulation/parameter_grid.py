@@ -0,0 +1,242 @@
+# F:\Learning_journal_at_CUHK\FTEC5610_Computational_Finance\Assignment\Assigenment2-3\parameter_grid.py
+# Fair value surface over a K0 x KI x AC x CP grid, from one simulation of the paths.
+#
+# The strike K0, the barriers KI and AC and the coupon CP only change the payoff, not the paths. So every block of paths is
+# simulated once, and each path is reduced to what the payoff needs:
+#   - its running minimum (knock-in for any KI: min < KI * S0)
+#   - its first passage time to every AC level on or after the first auto-call date (the running maximum reaches AC * S0),
+#     for all the levels at once: the running maximum is computed once, each day is placed among the sorted levels (searchsorted),
+#     and the first passage to level j is the number of callable days that are still below it
+#   - its final price S_T (redemption NOM * S_T / K for any K0)
+# The fair value of every (K0, KI, AC, CP) point then comes from array operations on these summaries:
+#   PV = A(K0, KI, AC) + CP * B(AC)
+#   B(AC)         = called paths: NOM * accrual * call discount,   alive paths: the coupon annuity of alive_coupon_annuity()
+#   A(K0, KI, AC) = called paths: NOM * call discount,            alive paths: discounted NOM * (1 - knocked_in(KI) * (1 - min(S_T / K, 1)))
+# The sum of the alive part over the paths is one matrix product per AC level: (1 - min(S_T / K, 1))^T @ (alive * knocked_in).
+# With a seed every grid point equals calculate_fair_value(..., seed=seed) at that point (same paths, same payoff).
+#
+#     surface = price_grid(hkd_params_prod, 'HKD', K0=np.linspace(0.90, 1.00, 11), KI=np.linspace(0.50, 0.95, 46),
+#                          AC=np.linspace(0.95, 1.05, 11), CP=np.linspace(3.0, 3.6, 7), seed=42)
+#     surface.values[i, j, k, l]                                   # fair value at K0[i], KI[j], AC[k], CP[l]
+#     surface.fair_value(K0=0.96, KI=0.80, AC=0.99, CP=3.36)       # interpolated
+#     surface.solve('KI', 98800.0, K0=0.96, AC=0.99, CP=3.36)      # read a Q2 answer off the surface
+
+import numpy as np
+import multiprocessing
+from scipy.interpolate import RegularGridInterpolator
+
+from calculate_fair_value import (DEFAULT_BLOCK_PAIRS, T_EXPIRY, N_STEPS, alive_coupon_annuity, build_step_schedule, get_rates,
+                                  iter_normal_blocks, simulate_paths_block)
+
+# xarray is optional: FairValueSurface.to_xarray() needs it, everything else works with plain numpy arrays
+try:
+    import xarray
+    XARRAY_AVAILABLE = True
+except ImportError:
+    xarray = None
+    XARRAY_AVAILABLE = False
+
+GRID_AXES = ('K0', 'KI', 'AC', 'CP')
+
+
+# Worker task: simulate a block range once and add up A(K0, KI, AC) and B(AC) over its paths.
+# Returns {'count': paths, 'a_sum': (n_K0, n_KI, n_AC) array, 'b_sum': (n_AC,) array}
+def run_grid_chunk(args):
+    num_pairs, r_g, r_disc, params, seed, first_block, block_pairs, K0_levels, KI_levels, AC_levels = args
+    NOM = params['NOM']
+    S0 = params['S0']
+    dt, coupon_steps, first_autocall_step, all_period_boundaries = build_step_schedule(params, T_EXPIRY, N_STEPS)
+    discount_factor_expiry = np.exp(-r_disc * T_EXPIRY)
+    alive_annuity = alive_coupon_annuity(params, r_disc, T_EXPIRY, N_STEPS)
+    strikes = S0 * np.asarray(K0_levels)
+    knock_in_prices = S0 * np.asarray(KI_levels)
+    call_prices = S0 * np.asarray(AC_levels) # increasing (price_grid checks it)
+    n_AC = len(AC_levels)
+
+    # Discount and accrued-coupon fraction of a call on each step
+    steps = np.arange(N_STEPS + 1)
+    period_index = np.clip(np.searchsorted(all_period_boundaries, steps, side='left') - 1, 0, len(all_period_boundaries) - 2)
+    preceding_coupon_step = all_period_boundaries[period_index]
+    next_coupon_step = all_period_boundaries[period_index + 1]
+    step_accrual_fraction = (steps - preceding_coupon_step) / (next_coupon_step - preceding_coupon_step)
+    step_call_discount = np.exp(-r_disc * steps * dt)
+
+    a_sum = np.zeros((len(K0_levels), len(KI_levels), len(AC_levels)))
+    b_sum = np.zeros(len(AC_levels))
+    count = 0
+
+    for Z in iter_normal_blocks(num_pairs, block_pairs, seed, first_block, N_STEPS):
+        for z_block in (Z, -Z): # antithetic pair; for the mean both halves are simply paths
+            S_paths = simulate_paths_block(z_block, S0, r_g, params['sigma_stock'], dt)
+            count += S_paths.shape[0]
+
+            # The path summaries
+            running_min = np.min(S_paths[:, 1:], axis=1)
+            S_T = S_paths[:, N_STEPS]
+            callable_prices = S_paths[:, first_autocall_step:]
+            num_callable_steps = callable_prices.shape[1]
+            knocked_in = running_min[:, None] < knock_in_prices[None, :] # (paths, n_KI)
+            redemption_loss = 1.0 - np.minimum(S_T[:, None] / strikes[None, :], 1.0) # (paths, n_K0), 0 unless S_T < K
+
+            # First passage to every AC level: levels_reached[i, n] is the number of levels at or below the running maximum of
+            # path i on callable day n (non-decreasing in n), so the first passage to level j is the number of days with
+            # levels_reached <= j, a cumulative count of the per-path histogram of levels_reached
+            running_max = np.maximum.accumulate(callable_prices, axis=1)
+            levels_reached = np.searchsorted(call_prices, running_max, side='right') # (paths, callable steps)
+            row_offset = (n_AC + 1) * np.arange(S_paths.shape[0])[:, None]
+            level_counts = np.bincount((levels_reached + row_offset).ravel(), minlength=S_paths.shape[0] * (n_AC + 1))
+            first_passage = np.cumsum(level_counts.reshape(S_paths.shape[0], n_AC + 1)[:, :n_AC], axis=1) # (paths, n_AC)
+            called_levels = first_passage < num_callable_steps
+            call_steps = first_autocall_step + first_passage
+
+            for k in range(n_AC):
+                called = called_levels[:, k]
+                call_step = call_steps[called, k]
+                accrual_fraction = step_accrual_fraction[call_step]
+                call_discount = step_call_discount[call_step]
+
+                alive = ~called
+                num_alive = np.count_nonzero(alive)
+                # Alive paths: NOM at expiry, less NOM * (1 - S_T / K) where knocked in and S_T < K
+                loss = redemption_loss[alive].T @ knocked_in[alive].astype(float) # (n_K0, n_KI)
+                a_sum[:, :, k] += NOM * np.sum(call_discount) + discount_factor_expiry * NOM * (num_alive - loss)
+                b_sum[k] += NOM * np.sum(accrual_fraction * call_discount) + num_alive * alive_annuity
+
+    return {'count': count, 'a_sum': a_sum, 'b_sum': b_sum}
+
+
+# The fair value surface of a price_grid run.
+#   values: (n_K0, n_KI, n_AC, n_CP) array of fair values, A and B its affine parts (values = A + CP% / 100 * B)
+#   K0, KI, AC, CP: the grid axes (CP in %)
+class FairValueSurface:
+
+    def __init__(self, K0, KI, AC, CP, A, B, num_paths, seed):
+        self.K0, self.KI, self.AC, self.CP = (np.asarray(axis, dtype=float) for axis in (K0, KI, AC, CP))
+        self.A = A
+        self.B = B
+        self.num_paths = num_paths
+        self.seed = seed
+        self.values = A[:, :, :, None] + self.CP[None, None, None, :] / 100.0 * B[None, None, :, None]
+
+    # Interpolated affine parts at (K0, KI, AC): multilinear in the axes with more than one level
+    def affine_parts(self, K0, KI, AC):
+        point = {'K0': K0, 'KI': KI, 'AC': AC}
+        axes = [name for name in ('K0', 'KI', 'AC') if len(getattr(self, name)) > 1]
+        for name in ('K0', 'KI', 'AC'):
+            if name not in axes and not np.isclose(point[name], getattr(self, name)[0]):
+                raise ValueError(f"The grid has the single level {name} = {getattr(self, name)[0]}, it cannot give {name} = {point[name]}")
+        A = self.A.reshape([len(getattr(self, name)) for name in ('K0', 'KI', 'AC') if name in axes] or [1])
+        if axes:
+            A = RegularGridInterpolator([getattr(self, name) for name in axes], A)([point[name] for name in axes])[0]
+        else:
+            A = A[0]
+        B = np.interp(AC, self.AC, self.B) if len(self.AC) > 1 else self.B[0]
+        return A, B
+
+    # Interpolated fair value at one point (inside the grid; CP enters exactly, it is affine)
+    def fair_value(self, K0, KI, AC, CP):
+        A, B = self.affine_parts(K0, KI, AC)
+        return A + CP / 100.0 * B
+
+    # Read a solution off the surface: the value of `variable` at which the fair value equals target_fv, the others fixed.
+    # CP is exact ((target - A) / B); K0 / KI / AC are the root of the interpolated fair value along their axis.
+    # Returns None when the fair value does not cross the target inside the grid.
+    def solve(self, variable, target_fv, K0=None, KI=None, AC=None, CP=None):
+        point = {'K0': K0, 'KI': KI, 'AC': AC, 'CP': CP}
+        if variable not in GRID_AXES:
+            raise ValueError(f"variable must be one of {GRID_AXES}")
+        if any(point[name] is None for name in GRID_AXES if name != variable):
+            raise ValueError(f"Give the fixed values of {[name for name in GRID_AXES if name != variable]}")
+        if variable == 'CP':
+            A, B = self.affine_parts(K0, KI, AC)
+            return 100.0 * (target_fv - A) / B
+
+        levels = getattr(self, variable)
+        errors = []
+        for level in levels:
+            point[variable] = level
+            errors.append(self.fair_value(point['K0'], point['KI'], point['AC'], point['CP']) - target_fv)
+        errors = np.array(errors)
+        crossings = np.nonzero(errors[:-1] * errors[1:] <= 0)[0]
+        if len(crossings) == 0:
+            return None
+        # The first crossing from the low end; the interpolant is linear between two levels
+        i = crossings[0]
+        if errors[i] == errors[i + 1]:
+            return levels[i]
+        return levels[i] - errors[i] * (levels[i + 1] - levels[i]) / (errors[i + 1] - errors[i])
+
+    # The surface as a labelled xarray.DataArray (needs xarray)
+    def to_xarray(self):
+        if not XARRAY_AVAILABLE:
+            raise ImportError("to_xarray needs xarray (pip install xarray); the surface is also available as .values")
+        return xarray.DataArray(self.values, dims=GRID_AXES, coords={name: getattr(self, name) for name in GRID_AXES},
+                                name='fair_value', attrs={'num_paths': self.num_paths, 'seed': self.seed})
+
+
+# Price the whole K0 x KI x AC x CP grid (each a 1-D array of levels; K0 / KI / AC as fractions of S0, CP in %)
+# on params['num_paths'] paths, simulated once. seed fixes the paths (CRN), as in calculate_fair_value.
+def price_grid(params, product_type='HKD', K0=None, KI=None, AC=None, CP=None, seed=None, num_cores=None,
+               block_pairs=DEFAULT_BLOCK_PAIRS):
+    # An axis that is not given is the single level of params (CP has no default)
+    K0 = np.atleast_1d(params['K0'] if K0 is None else K0).astype(float)
+    KI = np.atleast_1d(params['KI'] if KI is None else KI).astype(float)
+    AC = np.atleast_1d(params['AC'] if AC is None else AC).astype(float)
+    if CP is None:
+        raise ValueError("price_grid needs the CP levels (in %)")
+    CP = np.atleast_1d(CP).astype(float)
+    for name, levels in (('K0', K0), ('KI', KI), ('AC', AC), ('CP', CP)):
+        if len(levels) > 1 and np.any(np.diff(levels) <= 0):
+            raise ValueError(f"The {name} levels must be increasing")
+
+    if seed is None:
+        seed = np.random.SeedSequence().entropy
+    num_cores = num_cores or multiprocessing.cpu_count()
+    r_g, r_disc = get_rates(params, product_type)
+
+    # Whole blocks per task, like build_pricing_tasks, so the paths are the ones of calculate_fair_value with the same seed
+    num_pairs = params['num_paths'] // 2
+    num_blocks = -(-num_pairs // block_pairs)
+    blocks_per_task = -(-num_blocks // num_cores)
+    args_list = [(min(blocks_per_task * block_pairs, num_pairs - first_block * block_pairs), r_g, r_disc, params, seed, first_block,
+                  block_pairs, K0, KI, AC) for first_block in range(0, num_blocks, blocks_per_task)]
+
+    with multiprocessing.Pool(processes=num_cores) as pool:
+        results = pool.map(run_grid_chunk, args_list)
+
+    count = sum(result['count'] for result in results)
+    A = sum(result['a_sum'] for result in results) / count
+    B = sum(result['b_sum'] for result in results) / count
+    return FairValueSurface(K0, KI, AC, CP, A, B, 2 * num_pairs, seed)
+
+
+if __name__ == "__main__":
+
+    import time
+    multiprocessing.freeze_support()
+
+    hkd_params_prod = {
+        'NOM': 100000.0, 'r_f': 0.0287, 'sigma_stock': 0.6039, 'S0': 11.08,
+        'time_points': np.array([1/12, 2/12, 3/12, 4/12, 5/12, 0.5]),
+        'num_paths': 300000,
+        'K0': 0.96, 'KI': 0.92, 'AC': 0.99
+    }
+    CP_NEW = 3.458654 - 0.10
+    TARGET_FV = 98800.0
+
+    K0_levels = np.round(np.arange(0.90, 1.0001, 0.005), 4)
+    KI_levels = np.round(np.arange(0.50, 0.9501, 0.01), 4)
+    AC_levels = np.round(np.arange(0.95, 1.0501, 0.005), 4)
+    CP_levels = np.round(np.arange(3.0, 3.6001, 0.05), 4)
+
+    start_time = time.time()
+    surface = price_grid(hkd_params_prod, 'HKD', K0=K0_levels, KI=KI_levels, AC=AC_levels, CP=CP_levels)
+    print(f"Fair value surface {surface.values.shape} = {surface.values.size:,} points on {surface.num_paths:,} paths "
+          f"in {time.time() - start_time:.2f} seconds")
+
+    # Q2 read off the surface: one of K0 / KI / AC moves, the others keep their Q1 values
+    print(f"Q1(i) CP  at K0=0.96, KI=0.92, AC=0.99: {surface.solve('CP', TARGET_FV, K0=0.96, KI=0.92, AC=0.99):.6f} %")
+    for variable in ('K0', 'KI', 'AC'):
+        fixed = {name: hkd_params_prod[name] for name in ('K0', 'KI', 'AC') if name != variable}
+        solution = surface.solve(variable, TARGET_FV, CP=CP_NEW, **fixed)
+        print(f"Q2 {variable} at CP_new={CP_NEW:.6f}%: " + (f"{solution:.6f}" if solution is not None else "no root inside the grid"))
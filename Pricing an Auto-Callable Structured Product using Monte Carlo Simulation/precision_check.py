@@ -0,0 +1,138 @@
+# F:\Learning_journal_at_CUHK\FTEC5610_Computational_Finance\Assignment\Assigenment2-3\precision_check.py
+# (This script checks that float32 paths, calculate_fair_value(..., dtype='float32'), do not move the answers)
+#
+# A seeded float32 run changes two things at once: the arithmetic of the paths is rounded to 7 digits, and the normals themselves
+# are other numbers (the block generators draw float32 normals directly). The float32 error is the first part, so it is measured
+# on the same normals; the second part only adds ordinary Monte Carlo noise. The check has three parts:
+#   1. Rounding error, pair by pair: the same float64 normals are priced once with float64 paths and once with the paths evolved
+#      in float32 (affine_pairs_block on Z.astype(float32)). The only difference is the rounding, which flips the knock-in or
+#      auto-call test of the few paths that sit on a barrier to 7 digits. The mean pair difference (with its own standard error)
+#      must stay below ROUNDING_TOLERANCE times the Monte Carlo standard error of the price.
+#   2. End to end on the same normals: the engine prices the product with dtype='float64' and dtype='float32' on one
+#      SharedNormals buffer (the float32 run rounds the float64 normals). The gap must stay below ROUNDING_TOLERANCE stderr.
+#   3. The fast float32 mode: the engine prices with dtype='float32' on the seed (its own float32 normals). It is unbiased on
+#      its own normals, so it must agree with the float64 run within NOISE_Z_LIMIT combined standard errors (as validator.py).
+# The production parameter sets and coupons are those of solver_i.py (Q1) and solver_iii.py (Q3).
+
+import numpy as np
+import multiprocessing
+
+from calculate_fair_value import (DEFAULT_BLOCK_PAIRS, N_STEPS, PricingPool, SharedNormals, affine_pairs_block, get_rates,
+                                  iter_normal_blocks)
+
+# The float32 rounding error of the price (on the same normals) must stay below this fraction of the Monte Carlo standard error
+ROUNDING_TOLERANCE = 0.1
+
+# The float64 and the fast float32 fair values (different normals) must agree within this many combined standard errors
+NOISE_Z_LIMIT = 3.0
+
+
+# Price the same float64 normals with float64 and with float32 paths, pair by pair.
+# Returns {'difference': mean pair PV difference (float32 - float64), 'difference_stderr', 'max_pair_difference',
+#          'changed_pairs': pairs whose PV moved by more than 1 HKD, 'stderr': MC standard error of the float64 price}
+def float32_rounding_error(CP_guess, params, product_type='HKD', seed=None, scheme='euler', block_pairs=DEFAULT_BLOCK_PAIRS):
+    CP_rate = CP_guess / 100.0
+    r_g, r_disc = get_rates(params, product_type)
+    moments = {'count': 0, 'sum': 0.0, 'sum_sq': 0.0, 'diff_sum': 0.0, 'diff_sum_sq': 0.0, 'max_diff': 0.0, 'changed': 0}
+    for Z in iter_normal_blocks(params['num_paths'] // 2, block_pairs, seed, 0, N_STEPS):
+        a, b = affine_pairs_block(Z, r_g, r_disc, params, scheme)
+        a32, b32 = affine_pairs_block(Z.astype(np.float32), r_g, r_disc, params, scheme)
+        pair_pv = a + CP_rate * b
+        difference = (a32 + CP_rate * b32) - pair_pv
+        moments['count'] += Z.shape[0]
+        moments['sum'] += np.sum(pair_pv)
+        moments['sum_sq'] += np.sum(pair_pv ** 2)
+        moments['diff_sum'] += np.sum(difference)
+        moments['diff_sum_sq'] += np.sum(difference ** 2)
+        moments['max_diff'] = max(moments['max_diff'], np.max(np.abs(difference)))
+        moments['changed'] += int(np.count_nonzero(np.abs(difference) > 1.0))
+
+    count = moments['count']
+    mean = moments['sum'] / count
+    difference = moments['diff_sum'] / count
+    return {'difference': difference,
+            'difference_stderr': np.sqrt(max(moments['diff_sum_sq'] / count - difference ** 2, 0.0) / count),
+            'max_pair_difference': moments['max_diff'], 'changed_pairs': moments['changed'], 'pairs': count,
+            'stderr': np.sqrt(max(moments['sum_sq'] / count - mean ** 2, 0.0) / count)}
+
+
+# All three parts of the check for one product. pool is a PricingPool for the engine runs (a new one is started if not given).
+# Returns the rounding-error dict of float32_rounding_error, updated with the engine runs on the same normals
+# ('shared_fv64', 'shared_fv32', 'shared_gap': float32 - float64 in standard errors), the seeded runs ('fv64', 'fv32',
+# 'gap_z': in combined standard errors) and 'passed' (all criteria met).
+def check_float32_accuracy(CP_guess, params, product_type='HKD', seed=None, scheme='euler', pool=None):
+    if seed is None:
+        seed = np.random.SeedSequence().entropy
+    check = float32_rounding_error(CP_guess, params, product_type, seed, scheme)
+
+    own_pool = pool is None
+    if own_pool:
+        pool = PricingPool(params, product_type)
+    try:
+        with SharedNormals(params['num_paths'] // 2, seed) as shared_normals:
+            shared_fv64 = pool.price(CP_guess, params=params, product_type=product_type, shared_normals=shared_normals, scheme=scheme)
+            shared_fv32 = pool.price(CP_guess, params=params, product_type=product_type, shared_normals=shared_normals, scheme=scheme,
+                                     dtype='float32')
+        fv64 = pool.price(CP_guess, params=params, product_type=product_type, seed=seed, scheme=scheme)
+        fv32 = pool.price(CP_guess, params=params, product_type=product_type, seed=seed, scheme=scheme, dtype='float32')
+    finally:
+        if own_pool:
+            pool.close()
+
+    check['shared_fv64'] = shared_fv64
+    check['shared_fv32'] = shared_fv32
+    check['shared_gap'] = (shared_fv32.mean - shared_fv64.mean) / shared_fv64.stderr
+    check['fv64'] = fv64
+    check['fv32'] = fv32
+    check['gap_z'] = (fv32.mean - fv64.mean) / np.hypot(fv32.stderr, fv64.stderr)
+    check['passed'] = (abs(check['difference']) < ROUNDING_TOLERANCE * check['stderr'] and abs(check['shared_gap']) < ROUNDING_TOLERANCE
+                       and abs(check['gap_z']) < NOISE_Z_LIMIT)
+    return check
+
+
+if __name__ == "__main__":
+
+    multiprocessing.freeze_support()
+
+    # Production parameters of solver_i.py / solver_ii.py (Q1) and solver_iii.py (Q3), with their answers
+    hkd_params_prod = {
+        'NOM': 100000.0, 'r_f': 0.0287, 'sigma_stock': 0.6039, 'S0': 11.08,
+        'time_points': np.array([1/12, 2/12, 3/12, 4/12, 5/12, 0.5]),
+        'num_paths': 300000,
+        'K0': 0.96, 'KI': 0.92, 'AC': 0.99
+    }
+    quanto_params_prod = {
+        'NOM': 100000.0, 'S0': 11.08, 'sigma_stock': 0.6039,
+        'K0': 0.96, 'KI': 0.92, 'AC': 0.99,
+        'time_points': np.array([1/12, 2/12, 3/12, 4/12, 5/12, 0.5]),
+        'num_paths': 300000,
+        'r_d': 0.0169, 'r_f': 0.0287, 'sigma_fx': 0.074, 'rho': 0.42
+    }
+    seed = 20251017
+    cases = [('Q1(i)  HKD, euler', hkd_params_prod, 'HKD', 3.458654, 'euler'),
+             ('Q1(ii) HKD, euler', hkd_params_prod, 'HKD', 3.206363, 'euler'),
+             ('Q1(i)  HKD, exact', hkd_params_prod, 'HKD', 3.458654, 'exact'),
+             ('Q3(i)  Quanto, euler', quanto_params_prod, 'Quanto', 3.262929, 'euler'),
+             ('Q3(ii) Quanto, euler', quanto_params_prod, 'Quanto', 3.015741, 'euler')]
+
+    print(f"1. Rounding: same float64 normals, float32 paths, pair by pair (limit {ROUNDING_TOLERANCE:.0%} of the MC stderr)")
+    print(f"2. Engine on one SharedNormals buffer: dtype='float32' against dtype='float64' (limit {ROUNDING_TOLERANCE:.0%} of the MC stderr)")
+    print(f"3. Engine on the seed, float32 drawing its own normals: against float64 (limit {NOISE_Z_LIMIT:.0f} combined stderr)\n")
+    print(f"{'case':<23}{'stderr':>8}{'rounding':>10}{'+/-':>7}{'/ stderr':>10}{'moved pairs':>13}{'shared gap':>12}"
+          f"{'FV float64':>13}{'FV float32':>13}{'gap z':>7}{'time 64 / 32':>15}{'block MB 64 / 32':>18}  result")
+    all_passed = True
+    for name, params, product_type, cp, scheme in cases:
+        with PricingPool(params, product_type) as pool:
+            check = check_float32_accuracy(cp, params, product_type, seed, scheme, pool)
+        fv64, fv32 = check['fv64'], check['fv32']
+        all_passed = all_passed and check['passed']
+        print(f"{name:<23}{check['stderr']:>8.2f}{check['difference']:>+10.3f}{check['difference_stderr']:>7.3f}"
+              f"{check['difference'] / check['stderr']:>+10.4f}{check['changed_pairs']:>13,}{check['shared_gap']:>+12.4f}"
+              f"{fv64.mean:>13,.2f}{fv32.mean:>13,.2f}{check['gap_z']:>+7.2f}"
+              f"{fv64.wall_time:>8.2f}{fv32.wall_time:>7.2f}"
+              f"{fv64.stats['peak_block_bytes'] / 2**20:>11.1f}{fv32.stats['peak_block_bytes'] / 2**20:>7.1f}"
+              f"  {'PASSED' if check['passed'] else 'FAILED'}")
+
+    print("\n==> float32 paths: " + ("all checks PASSED." if all_passed else "some checks FAILED, keep dtype='float64'."))
+    if not all_passed:
+        raise SystemExit(1)
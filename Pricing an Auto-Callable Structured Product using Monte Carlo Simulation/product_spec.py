@@ -0,0 +1,311 @@
+# F:\Learning_journal_at_CUHK\FTEC5610_Computational_Finance\Assignment\Assigenment2-3\product_spec.py
+# Products described as data: a term sheet is a dict (a "spec"), compiled into a vectorized payoff on the shared path generator.
+#
+# The autocall terms live in the engine code (T_EXPIRY, N_STEPS, the monthly coupons and the accrual rule in
+# payoff_components_block and the loop engine), and the worst-of Asian option of the option notebooks has its own
+# calculate_payoffs_vectorized. Here both are specs over one reference path X(t):
+#   'single'   X(t) = S(t) / S0                      (the engine's GBM paths, started at 1)
+#   'worst_of' X(t) = min_i S_i(t) / S0_i            (the correlated basket of worst_of.py)
+# so every level in a spec is a fraction of the initial price, as K0, KI and AC already are.
+#
+# Spec keys (a value given as a string is looked up in params, e.g. 'KI' -> params['KI']; dates are times in years):
+#   'expiry', 'steps'   the simulation grid: steps Euler steps up to expiry (a date t falls on step int(t / expiry * steps))
+#   'underlying'        'single' or 'worst_of'
+#   'notional'          amount the principal, the coupons and the redemption are paid on
+#   'knock_in'          {'level', 'dates'}: knocked in if X < level on one of the dates ('daily' = every step)
+#   'autocall'          {'level', 'dates', 'start'}: the product ends at the first date from start on where X >= level
+#                       (level may also be one value per date, e.g. a step-down schedule); it pays notional plus coupons
+#   'coupons'           {'dates', 'on_call'}: a coupon of notional * CP on every date to a product still alive, and
+#                       on_call 'accrued'          - a called product gets the coupon accrued since the last date only (the engine's rule)
+#                               'paid_and_accrued' - it also keeps the coupons of the dates before the call
+#   'redemption'        {'formula': name in REDEMPTIONS, other keys are its arguments}: paid at expiry to a product still alive
+# Coupons are linear in the coupon rate, so each path is priced as PV = A + CP * B and a CP solve is one pass.
+#
+#     fv = price_product(AUTOCALL_SPEC, hkd_params_prod, 'HKD', CP_guess=3.45, seed=42)      # = calculate_fair_value(...)
+#     spec = dict(AUTOCALL_SPEC, autocall=dict(AUTOCALL_SPEC['autocall'], level=[1.00, 0.98, 0.96, 0.94, 0.92, 0.90]))
+#     fv = price_product(spec, hkd_params_prod, 'HKD', CP_guess=3.45, seed=42)                  # a step-down autocall
+
+import numpy as np
+import multiprocessing
+import time
+
+from calculate_fair_value import (DEFAULT_BLOCK_PAIRS, T_EXPIRY, N_STEPS, PricingResult, get_rates, iter_normal_blocks,
+                                  simulate_paths_block)
+from worst_of import basket_cholesky, iter_basket_normal_blocks, simulate_worst_of_block
+
+UNDERLYINGS = ('single', 'worst_of')
+COUPON_RULES = ('accrued', 'paid_and_accrued')
+
+
+# Redemption formulas, per unit of notional, of the paths alive at expiry.
+# X is the (paths, N + 1) reference path, knocked_in the knock-in flags, args the resolved arguments of the spec.
+# A new formula is a function with this signature added to REDEMPTIONS.
+def redemption_par(X, knocked_in, args):
+    return np.ones(X.shape[0])
+
+
+# Refer to: principal NOM, or NOM * S_T / K if a knock-in event happened and S_T < K
+def redemption_knock_in_put(X, knocked_in, args):
+    X_T = X[:, -1]
+    return np.where(knocked_in & (X_T < args['strike']), X_T / args['strike'], 1.0)
+
+
+# The worst-of Asian put of the option notebooks: max(strike - average of X on the fixing dates, 0)
+def redemption_average_put(X, knocked_in, args):
+    return np.maximum(args['strike'] - np.mean(X[:, args['fixing_steps']], axis=1), 0.0)
+
+
+REDEMPTIONS = {'par': redemption_par, 'knock_in_put': redemption_knock_in_put, 'average_put': redemption_average_put}
+
+# The product of calculate_fair_value.py
+AUTOCALL_SPEC = {
+    'expiry': T_EXPIRY, 'steps': N_STEPS, 'underlying': 'single', 'notional': 'NOM',
+    'knock_in': {'level': 'KI', 'dates': 'daily'},
+    'autocall': {'level': 'AC', 'dates': 'daily', 'start': 'first_coupon'},
+    'coupons': {'dates': 'time_points', 'on_call': 'accrued'},
+    'redemption': {'formula': 'knock_in_put', 'strike': 'K0'},
+}
+
+# The same term sheet on the worst performer of a basket (the product of worst_of.py)
+WORST_OF_AUTOCALL_SPEC = dict(AUTOCALL_SPEC, underlying='worst_of')
+
+# The two-stock worst-of Asian put of the option notebooks: 1 - average of the worst performance at 0.5, 1 and 2 years
+WORST_OF_ASIAN_PUT_SPEC = {
+    'expiry': 2.0, 'steps': 200, 'underlying': 'worst_of', 'notional': 1.0,
+    'redemption': {'formula': 'average_put', 'strike': 1.0, 'fixing_dates': [0.5, 1.0, 2.0]},
+}
+
+
+# A spec value: a params key or a literal
+def resolve(value, params):
+    return params[value] if isinstance(value, str) else value
+
+
+# The steps of a list of dates ('daily' = every step 1..N)
+def date_steps(dates, params, expiry, N):
+    if isinstance(dates, str) and dates == 'daily':
+        return np.arange(1, N + 1)
+    # same conversion as build_step_schedule: coupon_times / T * N, truncated
+    return (np.asarray(resolve(dates, params), dtype=float) / expiry * N).astype(int)
+
+
+# Compile a spec for given params into a plan: the step indices, levels, discount factors and accruals the payoff needs,
+# and what the path generator needs (drift, volatility, Cholesky factor). The plan is plain data, so it is sent to the workers.
+def compile_product(spec, params, product_type='HKD'):
+    expiry, N = spec.get('expiry', T_EXPIRY), spec.get('steps', N_STEPS)
+    if spec.get('underlying', 'single') not in UNDERLYINGS:
+        raise ValueError(f"underlying must be one of {UNDERLYINGS}")
+    dt = expiry / N
+    r_g, r_disc = get_rates(params, product_type)
+    discount = np.exp(-r_disc * dt * np.arange(N + 1)) # discount factor of every step
+    plan = {'underlying': spec.get('underlying', 'single'), 'N': N, 'dt': dt, 'r_g': r_g,
+            'sigma': params['sigma_stock'], 'notional': resolve(spec['notional'], params), 'discount': discount}
+    if plan['underlying'] == 'worst_of':
+        plan['cholesky'] = basket_cholesky(params)
+    elif np.ndim(params['S0']) or np.ndim(params['sigma_stock']):
+        raise ValueError("a 'single' product needs a scalar S0 and sigma_stock, use 'worst_of' for a basket")
+
+    # Coupon schedule: every period runs from one coupon date (or 0) to the next; a called product accrues within its period
+    coupons = spec.get('coupons')
+    coupon_steps = date_steps(coupons['dates'], params, expiry, N) if coupons else np.array([], dtype=int)
+    if coupons:
+        if coupons.get('on_call', 'accrued') not in COUPON_RULES:
+            raise ValueError(f"on_call must be one of {COUPON_RULES}")
+        # Alive at expiry: the coupons of the dates before expiry plus the final coupon (alive_coupon_annuity)
+        plan['alive_annuity'] = np.sum(discount[coupon_steps[coupon_steps < N]]) + discount[N]
+    else:
+        plan['alive_annuity'] = 0.0
+
+    knock_in = spec.get('knock_in')
+    if knock_in:
+        plan['knock_in_steps'] = date_steps(knock_in['dates'], params, expiry, N)
+        plan['knock_in_level'] = resolve(knock_in['level'], params)
+
+    autocall = spec.get('autocall')
+    if autocall:
+        call_steps = date_steps(autocall['dates'], params, expiry, N)
+        call_level = np.asarray(resolve(autocall['level'], params), dtype=float)
+        start = autocall.get('start')
+        if start is not None:
+            # 'first_coupon' = the first auto-call date (Dc) is the first coupon date
+            start_step = coupon_steps[0] if start == 'first_coupon' else int(resolve(start, params) / expiry * N)
+            if call_level.ndim:
+                call_level = call_level[call_steps >= start_step]
+            call_steps = call_steps[call_steps >= start_step]
+        plan['call_steps'] = call_steps
+        plan['call_level'] = call_level
+
+        # Coupon leg of a call on every step: accrued coupon (and the coupons of the earlier dates for 'paid_and_accrued')
+        steps = np.arange(N + 1)
+        period_boundaries = np.union1d([0, N], coupon_steps).astype(int)
+        period_index = np.clip(np.searchsorted(period_boundaries, steps, side='left') - 1, 0, len(period_boundaries) - 2)
+        preceding = period_boundaries[period_index]
+        accrual_fraction = (steps - preceding) / (period_boundaries[period_index + 1] - preceding)
+        call_coupon = accrual_fraction * discount if coupons else np.zeros(N + 1)
+        if coupons and coupons.get('on_call', 'accrued') == 'paid_and_accrued':
+            paid_to_step = np.cumsum(np.bincount(coupon_steps, weights=discount[coupon_steps], minlength=N + 1))
+            call_coupon = call_coupon + paid_to_step[preceding]
+        plan['call_coupon'] = call_coupon
+
+    redemption = dict(spec.get('redemption', {'formula': 'par'}))
+    if redemption['formula'] not in REDEMPTIONS:
+        raise ValueError(f"redemption formula must be one of {tuple(REDEMPTIONS)}")
+    args = {key: resolve(value, params) for key, value in redemption.items() if key not in ('formula', 'fixing_dates')}
+    if 'fixing_dates' in redemption:
+        args['fixing_steps'] = date_steps(redemption['fixing_dates'], params, expiry, N)
+    plan['redemption'] = (redemption['formula'], args)
+    return plan
+
+
+# The payoff of a block of reference paths X (paths, N + 1), split as PV = principal_pv + CP_rate * coupon_annuity
+def product_payoff_block(plan, X):
+    notional = plan['notional']
+    discount = plan['discount']
+    N = plan['N']
+
+    knocked_in = np.zeros(X.shape[0], dtype=bool)
+    if 'knock_in_steps' in plan:
+        knocked_in = np.min(X[:, plan['knock_in_steps']], axis=1) < plan['knock_in_level']
+
+    formula, args = plan['redemption']
+    principal_pv = notional * discount[N] * REDEMPTIONS[formula](X, knocked_in, args)
+    coupon_annuity = np.full(X.shape[0], notional * plan['alive_annuity'])
+
+    if 'call_steps' in plan:
+        # First call date: argmax on a boolean mask returns the first True
+        call_mask = X[:, plan['call_steps']] >= plan['call_level']
+        terminated_early = call_mask.any(axis=1)
+        call_step = plan['call_steps'][np.argmax(call_mask, axis=1)]
+        principal_pv = np.where(terminated_early, notional * discount[call_step], principal_pv)
+        coupon_annuity = np.where(terminated_early, notional * plan['call_coupon'][call_step], coupon_annuity)
+    return principal_pv, coupon_annuity
+
+
+# The shared path generator: the reference paths of every block, as (X of Z, X of -Z) antithetic pairs
+# seed is required (price_product draws a fresh one in the parent when none is given)
+def iter_reference_path_pairs(plan, num_pairs, block_pairs, seed, first_block=0):
+    N, dt = plan['N'], plan['dt']
+    if plan['underlying'] == 'worst_of':
+        cholesky = plan['cholesky']
+        sigma = np.atleast_1d(plan['sigma'])[:, None]
+        r_g = np.broadcast_to(np.atleast_1d(plan['r_g'])[:, None], sigma.shape)
+        for Z in iter_basket_normal_blocks(num_pairs, cholesky.shape[0], block_pairs, seed, first_block, N):
+            W = cholesky @ Z
+            yield simulate_worst_of_block(W, r_g, sigma, dt), simulate_worst_of_block(-W, r_g, sigma, dt)
+    else:
+        for Z in iter_normal_blocks(num_pairs, block_pairs, seed, first_block, N):
+            yield simulate_paths_block(Z, 1.0, plan['r_g'], plan['sigma'], dt), simulate_paths_block(-Z, 1.0, plan['r_g'], plan['sigma'], dt)
+
+
+# Worker task: the running affine moments of the pair PVs of one block range (as run_simulation_chunk_vectorized)
+def run_product_chunk(args):
+    num_pairs, CP_rate, plan, seed, first_block, block_pairs = args
+    moments = {'sum': 0.0, 'sum_sq': 0.0, 'count': 0, 'a_sum': 0.0, 'b_sum': 0.0, 'a_sum_sq': 0.0, 'ab_sum': 0.0, 'b_sum_sq': 0.0}
+    for X_plus, X_minus in iter_reference_path_pairs(plan, num_pairs, block_pairs, seed, first_block):
+        a_plus, b_plus = product_payoff_block(plan, X_plus)
+        a_minus, b_minus = product_payoff_block(plan, X_minus)
+        a, b = 0.5 * (a_plus + a_minus), 0.5 * (b_plus + b_minus)
+        pair_pv = a + CP_rate * b
+        moments['sum'] += np.sum(pair_pv)
+        moments['sum_sq'] += np.sum(pair_pv ** 2)
+        moments['count'] += a.shape[0]
+        moments['a_sum'] += np.sum(a)
+        moments['b_sum'] += np.sum(b)
+        moments['a_sum_sq'] += np.sum(a ** 2)
+        moments['ab_sum'] += np.sum(a * b)
+        moments['b_sum_sq'] += np.sum(b ** 2)
+    return moments
+
+
+# Fair value of the product of a spec at coupon CP_guess (in %), on params['num_paths'] paths.
+# block_pairs defaults to DEFAULT_BLOCK_PAIRS divided by the number of underlyings. Returns a PricingResult;
+# its stats hold the moments and 'A', 'B' (PV = A + CP_rate * B on these paths).
+def price_product(spec, params, product_type='HKD', CP_guess=0.0, seed=None, num_cores=None, block_pairs=None):
+    start_time = time.time()
+    plan = compile_product(spec, params, product_type)
+    d = plan['cholesky'].shape[0] if 'cholesky' in plan else 1
+    block_pairs = block_pairs or max(1, DEFAULT_BLOCK_PAIRS // d)
+    num_cores = num_cores or multiprocessing.cpu_count()
+    if seed is None:
+        # A fresh seed for this call (as build_pricing_tasks): each block has its own stream, so the workers never repeat each other
+        seed = np.random.SeedSequence().entropy
+
+    # Whole blocks per task, so the seeded numbers do not depend on the number of cores
+    num_pairs = params['num_paths'] // 2
+    num_blocks = -(-num_pairs // block_pairs)
+    blocks_per_task = -(-num_blocks // num_cores)
+    args_list = []
+    for first_block in range(0, num_blocks, blocks_per_task):
+        pairs_to_run = min(blocks_per_task * block_pairs, num_pairs - first_block * block_pairs)
+        args_list.append((pairs_to_run, CP_guess / 100.0, plan, seed, first_block, block_pairs))
+
+    if len(args_list) == 1:
+        results = [run_product_chunk(args_list[0])]
+    else:
+        with multiprocessing.Pool(processes=len(args_list)) as pool:
+            results = pool.map(run_product_chunk, args_list)
+
+    stats = {key: sum(result[key] for result in results) for key in results[0]}
+    count = stats['count']
+    mean = stats['sum'] / count
+    stats['stderr'] = np.sqrt(max(stats['sum_sq'] / count - mean ** 2, 0.0) / count)
+    stats['A'] = stats['a_sum'] / count
+    stats['B'] = stats['b_sum'] / count
+    stats['block_pairs'] = block_pairs
+    stats['seed'] = seed
+    return PricingResult(mean, stats['stderr'], 2 * count, time.time() - start_time, stats)
+
+
+# Coupon (in %) that gives the target margin on params['NOM'], from one pass: PV = A + CP_rate * B on fixed paths
+def solve_product_cp(spec, params, product_type, target_margin, seed=None, num_cores=None):
+    fv = price_product(spec, params, product_type, 0.0, seed=seed, num_cores=num_cores)
+    if fv.stats['B'] == 0:
+        raise ValueError("the product pays no coupon, there is no CP to solve for")
+    target_fv = params['NOM'] * (1.0 - target_margin)
+    return 100.0 * (target_fv - fv.stats['A']) / fv.stats['B']
+
+
+if __name__ == "__main__":
+
+    from calculate_fair_value import calculate_fair_value
+    from worst_of import calculate_worst_of_fair_value
+    multiprocessing.freeze_support()
+
+    hkd_params_prod = {
+        'NOM': 100000.0, 'r_f': 0.0287, 'sigma_stock': 0.6039, 'S0': 11.08,
+        'time_points': np.array([1/12, 2/12, 3/12, 4/12, 5/12, 0.5]),
+        'num_paths': 300000,
+        'K0': 0.96, 'KI': 0.92, 'AC': 0.99
+    }
+    quanto_params_prod = dict(hkd_params_prod, r_d=0.0169, sigma_fx=0.074, rho=0.42)
+    seed = 20251017
+    CP1_VALUE = 3.458654
+
+    # 1. The spec of the engine's product gives the engine's prices (same seed, same paths)
+    for product_type, params in (('HKD', hkd_params_prod), ('Quanto', quanto_params_prod)):
+        engine = calculate_fair_value(CP1_VALUE, params, product_type, seed=seed)
+        spec_fv = price_product(AUTOCALL_SPEC, params, product_type, CP1_VALUE, seed=seed)
+        print(f"{product_type} engine: {engine.summary()}")
+        print(f"{product_type} spec:   {spec_fv.summary()}  (difference {float(spec_fv) - float(engine):.2e})")
+
+    # 2. The worst-of spec gives the prices of worst_of.py
+    basket_params = dict(hkd_params_prod, S0=np.array([11.08, 73.4]), sigma_stock=np.array([0.6039, 0.3481]),
+                         correlation=np.array([[1.0, 0.5456], [0.5456, 1.0]]))
+    basket = calculate_worst_of_fair_value(CP1_VALUE, basket_params, 'HKD', seed=seed)
+    spec_fv = price_product(WORST_OF_AUTOCALL_SPEC, basket_params, 'HKD', CP1_VALUE, seed=seed)
+    print(f"\nWorst-of engine: {basket.summary()}")
+    print(f"Worst-of spec:   {spec_fv.summary()}  (difference {float(spec_fv) - float(basket):.2e})")
+
+    # 3. The worst-of Asian put of the option notebooks (about 23.13% there, 300,000 paths)
+    asian_params = {'r_f': 0.0325, 'S0': np.array([11.08, 73.4]), 'sigma_stock': np.array([0.6039, 0.3481]),
+                    'correlation': np.array([[1.0, 0.5456], [0.5456, 1.0]]), 'num_paths': 300000}
+    asian = price_product(WORST_OF_ASIAN_PUT_SPEC, asian_params, 'HKD', seed=seed)
+    print(f"\nWorst-of Asian put: {100 * asian.mean:.4f}% +/- {100 * asian.stderr:.4f}% of the notional, {asian.wall_time:.2f} s")
+
+    # 4. New term sheets from the spec alone: the CP of a 1.2% margin
+    step_down = dict(AUTOCALL_SPEC, autocall=dict(AUTOCALL_SPEC['autocall'], dates=[1/12, 2/12, 3/12, 4/12, 5/12, 0.5],
+                                                  level=[1.00, 0.98, 0.96, 0.94, 0.92, 0.90]))
+    memory_coupons = dict(AUTOCALL_SPEC, coupons=dict(AUTOCALL_SPEC['coupons'], on_call='paid_and_accrued'))
+    for name, spec in (('Q1 term sheet', AUTOCALL_SPEC), ('monthly step-down auto-call', step_down),
+                       ('coupons kept on call', memory_coupons)):
+        print(f"{name:<28} CP for a 1.2% margin = {solve_product_cp(spec, hkd_params_prod, 'HKD', 0.012, seed=seed):.4f}%")
@@ -0,0 +1,75 @@
+# F:\Learning_journal_at_CUHK\FTEC5610_Computational_Finance\Assignment\Assigenment2-3\qmc_sampler.py
+# Randomized Quasi-Monte Carlo normals: scrambled Sobol points with Brownian-bridge path construction.
+#
+# A Sobol sequence fills the unit cube far more evenly than pseudo-random numbers, but only its first dimensions are really even.
+# With the Brownian bridge the first Sobol dimension builds the terminal value W(T), the next ones the mid-points
+# W(T/2), W(T/4), W(3T/4), ..., so the few dimensions that decide most of the payoff get the best Sobol coordinates.
+# The output is the usual (num_pairs, N) block of standard normal increments, so every engine and scheme can use it unchanged.
+#
+# Randomized QMC: each replicate is an independently scrambled Sobol sequence. The replicate means are i.i.d. and unbiased,
+# so their spread gives the error estimate of the QMC price (a single Sobol run has no usable error estimate).
+
+import numpy as np
+from scipy.stats import qmc
+from scipy.special import ndtri # inverse of the standard normal CDF
+
+# Number of independently scrambled Sobol sequences of a sampler='sobol' run
+DEFAULT_QMC_REPLICATES = 16
+
+# Keep the uniforms away from 0 and 1, where the inverse normal CDF is infinite
+_UNIFORM_EPS = 2.0 ** -53
+
+
+# Order in which a Brownian bridge builds the path on the times t_1 < ... < t_N (t_0 = 0, W(0) = 0).
+# Returns a list of (index, left_index, right_index, left_weight, right_weight, std):
+#     W[index] = left_weight * W[left_index] + right_weight * W[right_index] + std * X
+# The first entry is the terminal point (left_index = 0, left_weight = 0), then the mid-points level by level.
+def brownian_bridge_plan(times):
+    t = np.concatenate([[0.0], np.asarray(times, dtype=float)])
+    N = len(times)
+    plan = [(N, 0, N, 0.0, 0.0, np.sqrt(t[N]))]
+    intervals = [(0, N)]
+    while intervals:
+        left, right = intervals.pop(0)
+        if right - left < 2:
+            continue
+        middle = (left + right) // 2
+        span = t[right] - t[left]
+        plan.append((middle, left, right, (t[right] - t[middle]) / span, (t[middle] - t[left]) / span,
+                     np.sqrt((t[middle] - t[left]) * (t[right] - t[middle]) / span)))
+        intervals.append((left, middle))
+        intervals.append((middle, right))
+    return plan
+
+
+# Turn i.i.d. normals X (num_points, N), in order of importance, into the standardized increments of a Brownian path:
+# Z[:, i] = (W(t_{i+1}) - W(t_i)) / sqrt(t_{i+1} - t_i), i.e. the shocks the engines expect
+def brownian_bridge_increments(X, times):
+    t = np.concatenate([[0.0], np.asarray(times, dtype=float)])
+    W = np.zeros((X.shape[0], len(t)))
+    for column, (index, left, right, left_weight, right_weight, std) in enumerate(brownian_bridge_plan(times)):
+        W[:, index] = left_weight * W[:, left] + right_weight * W[:, right] + std * X[:, column]
+    return np.diff(W, axis=1) / np.sqrt(np.diff(t))
+
+
+# The bridge is linear, so it is one (N, N) matrix: Z = X @ brownian_bridge_matrix(times).
+# The matrix is orthogonal (the increments are again i.i.d. N(0, 1)), and one matrix product is much faster than the column loop.
+def brownian_bridge_matrix(times):
+    return brownian_bridge_increments(np.eye(len(times)), times)
+
+
+# Yield the normals of num_pairs points of replicate `replicate`, one (pairs_in_block, N) array per block.
+# The scramble of a replicate is spawned from the seed by its index, so a (seed, replicate) always gives the same points.
+# Sobol points are best balanced in blocks of 2^m points, so block_pairs (and the pairs of a replicate) should be powers of 2.
+# first_pair skips the first points of the sequence, so a replicate can be extended batch by batch.
+def iter_sobol_normal_blocks(num_pairs, block_pairs, seed, replicate, times, first_pair=0):
+    sobol = qmc.Sobol(d=len(times), scramble=True, seed=np.random.default_rng(np.random.SeedSequence(seed, spawn_key=(replicate,))))
+    if first_pair:
+        sobol.fast_forward(first_pair)
+    bridge_matrix = brownian_bridge_matrix(times)
+    pairs_done = 0
+    while pairs_done < num_pairs:
+        pairs_in_block = min(block_pairs, num_pairs - pairs_done)
+        U = np.clip(sobol.random(pairs_in_block), _UNIFORM_EPS, 1.0 - _UNIFORM_EPS)
+        yield ndtri(U) @ bridge_matrix
+        pairs_done += pairs_in_block
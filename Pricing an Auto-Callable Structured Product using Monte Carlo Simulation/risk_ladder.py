@@ -0,0 +1,163 @@
+# F:\Learning_journal_at_CUHK\FTEC5610_Computational_Finance\Assignment\Assigenment2-3\risk_ladder.py
+# Bump-and-revalue risk: the autocall repriced under a list of market bumps, on the normals of the base scenario.
+#
+# One calculate_fair_value call per bump starts its own workers and draws its own numbers, so the change of the price
+# is buried in the noise of two independent estimates. Here every worker draws each block of normals once and prices the base
+# scenario and every bump on it (common random numbers):
+#   - the paths of a scenario are S0 times the unit path of its drift and volatility, so the unit paths are simulated once per
+#     (r_g, sigma) and reused by every bump that keeps them (spot, r_d, and r_f / rho / sigma_fx bumps that leave r_g alone)
+#   - the change against the base is accumulated pair by pair, so each rung of the ladder carries the standard error of the
+#     change itself, much smaller than the standard error of either price
+# A spot bump keeps the barriers and the strike where they are in HKD (K0, KI and AC are rescaled to the bumped spot).
+# With a seed each scenario's fair value equals calculate_fair_value(..., seed=seed) at the bumped parameters.
+#
+#     ladder = risk_ladder(3.458654, hkd_params_prod, 'HKD', seed=42)
+#     print(format_ladder(ladder))
+#     risk_ladder(3.26, quanto_params_prod, 'Quanto', bumps=[('sigma_fx', 0.01), ('rho', -0.1)], seed=42)
+
+import numpy as np
+import multiprocessing
+import time
+
+from calculate_fair_value import (DEFAULT_BLOCK_PAIRS, T_EXPIRY, N_STEPS, get_rates, iter_normal_blocks, payoff_components_block,
+                                  simulate_paths_block)
+
+# Market factors a bump can move. S0 bumps are relative (0.01 = spot up 1%), the others absolute (0.01 = +1 vol point / +100 bp).
+RISK_FACTORS = ('S0', 'sigma_stock', 'r_f', 'r_d', 'rho', 'sigma_fx')
+
+# Default ladder per product: (factor, bump) pairs. The HKD price does not depend on r_d, rho or sigma_fx.
+DEFAULT_BUMPS = {
+    'HKD': [('S0', size) for size in (-0.10, -0.05, -0.01, 0.01, 0.05, 0.10)]
+           + [('sigma_stock', size) for size in (-0.05, -0.01, 0.01, 0.05)]
+           + [('r_f', size) for size in (-0.001, 0.001)],
+}
+DEFAULT_BUMPS['Quanto'] = (DEFAULT_BUMPS['HKD'] + [('r_d', size) for size in (-0.001, 0.001)]
+                           + [('rho', size) for size in (-0.1, 0.1)] + [('sigma_fx', size) for size in (-0.01, 0.01)])
+
+
+# The parameters of one bump
+def bump_params(params, factor, size):
+    if factor not in RISK_FACTORS:
+        raise ValueError(f"factor must be one of {RISK_FACTORS}")
+    if factor == 'S0':
+        S0 = params['S0']
+        spot = S0 * (1.0 + size)
+        return dict(params, S0=spot, K0=params['K0'] * S0 / spot, KI=params['KI'] * S0 / spot, AC=params['AC'] * S0 / spot)
+    return dict(params, **{factor: params[factor] + size})
+
+
+# Worker task: price the base scenario and every bump on the same blocks of normals.
+# scenarios is a list of (S0, r_g, sigma, r_disc, params), the base first. Returns one dict of moments per scenario:
+# count, sum, sum_sq of the pair PVs and change_sum, change_sum_sq of (pair PV - base pair PV).
+def run_risk_chunk(args):
+    num_pairs, CP_rate, seed, first_block, block_pairs, scenarios = args
+    dt = T_EXPIRY / N_STEPS
+    moments = [{'count': 0, 'sum': 0.0, 'sum_sq': 0.0, 'change_sum': 0.0, 'change_sum_sq': 0.0} for _ in scenarios]
+
+    for Z in iter_normal_blocks(num_pairs, block_pairs, seed, first_block, N_STEPS):
+        pair_pv = [0.0] * len(scenarios)
+        for z_block in (Z, -Z): # antithetic pair
+            unit_paths = {} # (r_g, sigma) -> paths started at 1, shared by the scenarios with that drift and volatility
+            for index, (S0, r_g, sigma, r_disc, params) in enumerate(scenarios):
+                if (r_g, sigma) not in unit_paths:
+                    unit_paths[(r_g, sigma)] = simulate_paths_block(z_block, 1.0, r_g, sigma, dt)
+                principal_pv, coupon_annuity = payoff_components_block(S0 * unit_paths[(r_g, sigma)], r_disc, params)
+                pair_pv[index] = pair_pv[index] + 0.5 * (principal_pv + CP_rate * coupon_annuity)
+
+        for moment, pv in zip(moments, pair_pv):
+            change = pv - pair_pv[0]
+            moment['count'] += Z.shape[0]
+            moment['sum'] += np.sum(pv)
+            moment['sum_sq'] += np.sum(pv ** 2)
+            moment['change_sum'] += np.sum(change)
+            moment['change_sum_sq'] += np.sum(change ** 2)
+    return moments
+
+
+# Reprice the autocall under every bump in one job. bumps is a list of (factor, bump) pairs (default DEFAULT_BUMPS[product_type]).
+# All bumps of a block range run in the same worker on the same normals; seed is the CRN seed (drawn if not given).
+# Returns the ladder: one row (dict) for the base and one per bump, in order:
+#   factor, bump, fair_value, stderr, change (against the base, HKD), change_stderr, sensitivity (change / bump)
+def risk_ladder(CP_guess, params, product_type='HKD', bumps=None, seed=None, num_cores=None, block_pairs=DEFAULT_BLOCK_PAIRS):
+    if bumps is None:
+        bumps = DEFAULT_BUMPS[product_type]
+    if seed is None:
+        seed = np.random.SeedSequence().entropy
+    num_cores = num_cores or multiprocessing.cpu_count()
+
+    scenarios = []
+    for factor, size in [(None, 0.0)] + list(bumps):
+        scenario_params = params if factor is None else bump_params(params, factor, size)
+        r_g, r_disc = get_rates(scenario_params, product_type)
+        scenarios.append((scenario_params['S0'], r_g, scenario_params['sigma_stock'], r_disc, scenario_params))
+
+    # Split the blocks over the workers, every task carries all the scenarios
+    num_pairs = params['num_paths'] // 2
+    num_blocks = -(-num_pairs // block_pairs)
+    blocks_per_task = -(-num_blocks // num_cores)
+    tasks = []
+    for first_block in range(0, num_blocks, blocks_per_task):
+        pairs_to_run = min(blocks_per_task * block_pairs, num_pairs - first_block * block_pairs)
+        tasks.append((pairs_to_run, CP_guess / 100.0, seed, first_block, block_pairs, scenarios))
+
+    with multiprocessing.Pool(processes=min(num_cores, len(tasks))) as pool:
+        results = pool.map(run_risk_chunk, tasks)
+
+    totals = [dict.fromkeys(moment, 0.0) for moment in results[0]]
+    for task_moments in results:
+        for total, moment in zip(totals, task_moments):
+            for name, value in moment.items():
+                total[name] += value
+
+    rows = []
+    for (factor, size), total in zip([(None, 0.0)] + list(bumps), totals):
+        count = total['count']
+        fair_value = total['sum'] / count
+        change = total['change_sum'] / count
+        row = {'factor': factor or 'base', 'bump': size, 'fair_value': fair_value,
+               'stderr': np.sqrt(max(total['sum_sq'] / count - fair_value ** 2, 0.0) / count),
+               'change': change, 'change_stderr': np.sqrt(max(total['change_sum_sq'] / count - change ** 2, 0.0) / count)}
+        row['sensitivity'] = change / size if size else 0.0
+        rows.append(row)
+    return rows
+
+
+# Plain-text table of a risk ladder
+def format_ladder(rows):
+    header = f"{'factor':<13}{'bump':>9}{'fair value':>14}{'stderr':>9}{'change':>12}{'stderr':>9}{'change / bump':>16}"
+    lines = [header, "-" * len(header)]
+    for row in rows:
+        bump = f"{100.0 * row['bump']:+.1f}%" if row['factor'] == 'S0' else f"{row['bump']:+.3f}"
+        lines.append(f"{row['factor']:<13}{bump:>9}{row['fair_value']:>14,.2f}{row['stderr']:>9,.2f}"
+                     f"{row['change']:>12,.2f}{row['change_stderr']:>9,.2f}{row['sensitivity']:>16,.1f}")
+    return "\n".join(lines)
+
+
+if __name__ == "__main__":
+
+    from calculate_fair_value import calculate_fair_value
+    multiprocessing.freeze_support()
+
+    hkd_params_prod = {
+        'NOM': 100000.0, 'r_f': 0.0287, 'sigma_stock': 0.6039, 'S0': 11.08,
+        'time_points': np.array([1/12, 2/12, 3/12, 4/12, 5/12, 0.5]),
+        'num_paths': 300000,
+        'K0': 0.96, 'KI': 0.92, 'AC': 0.99
+    }
+    quanto_params_prod = dict(hkd_params_prod, r_d=0.0169, sigma_fx=0.074, rho=0.42)
+    seed = 20251017
+
+    for product_type, params, cp in (('HKD', hkd_params_prod, 3.458654), ('Quanto', quanto_params_prod, 3.26)):
+        bumps = DEFAULT_BUMPS[product_type]
+        start_time = time.time()
+        ladder = risk_ladder(cp, params, product_type, seed=seed)
+        ladder_time = time.time() - start_time
+        print(f"--- {product_type} risk ladder at CP = {cp}%: {len(bumps)} bumps in {ladder_time:.2f} s ---")
+        print(format_ladder(ladder))
+
+        # The same bumps as separate calculate_fair_value calls (same seed, so the same numbers)
+        start_time = time.time()
+        separate = [calculate_fair_value(cp, params if factor is None else bump_params(params, factor, size), product_type, seed=seed)
+                    for factor, size in [(None, 0.0)] + bumps]
+        largest_gap = max(abs(row['fair_value'] - float(fv)) for row, fv in zip(ladder, separate))
+        print(f"Separate calculate_fair_value calls: {time.time() - start_time:.2f} s, largest difference {largest_gap:.2e} HKD\n")
@@ -9,7 +9,8 @@ import copy
 
 # --- 1. 导入您的 *加速版* 核心定价函数 ---
 try:
-    from calculate_fair_value import calculate_fair_value
+    from calculate_fair_value import calculate_fair_value, PricingPool
+    from telemetry import profiled_solve, record_solver_step # JSONL 记录 / 性能分析, 由环境变量开启
     print("成功导入 'calculate_fair_value' (V3-并行版)。\n")
 except ImportError:
     print("="*50)
@@ -36,7 +37,7 @@ TARGET_FV = hkd_params_prod['NOM'] * (1.0 - TARGET_MARGIN) # 98,800.00
 
 # --- 3. 定义通用的目标函数 (Q2 专用) ---
 
-def generic_objective_function(param_guess, param_name_to_solve, base_params, fixed_cp, target_fv):
+def generic_objective_function(param_guess, param_name_to_solve, base_params, fixed_cp, target_fv, seed=None, pool=None):
     """
     通用的目标函数, 用于求解 K0, KI, 或 AC。
     """
@@ -47,12 +48,15 @@ def generic_objective_function(param_guess, param_name_to_solve, base_params, fi
     current_fv = calculate_fair_value(
         CP_guess=fixed_cp, 
         params=temp_params, 
-        product_type='HKD'
+        product_type='HKD',
+        seed=seed,
+        pool=pool
     )
     
     error = current_fv - target_fv
     
     print(f"  [Solver Step: {param_name_to_solve}] 猜想 {param_name_to_solve} = {param_guess: .6f} -> FV: {current_fv/temp_params['NOM'] * 100.0: .4f}% -> 误差: {error: .2f}")
+    record_solver_step('solve_param', param_name_to_solve, param_guess, current_fv, error, cp=fixed_cp, target_fv=target_fv, seed=seed)
     
     return error
 
@@ -72,48 +76,54 @@ if __name__ == "__main__":
     # 定义基础参数 (Q1的原始值)
     base_params = hkd_params_prod
     
-    # --- 练习 A: 求解 K0 (已跳过) ---
-    print("\n" + "="*50)
-    print(f"练习 A: 求解 K0 (已跳过)")
-    print("="*50)
-    found_K0 = None # 跳过
+    # 公共随机数 (CRN): 每个猜想都在同一组路径上定价
+    CRN_SEED = np.random.SeedSequence().entropy
+    print(f"CRN 种子: {CRN_SEED}")
+    # 所有猜想共用一个进程池 (with 块结束时关闭进程, 求解出错时也会关闭)
+    with PricingPool(base_params, 'HKD') as pricing_pool:
+        # --- 练习 A: 求解 K0 (已跳过) ---
+        print("\n" + "="*50)
+        print(f"练习 A: 求解 K0 (已跳过)")
+        print("="*50)
+        found_K0 = None # 跳过
 
-    # --- 练习 B: 求解 KI ---
-    # 固定: CP=CP_new, K0=0.96, AC=0.99
-    # 求解: KI
-    print("\n" + "="*50)
-    print(f"练习 B: 求解 KI (保持 K0=0.96, AC=0.99)")
+        # --- 练习 B: 求解 KI ---
+        # 固定: CP=CP_new, K0=0.96, AC=0.99
+        # 求解: KI
+        print("\n" + "="*50)
+        print(f"练习 B: 求解 KI (保持 K0=0.96, AC=0.99)")
     
-    # **** 错误修复: 激进地扩大搜索区间的下界 ****
-    # 之前 [0.70, 0.92] 区间两端的 FV 都低于目标值
-    # 这意味着 KI 必须降到 0.70 以下才能让 FV 升过 98.80%
-    # 我们将下界从 0.70 扩大到 0.50
-    new_lower_bound = 0.50
-    print(f"搜索区间: [{new_lower_bound:.2f}, {base_params['KI']:.2f}]") 
-    print("="*50)
+        # **** 错误修复: 激进地扩大搜索区间的下界 ****
+        # 之前 [0.70, 0.92] 区间两端的 FV 都低于目标值
+        # 这意味着 KI 必须降到 0.70 以下才能让 FV 升过 98.80%
+        # 我们将下界从 0.70 扩大到 0.50
+        new_lower_bound = 0.50
+        print(f"搜索区间: [{new_lower_bound:.2f}, {base_params['KI']:.2f}]") 
+        print("="*50)
     
-    start_time = time.time()
-    try:
-        found_KI = brentq(
-            generic_objective_function,
-            a=new_lower_bound, # 使用新的、激进的下界
-            b=base_params['KI'], # 原始值作为上界
-            args=('KI', base_params, CP_NEW, TARGET_FV),
-            xtol=1e-6
-        )
-        print(f"--- 练习 B 完成 (用时: {time.time() - start_time:.2f}s) ---")
-        print(f"==> 找到的新 KI: {found_KI:.6f} (原始值: {base_params['KI']})")
-        print(f"==> 变化量: {found_KI - base_params['KI']:.6f}")
-    except ValueError as e:
-        print(f"--- 练习 B 求解失败: {e} ---")
-        print(f"--- 即使在 [{new_lower_bound}, {base_params['KI']}] 区间也失败了。---")
-        found_KI = None
+        start_time = time.time()
+        try:
+            with profiled_solve("solve_param-KI"): # AUTOCALL_PROFILE=<文件> 时对本次求解做性能分析 (见 telemetry.py)
+                found_KI = brentq(
+                    generic_objective_function,
+                    a=new_lower_bound, # 使用新的、激进的下界
+                    b=base_params['KI'], # 原始值作为上界
+                    args=('KI', base_params, CP_NEW, TARGET_FV, CRN_SEED, pricing_pool),
+                    xtol=1e-6
+                )
+            print(f"--- 练习 B 完成 (用时: {time.time() - start_time:.2f}s) ---")
+            print(f"==> 找到的新 KI: {found_KI:.6f} (原始值: {base_params['KI']})")
+            print(f"==> 变化量: {found_KI - base_params['KI']:.6f}")
+        except ValueError as e:
+            print(f"--- 练习 B 求解失败: {e} ---")
+            print(f"--- 即使在 [{new_lower_bound}, {base_params['KI']}] 区间也失败了。---")
+            found_KI = None
 
-    # --- 练习 C: 求解 AC (已跳过) ---
-    print("\n" + "="*50)
-    print(f"练习 C: 求解 AC (已跳过)")
-    print("="*50)
-    found_AC = None # 跳过
+        # --- 练习 C: 求解 AC (已跳过) ---
+        print("\n" + "="*50)
+        print(f"练习 C: 求解 AC (已跳过)")
+        print("="*50)
+        found_AC = None # 跳过
 
     # --- 最终总结 ---
     print("\n" + "="*60)
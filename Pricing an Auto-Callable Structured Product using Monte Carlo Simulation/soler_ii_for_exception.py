@@ -8,7 +8,8 @@ import multiprocessing
 import copy 
 
 try:
-    from calculate_fair_value import calculate_fair_value
+    from calculate_fair_value import calculate_fair_value, PricingPool
+    from telemetry import profiled_solve, record_solver_step # JSONL records / profiler, switched on by the environment
 except ImportError:
     print("Error: Could not import 'calculate_fair_value' function.")
     exit()
@@ -31,7 +32,7 @@ TARGET_FV = hkd_params_prod['NOM'] * (1.0 - TARGET_MARGIN) # 98,800.00
 
 # --- 3. Define the generic objective function (Q2 specific) ---
 
-def generic_objective_function(param_guess, param_name_to_solve, base_params, fixed_cp, target_fv):
+def generic_objective_function(param_guess, param_name_to_solve, base_params, fixed_cp, target_fv, seed=None, pool=None):
     """
     Generic objective function, used to solve for K0, KI, or AC.
     """
@@ -42,12 +43,15 @@ def generic_objective_function(param_guess, param_name_to_solve, base_params, fi
     current_fv = calculate_fair_value(
         CP_guess=fixed_cp, 
         params=temp_params, 
-        product_type='HKD'
+        product_type='HKD',
+        seed=seed,
+        pool=pool
     )
     
     error = current_fv - target_fv
     
     print(f"  [Solver Step: {param_name_to_solve}] Guess {param_name_to_solve} = {param_guess: .6f} -> FV: {current_fv/temp_params['NOM'] * 100.0: .4f}% -> Error: {error: .2f}")
+    record_solver_step('solve_param', param_name_to_solve, param_guess, current_fv, error, cp=fixed_cp, target_fv=target_fv, seed=seed)
     
     return error
 
@@ -67,48 +71,54 @@ if __name__ == "__main__":
     # Define base parameters (Q1 original values)
     base_params = hkd_params_prod
     
-    # --- Exercise A: Solve for K0 (Skipped) ---
-    print("\n" + "="*50)
-    print(f"Exercise A: Solving for K0 (Skipped)")
-    print("="*50)
-    found_K0 = None # Skipped
+    # Common Random Numbers: every guess is priced on the same paths
+    CRN_SEED = np.random.SeedSequence().entropy
+    print(f"CRN Seed: {CRN_SEED}")
+    # One pool of workers for every guess (the with-block stops the workers, also when the solve raises)
+    with PricingPool(base_params, 'HKD') as pricing_pool:
+        # --- Exercise A: Solve for K0 (Skipped) ---
+        print("\n" + "="*50)
+        print(f"Exercise A: Solving for K0 (Skipped)")
+        print("="*50)
+        found_K0 = None # Skipped
 
-    # --- Exercise B: Solve for KI ---
-    # Fixed: CP=CP_new, K0=0.96, AC=0.99
-    # Solve: KI
-    print("\n" + "="*50)
-    print(f"Exercise B: Solving for KI (Keep K0=0.96, AC=0.99)")
+        # --- Exercise B: Solve for KI ---
+        # Fixed: CP=CP_new, K0=0.96, AC=0.99
+        # Solve: KI
+        print("\n" + "="*50)
+        print(f"Exercise B: Solving for KI (Keep K0=0.96, AC=0.99)")
     
-    # **** Bug Fix: Aggressively expand the lower bound of the search range ****
-    # Previously, the FVs at both ends of the [0.70, 0.92] range were below the target
-    # This means KI must drop below 0.70 for the FV to rise above 98.80%
-    # We are expanding the lower bound from 0.70 to 0.50
-    new_lower_bound = 0.50
-    print(f"Search Range: [{new_lower_bound:.2f}, {base_params['KI']:.2f}]") 
-    print("="*50)
+        # **** Bug Fix: Aggressively expand the lower bound of the search range ****
+        # Previously, the FVs at both ends of the [0.70, 0.92] range were below the target
+        # This means KI must drop below 0.70 for the FV to rise above 98.80%
+        # We are expanding the lower bound from 0.70 to 0.50
+        new_lower_bound = 0.50
+        print(f"Search Range: [{new_lower_bound:.2f}, {base_params['KI']:.2f}]") 
+        print("="*50)
     
-    start_time = time.time()
-    try:
-        found_KI = brentq(
-            generic_objective_function,
-            a=new_lower_bound, # Use the new, aggressive lower bound
-            b=base_params['KI'], # Original value as upper bound
-            args=('KI', base_params, CP_NEW, TARGET_FV),
-            xtol=1e-6
-        )
-        print(f"--- Exercise B Finished (Time: {time.time() - start_time:.2f}s) ---")
-        print(f"==> Found new KI: {found_KI:.6f} (Original: {base_params['KI']})")
-        print(f"==> Change: {found_KI - base_params['KI']:.6f}")
-    except ValueError as e:
-        print(f"--- Exercise B Solver FAILED: {e} ---")
-        print(f"--- Failed even in the [{new_lower_bound}, {base_params['KI']}] range. ---")
-        found_KI = None
+        start_time = time.time()
+        try:
+            with profiled_solve("solve_param-KI"): # AUTOCALL_PROFILE=<file> profiles this solve (see telemetry.py)
+                found_KI = brentq(
+                    generic_objective_function,
+                    a=new_lower_bound, # Use the new, aggressive lower bound
+                    b=base_params['KI'], # Original value as upper bound
+                    args=('KI', base_params, CP_NEW, TARGET_FV, CRN_SEED, pricing_pool),
+                    xtol=1e-6
+                )
+            print(f"--- Exercise B Finished (Time: {time.time() - start_time:.2f}s) ---")
+            print(f"==> Found new KI: {found_KI:.6f} (Original: {base_params['KI']})")
+            print(f"==> Change: {found_KI - base_params['KI']:.6f}")
+        except ValueError as e:
+            print(f"--- Exercise B Solver FAILED: {e} ---")
+            print(f"--- Failed even in the [{new_lower_bound}, {base_params['KI']}] range. ---")
+            found_KI = None
 
-    # --- Exercise C: Solve for AC (Skipped) ---
-    print("\n" + "="*50)
-    print(f"Exercise C: Solving for AC (Skipped)")
-    print("="*50)
-    found_AC = None # Skipped
+        # --- Exercise C: Solve for AC (Skipped) ---
+        print("\n" + "="*50)
+        print(f"Exercise C: Solving for AC (Skipped)")
+        print("="*50)
+        found_AC = None # Skipped
 
     # --- Final Summary ---
     print("\n" + "="*60)
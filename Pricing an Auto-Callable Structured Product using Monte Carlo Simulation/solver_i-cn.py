@@ -3,12 +3,13 @@
 
 import numpy as np
 import time
-from scipy.optimize import brentq 
+from scipy.optimize import brentq
 import multiprocessing # <--- **** 错误修复: 添加这一行 ****
 
 # --- 1. 导入您的 *加速版* 核心定价函数 ---
 try:
-    from calculate_fair_value import calculate_fair_value
+    from calculate_fair_value import calculate_fair_value, solve_cp_direct, PricingPool
+    from telemetry import profiled_solve, record_solver_step # JSONL 记录 / 性能分析, 由环境变量开启
     print("成功导入 'calculate_fair_value' (V3-并行版)。\n")
 except ImportError:
     print("="*50)
@@ -35,38 +36,59 @@ quanto_params_prod = {
     'sigma_fx': 0.074, 'rho': 0.42
 }
 
+# 'direct': 只模拟一次, PV = A + CP * B 对 CP 是仿射的, 两个利润率都用 CP = (target - A) / B 直接求出
+# 'brentq': 原来的求根方法, 每个猜想都完整定价一次
+# 'progressive': 考虑噪声的求根方法, 区间较宽时用少量路径, 只在根附近使用 num_paths
+SOLVE_METHOD = 'direct'
+
+# 渐进求解: 第一阶段至少使用这么多条路径, 之后每个阶段是上一阶段的 PROGRESSIVE_GROWTH 倍
+PROGRESSIVE_MIN_PATHS = 10000
+PROGRESSIVE_GROWTH = 4
+
 
 # --- 3. 定义求解器所需的目标函数 ---
 
-def objective_function(cp_guess, params, product_type, target_fv):
+def objective_function(cp_guess, params, product_type, target_fv, seed=None, pool=None):
     """
     这是 brentq 求解器要优化的函数。
     它计算: Fair_Value(cp_guess) - Target_Fair_Value
+    seed: 本次求解的公共随机数 (CRN) 种子, 每个猜想都在同一组路径上定价
+    pool: 可选的 PricingPool, 每个猜想都复用它的进程
     """
-    
+
     # 调用您的核心定价引擎 (V3 并行版)
     current_fv = calculate_fair_value(
-        CP_guess=cp_guess, 
-        params=params, 
-        product_type=product_type
+        CP_guess=cp_guess,
+        params=params,
+        product_type=product_type,
+        seed=seed, # 每个猜想使用相同的随机数, 目标函数对 CP 是确定的
+        pool=pool
     )
-    
+
     error = current_fv - target_fv
-    
+
     print(f"  [Solver Step] 猜想 CP: {cp_guess: .6f}% -> FV: {current_fv/params['NOM'] * 100.0: .4f}% -> 误差: {error/params['NOM'] * 100.0: .4f}%")
-    
+    record_solver_step('solve_for_cp', 'CP', cp_guess, current_fv, error, product_type=product_type, target_fv=target_fv, seed=seed)
+
     return error
 
 # --- 4. 主求解器函数 ---
-def solve_for_cp(params, product_type, target_margin, cp_min_guess=0.01, cp_max_guess=10.0):
+def solve_for_cp(params, product_type, target_margin, cp_min_guess=0.01, cp_max_guess=10.0, seed=None, pool=None, return_info=False):
     """
     一个完整的求解器函数，用于寻找 CP。
     我们将搜索区间扩大到 10.0%, 因为高波动性可能需要高票息。
+    seed: 公共随机数 (CRN) 种子, 未给出时为本次求解生成一个新种子
+    pool: 可选的 PricingPool, 所有猜想 (以及多次求解) 共用
+    return_info: 同时返回一个字典, 包含定价次数、模拟的总路径数和求解用时
     """
-    
+
+    # 每次求解只固定一次随机数, 所有猜想重复使用
+    if seed is None:
+        seed = np.random.SeedSequence().entropy
+
     target_fv_pct = 1.0 - target_margin
     target_fv = params['NOM'] * target_fv_pct
-    
+
     print("\n" + "="*50)
     print(f"--- 正在启动求解器 (生产模式) ---")
     print(f"目标利润率: {target_margin*100: .2f}%")
@@ -74,26 +96,35 @@ def solve_for_cp(params, product_type, target_margin, cp_min_guess=0.01, cp_max_
     print(f"产品类型: {product_type}")
     print(f"蒙特卡洛路径: {params['num_paths']} (已启用并行 + 对偶变量)")
     print(f"CP 搜索区间: [{cp_min_guess}%, {cp_max_guess}%]")
+    print(f"CRN 种子: {seed}")
     print("="*50)
-    
+
     start_time = time.time()
-    
+
     try:
-        found_cp = brentq(
-            objective_function,
-            a=cp_min_guess,
-            b=cp_max_guess,
-            args=(params, product_type, target_fv),
-            xtol=1e-5,
-            rtol=1e-5
-        )
-        
+        # AUTOCALL_PROFILE=<文件> 时对本次求解做性能分析 (见 telemetry.py)
+        with profiled_solve(f"solve_for_cp-{product_type}-{target_margin * 100:.2f}"):
+            found_cp, brentq_result = brentq(
+                objective_function,
+                a=cp_min_guess,
+                b=cp_max_guess,
+                args=(params, product_type, target_fv, seed, pool),
+                xtol=1e-5,
+                rtol=1e-5,
+                full_output=True # 同时返回目标函数的调用次数
+            )
+
         end_time = time.time()
+        total_paths = brentq_result.function_calls * params['num_paths'] # 每个猜想都在 num_paths 条路径上定价
         print("--- 求解器完成 ---")
         print(f"总计用时: {end_time - start_time: .2f} 秒.")
+        print(f"定价次数: {brentq_result.function_calls}, 模拟的总路径数: {total_paths:,}")
         print(f"==> 求解得到的每月票息 (CP): {found_cp: .6f} %")
         print("="*50)
-        
+
+        if return_info:
+            return found_cp, {'pricing_calls': brentq_result.function_calls, 'total_paths': total_paths,
+                              'time': end_time - start_time}
         return found_cp
 
     except ValueError as e:
@@ -101,45 +132,202 @@ def solve_for_cp(params, product_type, target_margin, cp_min_guess=0.01, cp_max_
         print(f"错误: {e}")
         print("f(a) 和 f(b) 的误差符号相同。")
         print("请尝试在 'solve_for_cp' 函数中进一步扩大 'cp_max_guess' (例如: 15.0)。")
-        return None
+        return (None, None) if return_info else None
+
+
+# 考虑噪声、逐步增加路径数的求解器
+def solve_for_cp_progressive(params, product_type, target_margin, cp_min_guess=0.01, cp_max_guess=10.0, seed=None, pool=None,
+                             min_paths=PROGRESSIVE_MIN_PATHS, growth=PROGRESSIVE_GROWTH, overshoot=0.1, return_info=False):
+    """
+    与 solve_for_cp 的答案相同, 但模拟的路径更少。
+    蒙特卡洛公允价值只精确到它的标准误差, 把区间缩小到这个误差以下是白费功夫。
+    求解分阶段进行, 路径数逐渐增加 (..., num_paths / 16, num_paths / 4, num_paths):
+      - 第 1 阶段在整个搜索区间上运行 brentq, 当区间 (以公允价值计) 小于该阶段的标准误差时停止
+      - 之后每个阶段从上一阶段的根出发: 在 growth 倍的路径上为它定价,
+        用上一阶段的斜率走一个割线步, 多走 `overshoot` 以便这一步能把根包住。
+        两个阶段之间根大约移动一个标准误差, 所以这个区间往往已经小于误差, 不需要再定价;
+        否则由 brentq 缩小区间 (没有包住根的步长会继续延长)
+    最后一个阶段使用 params['num_paths'], 当它的区间小于价格的标准误差时求解停止。
+    所有阶段使用同一个 CRN 种子, 所以每个阶段的路径都以上一阶段的路径开头。
+    min_paths: 第一阶段至少使用这么多条路径
+    return_info: 同时返回一个字典, 包含定价次数、模拟的总路径数、各阶段和求解的误差
+    """
+
+    if cp_min_guess >= cp_max_guess:
+        raise ValueError("cp_min_guess must be below cp_max_guess")
+    if seed is None:
+        seed = np.random.SeedSequence().entropy
+
+    target_fv_pct = 1.0 - target_margin
+    target_fv = params['NOM'] * target_fv_pct
+
+    # 各阶段的路径数, 从最后一个阶段 (num_paths) 往前推
+    stage_paths = [params['num_paths']]
+    while stage_paths[0] // growth >= min_paths:
+        stage_paths.insert(0, stage_paths[0] // growth)
+
+    print("\n" + "="*50)
+    print(f"--- 正在启动渐进求解器 ---")
+    print(f"目标利润率: {target_margin*100: .2f}%")
+    print(f"目标公允价值: {target_fv: ,.2f} ({target_fv_pct*100: .2f}%)")
+    print(f"产品类型: {product_type}")
+    print(f"每个阶段的蒙特卡洛路径: {', '.join(f'{paths:,}' for paths in stage_paths)} (已启用并行 + 对偶变量)")
+    print(f"CP 搜索区间: [{cp_min_guess}%, {cp_max_guess}%]")
+    print(f"CRN 种子: {seed}")
+    print("="*50)
+
+    start_time = time.time()
+    pricing_calls = 0
+    total_paths = 0
+    found_cp = None
+    slope = None # 每 1% 票息对应的公允价值 (为正: 公允价值随票息上升)
+
+    for stage, num_paths in enumerate(stage_paths):
+        stage_params = dict(params, num_paths=num_paths)
+        priced = {} # 本阶段的公允价值 (带标准误差), brentq 会再次询问区间端点
+
+        def stage_objective(cp_guess):
+            nonlocal pricing_calls, total_paths
+            if cp_guess not in priced:
+                priced[cp_guess] = calculate_fair_value(cp_guess, stage_params, product_type, seed=seed, pool=pool)
+                pricing_calls += 1
+                total_paths += num_paths
+                print(f"  [阶段 {stage + 1}, {num_paths:,} 路径] 猜想 CP: {cp_guess: .6f}% -> FV: {priced[cp_guess]/params['NOM'] * 100.0: .4f}% "
+                      f"+/- {priced[cp_guess].stderr/params['NOM'] * 100.0: .4f}% -> 误差: {(priced[cp_guess] - target_fv)/params['NOM'] * 100.0: .4f}%")
+                record_solver_step('solve_for_cp_progressive', 'CP', cp_guess, priced[cp_guess], priced[cp_guess] - target_fv,
+                                   product_type=product_type, target_fv=target_fv, seed=seed, stage=stage + 1)
+            return priced[cp_guess] - target_fv
+
+        if found_cp is None:
+            # 第 1 阶段: 整个搜索区间
+            cp_low, cp_high = cp_min_guess, cp_max_guess
+        else:
+            # 从上一个根出发, 用上一阶段的斜率走一个割线步
+            cp_low = found_cp
+            step = -(1.0 + overshoot) * stage_objective(found_cp) / slope
+            cp_high = min(max(found_cp + step, cp_min_guess), cp_max_guess)
+            # 没有变号: 斜率不准, 继续走 (步长加倍) 直到包住根
+            while stage_objective(cp_low) * stage_objective(cp_high) > 0 and cp_min_guess < cp_high < cp_max_guess:
+                step *= 2.0
+                cp_low, cp_high = cp_high, min(max(cp_high + step, cp_min_guess), cp_max_guess)
+            cp_low, cp_high = min(cp_low, cp_high), max(cp_low, cp_high)
+
+        error_low, error_high = stage_objective(cp_low), stage_objective(cp_high)
+        if error_low * error_high > 0:
+            print(f"--- 求解器失败 ---")
+            print("错误: f(a) 和 f(b) 的误差符号相同。")
+            print("请尝试调整搜索区间。")
+            return (None, None) if return_info else None
+
+        if cp_high == cp_low:
+            # 割线步没有移动猜想。在通过了变号检查的情况下, 只有当它的误差恰好为 0 时才会这样,
+            # 所以它就是本阶段路径上的根; 保留上一阶段的斜率
+            found_cp = cp_low
+            stderr = priced[found_cp].stderr
+            cp_stderr = stderr / slope
+            print(f"  [阶段 {stage + 1}] CP: {found_cp: .6f}% +/- {cp_stderr: .6f}% (公允价值标准误差 {stderr: ,.2f})")
+            continue
+
+        # 本阶段路径上的斜率 (固定路径时目标函数对 CP 是线性的),
+        # 以及价格的标准误差, 取自离根最近的猜想
+        slope = (error_high - error_low) / (cp_high - cp_low)
+        found_cp = cp_low - error_low / slope
+        stderr = priced[min(priced, key=lambda cp: abs(cp - found_cp))].stderr
+        cp_stderr = stderr / slope
+
+        # 如果区间已经小于标准误差, 线性插值就是根;
+        # 否则 brentq 在区间 (以公允价值计) 缩小到一个标准误差时停止
+        if error_high - error_low >= stderr:
+            found_cp = brentq(stage_objective, cp_low, cp_high, xtol=0.5 * cp_stderr, rtol=1e-12)
+            stderr = priced[min(priced, key=lambda cp: abs(cp - found_cp))].stderr
+            cp_stderr = stderr / slope
+        print(f"  [阶段 {stage + 1}] CP: {found_cp: .6f}% +/- {cp_stderr: .6f}% (公允价值标准误差 {stderr: ,.2f})")
+
+    end_time = time.time()
+    print("--- 求解器完成 ---")
+    print(f"总计用时: {end_time - start_time: .2f} 秒.")
+    print(f"定价次数: {pricing_calls}, 模拟的总路径数: {total_paths:,} "
+          f"(= {total_paths / params['num_paths']:.1f} 次 {params['num_paths']:,} 路径的定价)")
+    print(f"==> 求解得到的每月票息 (CP): {found_cp: .6f} % +/- {cp_stderr: .6f} %")
+    print("="*50)
+
+    if return_info:
+        return found_cp, {'pricing_calls': pricing_calls, 'total_paths': total_paths, 'time': end_time - start_time,
+                          'stages': stage_paths, 'stderr': stderr, 'cp_stderr': cp_stderr}
+    return found_cp
 
 # --- 5. Main 入口: 求解 Q1(i) 和 Q1(ii) ---
 if __name__ == "__main__":
-    
+
     # 这一行对于防止多进程在 Windows 上出错是必需的
-    multiprocessing.freeze_support() 
-    
+    multiprocessing.freeze_support()
+
     print(f"--- 正在执行: solver_i.py (Q1 生产版) ---")
     print("本脚本将计算 Q1(i) 和 Q1(ii) 的 *精确* 答案。")
     print("这可能需要几分钟时间，具体取决于您的 CPU 核心数。")
-    
-    # --- 求解 Q1(i): HKD, 1.20% 利润率 ---
-    # !! 使用生产参数 !!
-    cp_q1_i = solve_for_cp(
-        params=hkd_params_prod,
-        product_type='HKD',
-        target_margin=0.0120     # 1.20%
-    )
-    
-    # --- 求解 Q1(ii): HKD, 1.60% 利润率 ---
-    # !! 使用生产参数 !!
-    cp_q1_ii = solve_for_cp(
-        params=hkd_params_prod,
-        product_type='HKD',
-        target_margin=0.0160    # 1.60%
-    )
+
+    if SOLVE_METHOD == 'direct':
+        # --- 用同一次模拟求解 Q1(i) 和 Q1(ii) ---
+        start_time = time.time()
+        cp_q1_i, cp_q1_ii = solve_cp_direct(
+            params=hkd_params_prod,
+            product_type='HKD',
+            target_margin=[0.0120, 0.0160]  # 1.20% 和 1.60%
+        )
+        print(f"直接求解 (一次模拟) 用时: {time.time() - start_time: .2f} 秒.")
+    elif SOLVE_METHOD == 'progressive':
+        # 两个利润率先渐进求解, 再用同一个种子做一次固定路径的 brentq, 比较花费的路径数
+        seed = np.random.SeedSequence().entropy
+        comparison = []
+        with PricingPool(hkd_params_prod, 'HKD') as pricing_pool:
+            for target_margin in (0.0120, 0.0160):
+                cp_progressive, progressive_info = solve_for_cp_progressive(
+                    params=hkd_params_prod, product_type='HKD', target_margin=target_margin, seed=seed, pool=pricing_pool, return_info=True)
+                cp_fixed, fixed_info = solve_for_cp(
+                    params=hkd_params_prod, product_type='HKD', target_margin=target_margin, seed=seed, pool=pricing_pool, return_info=True)
+                comparison.append((target_margin, cp_progressive, progressive_info, cp_fixed, fixed_info))
+        cp_q1_i, cp_q1_ii = comparison[0][1], comparison[1][1]
+
+        print("\n--- 渐进求解 vs 固定路径 brentq ---")
+        for target_margin, cp_progressive, progressive_info, cp_fixed, fixed_info in comparison:
+            if progressive_info is None or fixed_info is None:
+                continue
+            print(f"利润率 {target_margin*100:.2f}%: 渐进 CP {cp_progressive: .6f}% +/- {progressive_info['cp_stderr']:.6f}% "
+                  f"({progressive_info['pricing_calls']} 次, {progressive_info['total_paths']:,} 路径, {progressive_info['time']:.2f} 秒) | "
+                  f"brentq CP {cp_fixed: .6f}% ({fixed_info['pricing_calls']} 次, {fixed_info['total_paths']:,} 路径, "
+                  f"{fixed_info['time']:.2f} 秒) | 节省路径: {1.0 - progressive_info['total_paths'] / fixed_info['total_paths']:.0%}")
+    else:
+        # 只启动一次进程池, 两次求解的所有猜想都复用它
+        with PricingPool(hkd_params_prod, 'HKD') as pricing_pool:
+            # --- 求解 Q1(i): HKD, 1.20% 利润率 ---
+            # !! 使用生产参数 !!
+            cp_q1_i = solve_for_cp(
+                params=hkd_params_prod,
+                product_type='HKD',
+                target_margin=0.0120,    # 1.20%
+                pool=pricing_pool
+            )
+
+            # --- 求解 Q1(ii): HKD, 1.60% 利润率 ---
+            # !! 使用生产参数 !!
+            cp_q1_ii = solve_for_cp(
+                params=hkd_params_prod,
+                product_type='HKD',
+                target_margin=0.0160,   # 1.60%
+                pool=pricing_pool
+            )
 
     print("\n" + "="*60)
     print("--- Q1 最终答案 (300,000 路径) ---")
-    
+
     if cp_q1_i is not None:
         print(f"Q1(i) [1.20% 利润] 的 CP1 值为: {cp_q1_i: .6f} %")
         print("==> (请记下这个 'CP1' 值，Q2 需要它)")
     else:
         print("Q1(i) [1.20% 利润] 未能找到解。")
-        
+
     if cp_q1_ii is not None:
         print(f"Q1(ii) [1.60% 利润] 的 CP 值为: {cp_q1_ii: .6f} %")
     else:
         print("Q1(ii) [1.60% 利润] 未能找到解。")
-    print("="*60)
\ No newline at end of file
+    print("="*60)
@@ -8,7 +8,8 @@ import multiprocessing  # Required for parallel processing
 
 # Import the accelerated core pricing function. We use anthithetic variates and multiprocessing.
 try:
-    from calculate_fair_value import calculate_fair_value
+    from calculate_fair_value import calculate_fair_value, solve_cp_direct, PricingPool
+    from telemetry import profiled_solve, record_solver_step # JSONL records / profiler, switched on by the environment
 except ImportError:
     print("Error: Could not import 'calculate_fair_value' function.")
     exit()
@@ -21,34 +22,55 @@ hkd_params_prod = {
     'K0': 0.96, 'KI': 0.92, 'AC': 0.99
 }
 
+# 'direct': one simulation pass, PV = A + CP * B is affine in CP, so both margins are solved as CP = (target - A) / B
+# 'brentq': the original root finding, one full pricing per guess
+# 'progressive': noise-aware root finding, few paths while the bracket is wide, num_paths only near the root
+SOLVE_METHOD = 'direct'
+
+# Progressive solve: the first stage uses at least this many paths, every next stage PROGRESSIVE_GROWTH times more
+PROGRESSIVE_MIN_PATHS = 10000
+PROGRESSIVE_GROWTH = 4
+
 # Define the objective function for the solver
-def objective_function(cp_guess, params, product_type, target_fv):
+def objective_function(cp_guess, params, product_type, target_fv, seed=None, pool=None):
     """
     This is the function for the brentq solver to optimize.
     It calculates: Fair_Value(cp_guess) - Target_Fair_Value
+    seed: the Common Random Numbers seed of the solve, every guess is priced on the same paths
+    pool: optional PricingPool, its workers are reused for every guess
     """
     
     # Call the core pricing engine
     current_fv = calculate_fair_value(
         CP_guess=cp_guess, # cp_guess will be supplied by the solver
         params=params, 
-        product_type=product_type
+        product_type=product_type,
+        seed=seed, # same normals for every guess, so the objective is deterministic in CP
+        pool=pool
     )
     
     error = current_fv - target_fv # difference between current fair value and target fair value
     
     print(f"  [Solver Step] Guess CP: {cp_guess: .6f}% -> FV: {current_fv/params['NOM'] * 100.0: .4f}% -> Error: {error/params['NOM'] * 100.0: .4f}%")
+    record_solver_step('solve_for_cp', 'CP', cp_guess, current_fv, error, product_type=product_type, target_fv=target_fv, seed=seed)
     
     return error
 
 # Main solver function
-def solve_for_cp(params, product_type, target_margin, cp_min_guess=0.01, cp_max_guess=10.0):
+def solve_for_cp(params, product_type, target_margin, cp_min_guess=0.01, cp_max_guess=10.0, seed=None, pool=None, return_info=False):
     """
     target_margin: Bank's target margin (e.g., 0.012 for 1.20%)
     cp_min_guess: the lower bound for the solver search
     cp_max_guess: the upper bound for the solver search
+    seed: Common Random Numbers seed, a fresh one is drawn for this solve if not given
+    pool: optional PricingPool shared by all guesses (and by several solves)
+    return_info: also return a dict with the pricing calls, the total paths simulated and the time of the solve
     """
     
+    # The normals are fixed once per solve and reused for every guess
+    if seed is None:
+        seed = np.random.SeedSequence().entropy
+    
     target_fv_pct = 1.0 - target_margin
     target_fv = params['NOM'] * target_fv_pct # Target fair value in currency units
     
@@ -59,33 +81,165 @@ def solve_for_cp(params, product_type, target_margin, cp_min_guess=0.01, cp_max_
     print(f"Product Type: {product_type}")
     print(f"Monte Carlo Paths: {params['num_paths']} (Parallel + Antithetic)")
     print(f"CP Search Range: [{cp_min_guess}%, {cp_max_guess}%]")
+    print(f"CRN Seed: {seed}")
     print("="*50)
     
     start_time = time.time()
     
     try:
-        found_cp = brentq(
-            objective_function,
-            a=cp_min_guess, # min guess coupon
-            b=cp_max_guess, # max guess coupon 
-            args=(params, product_type, target_fv),
-            xtol=1e-5, # the first tolerance level for stopping criteria
-            rtol=1e-5 # the second tolerance level
-        )
+        # AUTOCALL_PROFILE=<file> profiles this solve (see telemetry.py)
+        with profiled_solve(f"solve_for_cp-{product_type}-{target_margin * 100:.2f}"):
+            found_cp, brentq_result = brentq(
+                objective_function,
+                a=cp_min_guess, # min guess coupon
+                b=cp_max_guess, # max guess coupon 
+                args=(params, product_type, target_fv, seed, pool),
+                xtol=1e-5, # the first tolerance level for stopping criteria
+                rtol=1e-5, # the second tolerance level
+                full_output=True # also return the number of objective calls
+            )
         
         end_time = time.time()
+        total_paths = brentq_result.function_calls * params['num_paths'] # every guess is priced on num_paths paths
         print("--- Solver Finished ---")
         print(f"Total Time Elapsed: {end_time - start_time: .2f} seconds.")
+        print(f"Pricing calls: {brentq_result.function_calls}, total paths simulated: {total_paths:,}")
         print(f"==> Solved Monthly Coupon (CP): {found_cp: .6f} %")
         print("="*50)
         
+        if return_info:
+            return found_cp, {'pricing_calls': brentq_result.function_calls, 'total_paths': total_paths,
+                              'time': end_time - start_time}
         return found_cp
 
     except ValueError as e:
         print(f"--- Solver FAILED ---")
         print(f"Error: {e}")
         print("Maybe adjust the search range?")
-        return None
+        return (None, None) if return_info else None
+
+
+# Noise-aware solver with progressive path refinement
+def solve_for_cp_progressive(params, product_type, target_margin, cp_min_guess=0.01, cp_max_guess=10.0, seed=None, pool=None,
+                             min_paths=PROGRESSIVE_MIN_PATHS, growth=PROGRESSIVE_GROWTH, overshoot=0.1, return_info=False):
+    """
+    Same answer as solve_for_cp, for fewer simulated paths.
+    A Monte Carlo fair value is only known up to its standard error, so narrowing the bracket below that error is wasted work.
+    The solve runs in stages with growing path counts (..., num_paths / 16, num_paths / 4, num_paths):
+      - stage 1 runs brentq on the whole search range, and stops once the bracket, in fair value terms,
+        is smaller than the standard error of that stage
+      - every next stage starts from the root of the stage before: it prices it on growth times more paths
+        and takes a secant step with the slope of the stage before, overshooting by `overshoot` so the step brackets the root.
+        The root moves by about one standard error between stages, so this bracket is often already smaller than the error
+        and no more pricing is needed; otherwise brentq narrows it (and a step that misses the root is extended)
+    The last stage uses params['num_paths'], and the solve stops when its bracket is smaller than the standard error of the price.
+    All stages use the same CRN seed, so a stage's paths start with the paths of the stage before.
+    min_paths: the first stage has at least this many paths
+    return_info: also return a dict with the pricing calls, the total paths simulated, the stages and the errors of the solve
+    """
+    
+    if cp_min_guess >= cp_max_guess:
+        raise ValueError("cp_min_guess must be below cp_max_guess")
+    if seed is None:
+        seed = np.random.SeedSequence().entropy
+    
+    target_fv_pct = 1.0 - target_margin
+    target_fv = params['NOM'] * target_fv_pct
+    
+    # Path counts of the stages, from the last (num_paths) backwards
+    stage_paths = [params['num_paths']]
+    while stage_paths[0] // growth >= min_paths:
+        stage_paths.insert(0, stage_paths[0] // growth)
+    
+    print("\n" + "="*50)
+    print(f"--- Starting Progressive Solver ---")
+    print(f"Target Margin: {target_margin*100: .2f}%")
+    print(f"Target Fair Value: {target_fv: ,.2f} ({target_fv_pct*100: .2f}%)")
+    print(f"Product Type: {product_type}")
+    print(f"Monte Carlo Paths per stage: {', '.join(f'{paths:,}' for paths in stage_paths)} (Parallel + Antithetic)")
+    print(f"CP Search Range: [{cp_min_guess}%, {cp_max_guess}%]")
+    print(f"CRN Seed: {seed}")
+    print("="*50)
+    
+    start_time = time.time()
+    pricing_calls = 0
+    total_paths = 0
+    found_cp = None
+    slope = None # fair value per 1% of coupon (positive: the fair value rises with the coupon)
+    
+    for stage, num_paths in enumerate(stage_paths):
+        stage_params = dict(params, num_paths=num_paths)
+        priced = {} # the fair values (with their standard errors) of this stage, brentq asks for the bracket ends again
+        
+        def stage_objective(cp_guess):
+            nonlocal pricing_calls, total_paths
+            if cp_guess not in priced:
+                priced[cp_guess] = calculate_fair_value(cp_guess, stage_params, product_type, seed=seed, pool=pool)
+                pricing_calls += 1
+                total_paths += num_paths
+                print(f"  [Stage {stage + 1}, {num_paths:,} paths] Guess CP: {cp_guess: .6f}% -> FV: {priced[cp_guess]/params['NOM'] * 100.0: .4f}% "
+                      f"+/- {priced[cp_guess].stderr/params['NOM'] * 100.0: .4f}% -> Error: {(priced[cp_guess] - target_fv)/params['NOM'] * 100.0: .4f}%")
+                record_solver_step('solve_for_cp_progressive', 'CP', cp_guess, priced[cp_guess], priced[cp_guess] - target_fv,
+                                   product_type=product_type, target_fv=target_fv, seed=seed, stage=stage + 1)
+            return priced[cp_guess] - target_fv
+        
+        if found_cp is None:
+            # Stage 1: the whole search range
+            cp_low, cp_high = cp_min_guess, cp_max_guess
+        else:
+            # Secant step from the last root, with the last slope
+            cp_low = found_cp
+            step = -(1.0 + overshoot) * stage_objective(found_cp) / slope
+            cp_high = min(max(found_cp + step, cp_min_guess), cp_max_guess)
+            # No sign change: the slope was off, keep stepping (doubling the step) until the root is bracketed
+            while stage_objective(cp_low) * stage_objective(cp_high) > 0 and cp_min_guess < cp_high < cp_max_guess:
+                step *= 2.0
+                cp_low, cp_high = cp_high, min(max(cp_high + step, cp_min_guess), cp_max_guess)
+            cp_low, cp_high = min(cp_low, cp_high), max(cp_low, cp_high)
+        
+        error_low, error_high = stage_objective(cp_low), stage_objective(cp_high)
+        if error_low * error_high > 0:
+            print(f"--- Solver FAILED ---")
+            print("Error: f(a) and f(b) must have different signs")
+            print("Maybe adjust the search range?")
+            return (None, None) if return_info else None
+        
+        if cp_high == cp_low:
+            # The secant step did not move the guess. With a sign check passed this only happens when its error is exactly 0,
+            # so it is the root on this stage's paths; the slope of the stage before is kept
+            found_cp = cp_low
+            stderr = priced[found_cp].stderr
+            cp_stderr = stderr / slope
+            print(f"  [Stage {stage + 1}] CP: {found_cp: .6f}% +/- {cp_stderr: .6f}% (fair value stderr {stderr: ,.2f})")
+            continue
+        
+        # Slope on this stage's paths (the objective is linear in CP on fixed paths),
+        # and the standard error of the price, taken from the guess closest to the root
+        slope = (error_high - error_low) / (cp_high - cp_low)
+        found_cp = cp_low - error_low / slope
+        stderr = priced[min(priced, key=lambda cp: abs(cp - found_cp))].stderr
+        cp_stderr = stderr / slope
+        
+        # If the bracket is already smaller than the standard error, the linear interpolation is the root;
+        # otherwise brentq stops when the bracket is one standard error wide in fair value terms
+        if error_high - error_low >= stderr:
+            found_cp = brentq(stage_objective, cp_low, cp_high, xtol=0.5 * cp_stderr, rtol=1e-12)
+            stderr = priced[min(priced, key=lambda cp: abs(cp - found_cp))].stderr
+            cp_stderr = stderr / slope
+        print(f"  [Stage {stage + 1}] CP: {found_cp: .6f}% +/- {cp_stderr: .6f}% (fair value stderr {stderr: ,.2f})")
+    
+    end_time = time.time()
+    print("--- Solver Finished ---")
+    print(f"Total Time Elapsed: {end_time - start_time: .2f} seconds.")
+    print(f"Pricing calls: {pricing_calls}, total paths simulated: {total_paths:,} "
+          f"(= {total_paths / params['num_paths']:.1f} pricings at {params['num_paths']:,} paths)")
+    print(f"==> Solved Monthly Coupon (CP): {found_cp: .6f} % +/- {cp_stderr: .6f} %")
+    print("="*50)
+    
+    if return_info:
+        return found_cp, {'pricing_calls': pricing_calls, 'total_paths': total_paths, 'time': end_time - start_time,
+                          'stages': stage_paths, 'stderr': stderr, 'cp_stderr': cp_stderr}
+    return found_cp
 
 # --- 5. Main entry point: Solve Q1(i) and Q1(ii) ---
 if __name__ == "__main__":
@@ -97,19 +251,54 @@ if __name__ == "__main__":
     print("This script will calculate the *exact* answers for Q1(i) and Q1(ii).")
     print("This may take a few minutes depending on your CPU cores.")
     
-    # --- Solve Q1(i): HKD, 1.20% Margin ---
-    cp_q1_i = solve_for_cp(
-        params=hkd_params_prod,
-        product_type='HKD',
-        target_margin=0.0120  # 1.20%
-    )
-    
-    # --- Solve Q1(ii): HKD, 1.60% Margin ---
-    cp_q1_ii = solve_for_cp(
-        params=hkd_params_prod,
-        product_type='HKD',
-        target_margin=0.0160  # 1.60%
-    )
+    if SOLVE_METHOD == 'direct':
+        # --- Solve Q1(i) and Q1(ii) from the same simulation pass ---
+        start_time = time.time()
+        cp_q1_i, cp_q1_ii = solve_cp_direct(
+            params=hkd_params_prod,
+            product_type='HKD',
+            target_margin=[0.0120, 0.0160]  # 1.20% and 1.60%
+        )
+        print(f"Direct solve (one pass) Time Elapsed: {time.time() - start_time: .2f} seconds.")
+    elif SOLVE_METHOD == 'progressive':
+        # Solve both margins progressively, then once with the fixed-path brentq on the same seed, to compare the paths spent
+        seed = np.random.SeedSequence().entropy
+        comparison = []
+        with PricingPool(hkd_params_prod, 'HKD') as pricing_pool:
+            for target_margin in (0.0120, 0.0160):
+                cp_progressive, progressive_info = solve_for_cp_progressive(
+                    params=hkd_params_prod, product_type='HKD', target_margin=target_margin, seed=seed, pool=pricing_pool, return_info=True)
+                cp_fixed, fixed_info = solve_for_cp(
+                    params=hkd_params_prod, product_type='HKD', target_margin=target_margin, seed=seed, pool=pricing_pool, return_info=True)
+                comparison.append((target_margin, cp_progressive, progressive_info, cp_fixed, fixed_info))
+        cp_q1_i, cp_q1_ii = comparison[0][1], comparison[1][1]
+        
+        print("\n--- Progressive vs fixed-path brentq ---")
+        for target_margin, cp_progressive, progressive_info, cp_fixed, fixed_info in comparison:
+            if progressive_info is None or fixed_info is None:
+                continue
+            print(f"Margin {target_margin*100:.2f}%: progressive CP {cp_progressive: .6f}% +/- {progressive_info['cp_stderr']:.6f}% "
+                  f"({progressive_info['pricing_calls']} calls, {progressive_info['total_paths']:,} paths, {progressive_info['time']:.2f} s) | "
+                  f"brentq CP {cp_fixed: .6f}% ({fixed_info['pricing_calls']} calls, {fixed_info['total_paths']:,} paths, "
+                  f"{fixed_info['time']:.2f} s) | paths saved: {1.0 - progressive_info['total_paths'] / fixed_info['total_paths']:.0%}")
+    else:
+        # One pool of workers is started once and reused by every guess of both solves
+        with PricingPool(hkd_params_prod, 'HKD') as pricing_pool:
+            # --- Solve Q1(i): HKD, 1.20% Margin ---
+            cp_q1_i = solve_for_cp(
+                params=hkd_params_prod,
+                product_type='HKD',
+                target_margin=0.0120,  # 1.20%
+                pool=pricing_pool
+            )
+            
+            # --- Solve Q1(ii): HKD, 1.60% Margin ---
+            cp_q1_ii = solve_for_cp(
+                params=hkd_params_prod,
+                product_type='HKD',
+                target_margin=0.0160,  # 1.60%
+                pool=pricing_pool
+            )
 
     print("\n" + "="*50)
     print("--- Q1 Final Answers (300,000 Paths) ---")
@@ -3,12 +3,11 @@
 
 import numpy as np
 import time
-from scipy.optimize import brentq 
 import multiprocessing
-import copy # Used for deep copying the parameter dictionary
 
 try:
-    from calculate_fair_value import calculate_fair_value
+    from calculate_fair_value import PricingPool
+    from param_solver import PARAM_DOMAINS, solve_param # bracket search + brentq on one parameter (see param_solver.py)
 except ImportError:
     print("="*50)
     print("Error: Could not import 'calculate_fair_value' function.")
@@ -30,39 +29,6 @@ CP_NEW = CP1_VALUE - 0.10 # The demanded new coupon
 TARGET_MARGIN = 0.0120 # 1.20%
 TARGET_FV = hkd_params_prod['NOM'] * (1.0 - TARGET_MARGIN) # 98,800.00
 
-# Define the generic objective function (Q2 specific)
-def generic_objective_function(param_guess, param_name_to_solve, base_params, fixed_cp, target_fv):
-    """
-    Generic objective function, used to solve for K0, KI, or AC.
-    
-    param_guess: The new parameter value guessed by the solver (e.g., 0.95)
-    param_name_to_solve: The name of the parameter to modify, which param to search (e.g., 'K0')
-    base_params: Dictionary containing the original K0, KI, AC
-    fixed_cp: The fixed new coupon (CP_new)
-    target_fv: The target fair value (98,800)
-    :return: Error (FV - Target)
-    """
-    
-    # Create a copy of the parameters to avoid modifying the original dictionary
-    temp_params = copy.deepcopy(base_params)
-    
-    # Set the "guessed value" in the dictionary
-    temp_params[param_name_to_solve] = param_guess
-    
-    # Call the core pricing engine
-    current_fv = calculate_fair_value(
-        CP_guess=fixed_cp, # coupon is fixed
-        params=temp_params, # the 3 changed params
-        product_type='HKD'
-    )
-    
-    # 4. Calculate the error
-    error = current_fv - target_fv
-    
-    print(f"  [Solver Step: {param_name_to_solve}] Guess {param_name_to_solve} = {param_guess: .6f} -> FV: {current_fv/temp_params['NOM'] * 100.0: .4f}% -> Error: {error: .2f}")
-    
-    return error
-
 # Main entry point: Solve the three exercises in Q2
 if __name__ == "__main__":
     
@@ -80,86 +46,79 @@ if __name__ == "__main__":
     # Define base parameters (Q1 original values)
     base_params = hkd_params_prod
     
-    # We will try to solve for K0, KI, and AC one by one.
-    # Just like what we did before, we set a lower and upper bound, but this range is mannually defined.
-    # If we fail to find a solution, we can always expand the range.
-    # For example, I can not find the solution for K0, then I expand the bound and try in soler_ii_for_exception.py.
+    # Common Random Numbers: every guess of every exercise is priced on the same paths
+    CRN_SEED = np.random.SeedSequence().entropy
+    print(f"CRN Seed: {CRN_SEED}")
+    
+    # One pool of workers is started once and reused by every guess of the three exercises
+    # (the with-block stops the workers, also when a solve raises)
+    with PricingPool(base_params, 'HKD') as pricing_pool:
+        # We will try to solve for K0, KI, and AC one by one.
+        # The search range is not hand-picked any more: solve_param walks from the original value with a cheap low-path search
+        # until the fair value crosses the target, then refines on the full path count.
+        # If there is no root in the parameter's domain (PARAM_DOMAINS) it says so before any full-path pricing is spent.
+        # (The hand-picked [0.80, 0.92] KI range failed once, that is why soler_ii_for_exception.py exists.)
 
 
-    # --- Exercise A: Solve for K0 ---
-    # Fixed: CP=CP_new, KI=0.92, AC=0.99
-    # Solve: K0
-    # Expect: K0 < 0.96
-    print("\n" + "="*50)
-    print(f"Exercise A: Solving for K0 (Keep KI=0.92, AC=0.99)")
-    print(f"Search Range: [0.80, {base_params['K0']}]") # Upper bound is the original value
-    print("="*50)
+        # --- Exercise A: Solve for K0 ---
+        # Fixed: CP=CP_new, KI=0.92, AC=0.99
+        # Solve: K0
+        # Expect: K0 < 0.96
+        print("\n" + "="*50)
+        print(f"Exercise A: Solving for K0 (Keep KI=0.92, AC=0.99)")
+        print(f"Search Start: {base_params['K0']} (domain {PARAM_DOMAINS['K0']})") # The search starts at the original value
+        print("="*50)
     
-    start_time = time.time()
-    try:
-        found_K0 = brentq(
-            generic_objective_function,
-            a=0.80, # Safe lower bound
-            b=base_params['K0'], # Original value as upper bound
-            args=('K0', base_params, CP_NEW, TARGET_FV),
-            xtol=1e-6
-        )
-        print(f"--- Exercise A Finished (Time: {time.time() - start_time:.2f}s) ---")
-        print(f"==> Found new K0: {found_K0:.6f} (Original: {base_params['K0']})")
-        print(f"==> Change: {found_K0 - base_params['K0']:.6f}")
-    except ValueError as e:
-        print(f"--- Exercise A Solver FAILED: {e} ---")
-        found_K0 = None
+        start_time = time.time()
+        try:
+            found_K0 = solve_param('K0', base_params, CP_NEW, TARGET_FV, CRN_SEED, pricing_pool, xtol=1e-6)
+            print(f"--- Exercise A Finished (Time: {time.time() - start_time:.2f}s) ---")
+            if found_K0 is not None:
+                print(f"==> Found new K0: {found_K0:.6f} (Original: {base_params['K0']})")
+                print(f"==> Change: {found_K0 - base_params['K0']:.6f}")
+        except ValueError as e:
+            print(f"--- Exercise A Solver FAILED: {e} ---")
+            found_K0 = None
 
-    # --- Exercise B: Solve for KI ---
-    # Fixed: CP=CP_new, K0=0.96, AC=0.99
-    # Solve: KI
-    # Expect: KI < 0.92
-    print("\n" + "="*50)
-    print(f"Exercise B: Solving for KI (Keep K0=0.96, AC=0.99)")
-    print(f"Search Range: [0.80, {base_params['KI']}]") # Upper bound is the original value
-    print("="*50)
+        # --- Exercise B: Solve for KI ---
+        # Fixed: CP=CP_new, K0=0.96, AC=0.99
+        # Solve: KI
+        # Expect: KI < 0.92
+        print("\n" + "="*50)
+        print(f"Exercise B: Solving for KI (Keep K0=0.96, AC=0.99)")
+        print(f"Search Start: {base_params['KI']} (domain {PARAM_DOMAINS['KI']})") # The search starts at the original value
+        print("="*50)
     
-    start_time = time.time()
-    try:
-        found_KI = brentq(
-            generic_objective_function,
-            a=0.80, # Safe lower bound
-            b=base_params['KI'], # Original value as upper bound
-            args=('KI', base_params, CP_NEW, TARGET_FV),
-            xtol=1e-6
-        )
-        print(f"--- Exercise B Finished (Time: {time.time() - start_time:.2f}s) ---")
-        print(f"==> Found new KI: {found_KI:.6f} (Original: {base_params['KI']})")
-        print(f"==> Change: {found_KI - base_params['KI']:.6f}")
-    except ValueError as e:
-        print(f"--- Exercise B Solver FAILED: {e} ---")
-        found_KI = None
+        start_time = time.time()
+        try:
+            found_KI = solve_param('KI', base_params, CP_NEW, TARGET_FV, CRN_SEED, pricing_pool, xtol=1e-6)
+            print(f"--- Exercise B Finished (Time: {time.time() - start_time:.2f}s) ---")
+            if found_KI is not None:
+                print(f"==> Found new KI: {found_KI:.6f} (Original: {base_params['KI']})")
+                print(f"==> Change: {found_KI - base_params['KI']:.6f}")
+        except ValueError as e:
+            print(f"--- Exercise B Solver FAILED: {e} ---")
+            found_KI = None
 
-    # --- Exercise C: Solve for AC ---
-    # Fixed: CP=CP_new, K0=0.96, KI=0.92
-    # Solve: AC
-    # Expect: AC < 0.99
-    print("\n" + "="*50)
-    print(f"Exercise C: Solving for AC (Keep K0=0.96, KI=0.92)")
-    print(f"Search Range: [0.90, {base_params['AC']}]") # Upper bound is the original value
-    print("="*50)
+        # --- Exercise C: Solve for AC ---
+        # Fixed: CP=CP_new, K0=0.96, KI=0.92
+        # Solve: AC
+        # Expect: AC < 0.99
+        print("\n" + "="*50)
+        print(f"Exercise C: Solving for AC (Keep K0=0.96, KI=0.92)")
+        print(f"Search Start: {base_params['AC']} (domain {PARAM_DOMAINS['AC']})") # The search starts at the original value
+        print("="*50)
     
-    start_time = time.time()
-    try:
-        found_AC = brentq(
-            generic_objective_function,
-            a=0.90, # Safe lower bound (AC unlikely to be lower than K0)
-            b=base_params['AC'], # Original value as upper bound
-            args=('AC', base_params, CP_NEW, TARGET_FV),
-            xtol=1e-6
-        )
-        print(f"--- Exercise C Finished (Time: {time.time() - start_time:.2f}s) ---")
-        print(f"==> Found new AC: {found_AC:.6f} (Original: {base_params['AC']})")
-        print(f"==> Change: {found_AC - base_params['AC']:.6f}")
-    except ValueError as e:
-        print(f"--- Exercise C Solver FAILED: {e} ---")
-        found_AC = None
+        start_time = time.time()
+        try:
+            found_AC = solve_param('AC', base_params, CP_NEW, TARGET_FV, CRN_SEED, pricing_pool, xtol=1e-6)
+            print(f"--- Exercise C Finished (Time: {time.time() - start_time:.2f}s) ---")
+            if found_AC is not None:
+                print(f"==> Found new AC: {found_AC:.6f} (Original: {base_params['AC']})")
+                print(f"==> Change: {found_AC - base_params['AC']:.6f}")
+        except ValueError as e:
+            print(f"--- Exercise C Solver FAILED: {e} ---")
+            found_AC = None
 
     # --- Final Summary ---
     print("\n" + "="*60)
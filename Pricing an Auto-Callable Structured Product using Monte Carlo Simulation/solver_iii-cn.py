@@ -8,7 +8,8 @@ import multiprocessing
 
 # --- 1. Import the *accelerated* core pricing function ---
 try:
-    from calculate_fair_value import calculate_fair_value
+    from calculate_fair_value import calculate_fair_value, solve_cp_direct, PricingPool
+    from telemetry import profiled_solve, record_solver_step # JSONL records / profiler, switched on by the environment
 except ImportError:
     print("Error: Could not import 'calculate_fair_value' function.")
     exit()
@@ -34,34 +35,49 @@ quanto_params_prod = {
     'rho': 0.42               # Correlation between stock and FX
 }
 
+# 'direct': simulate once; PV = A + CP * B is affine in CP, so both margins are solved directly with CP = (target - A) / B
+# 'brentq': the original root search, every guess is a full pricing run
+SOLVE_METHOD = 'direct'
+
 
 # --- 3. Define the objective function for the solver (identical to solver_i.py) ---
 
-def objective_function(cp_guess, params, product_type, target_fv):
+def objective_function(cp_guess, params, product_type, target_fv, seed=None, pool=None):
     """
     This is the function for the brentq solver to optimize.
     It calculates: Fair_Value(cp_guess) - Target_Fair_Value
+    seed: Common Random Numbers (CRN) seed of this solve, every guess is priced on the same paths
+    pool: optional PricingPool, its workers are reused for every guess
     """
     
     # Call the core pricing engine (V3 Parallel version)
     current_fv = calculate_fair_value(
         CP_guess=cp_guess, 
         params=params, 
-        product_type=product_type # This will be passed as 'Quanto'
+        product_type=product_type, # This will be passed as 'Quanto'
+        seed=seed, # Same random numbers for every guess, so the objective is deterministic in CP
+        pool=pool
     )
     
     error = current_fv - target_fv
     
     print(f"  [Solver Step] Guess CP: {cp_guess: .6f}% -> FV: {current_fv/params['NOM'] * 100.0: .4f}% -> Error: {error/params['NOM'] * 100.0: .4f}%")
+    record_solver_step('solve_for_cp', 'CP', cp_guess, current_fv, error, product_type=product_type, target_fv=target_fv, seed=seed)
     
     return error
 
 # --- 4. Main solver function (identical to solver_i.py) ---
-def solve_for_cp(params, product_type, target_margin, cp_min_guess=0.01, cp_max_guess=10.0):
+def solve_for_cp(params, product_type, target_margin, cp_min_guess=0.01, cp_max_guess=10.0, seed=None, pool=None):
     """
     A complete solver function to find the CP.
+    seed: Common Random Numbers (CRN) seed, a fresh one is drawn for this solve when not given
+    pool: optional PricingPool, shared by all guesses (and by several solves)
     """
     
+    # Fix the random numbers once per solve and reuse them for every guess
+    if seed is None:
+        seed = np.random.SeedSequence().entropy
+    
     target_fv_pct = 1.0 - target_margin
     target_fv = params['NOM'] * target_fv_pct
     
@@ -72,19 +88,22 @@ def solve_for_cp(params, product_type, target_margin, cp_min_guess=0.01, cp_max_
     print(f"Product Type: {product_type}") # <--- This will print 'Quanto'
     print(f"Monte Carlo Paths: {params['num_paths']} (Parallel + Antithetic)")
     print(f"CP Search Range: [{cp_min_guess}%, {cp_max_guess}%]")
+    print(f"CRN Seed: {seed}")
     print("="*50)
     
     start_time = time.time()
     
     try:
-        found_cp = brentq(
-            objective_function,
-            a=cp_min_guess,
-            b=cp_max_guess,
-            args=(params, product_type, target_fv), # Key: passing 'Quanto'
-            xtol=1e-5,
-            rtol=1e-5
-        )
+        # AUTOCALL_PROFILE=<file> profiles this solve (see telemetry.py)
+        with profiled_solve(f"solve_for_cp-{product_type}-{target_margin * 100:.2f}"):
+            found_cp = brentq(
+                objective_function,
+                a=cp_min_guess,
+                b=cp_max_guess,
+                args=(params, product_type, target_fv, seed, pool), # Key: passing 'Quanto'
+                xtol=1e-5,
+                rtol=1e-5
+            )
         
         end_time = time.time()
         print("--- Solver Finished ---")
@@ -110,21 +129,35 @@ if __name__ == "__main__":
     print("This script will calculate the *exact* answers for Q3(i) and Q3(ii) (Quanto version).")
     print("This may take a few minutes.")
     
-    # --- Solve Q3(i): Quanto, 1.20% Margin ---
-    # !! Use Quanto parameters and 'Quanto' type !!
-    cp_q3_i = solve_for_cp(
-        params=quanto_params_prod,
-        product_type='Quanto',       # <--- Key
-        target_margin=0.0120     # 1.20%
-    )
-    
-    # --- Solve Q3(ii): Quanto, 1.60% Margin ---
-    # !! Use Quanto parameters and 'Quanto' type !!
-    cp_q3_ii = solve_for_cp(
-        params=quanto_params_prod,
-        product_type='Quanto',       # <--- Key
-        target_margin=0.0160    # 1.60%
-    )
+    if SOLVE_METHOD == 'direct':
+        # --- Solve Q3(i) and Q3(ii) from the same simulation ---
+        start_time = time.time()
+        cp_q3_i, cp_q3_ii = solve_cp_direct(
+            params=quanto_params_prod,
+            product_type='Quanto',       # <--- Key
+            target_margin=[0.0120, 0.0160]  # 1.20% and 1.60%
+        )
+        print(f"Direct solve (one simulation) Time Elapsed: {time.time() - start_time: .2f} seconds.")
+    else:
+        # Start the pool once, every guess of both solves reuses it
+        with PricingPool(quanto_params_prod, 'Quanto') as pricing_pool:
+            # --- Solve Q3(i): Quanto, 1.20% Margin ---
+            # !! Use Quanto parameters and 'Quanto' type !!
+            cp_q3_i = solve_for_cp(
+                params=quanto_params_prod,
+                product_type='Quanto',       # <--- Key
+                target_margin=0.0120,    # 1.20%
+                pool=pricing_pool
+            )
+            
+            # --- Solve Q3(ii): Quanto, 1.60% Margin ---
+            # !! Use Quanto parameters and 'Quanto' type !!
+            cp_q3_ii = solve_for_cp(
+                params=quanto_params_prod,
+                product_type='Quanto',       # <--- Key
+                target_margin=0.0160,   # 1.60%
+                pool=pricing_pool
+            )
 
     print("\n" + "="*60)
     print("--- Q3 Final Answers (300,000 Paths, Quanto) ---")
@@ -8,7 +8,8 @@ import multiprocessing
 
 # --- 1. 导入您的 *加速版* 核心定价函数 ---
 try:
-    from calculate_fair_value import calculate_fair_value
+    from calculate_fair_value import calculate_fair_value, solve_cp_direct, PricingPool
+    from telemetry import profiled_solve, record_solver_step # JSONL 记录 / 性能分析, 由环境变量开启
     print("成功导入 'calculate_fair_value' (V3-并行版)。\n")
 except ImportError:
     print("="*50)
@@ -38,34 +39,49 @@ quanto_params_prod = {
     'rho': 0.42               # 股票与汇率的相关性
 }
 
+# 'direct': 只模拟一次, PV = A + CP * B 对 CP 是仿射的, 两个利润率都用 CP = (target - A) / B 直接求出
+# 'brentq': 原来的求根方法, 每个猜想都完整定价一次
+SOLVE_METHOD = 'direct'
+
 
 # --- 3. 定义求解器所需的目标函数 (与 solver_i.py 中完全相同) ---
 
-def objective_function(cp_guess, params, product_type, target_fv):
+def objective_function(cp_guess, params, product_type, target_fv, seed=None, pool=None):
     """
     这是 brentq 求解器要优化的函数。
     它计算: Fair_Value(cp_guess) - Target_Fair_Value
+    seed: 本次求解的公共随机数 (CRN) 种子, 每个猜想都在同一组路径上定价
+    pool: 可选的 PricingPool, 每个猜想都复用它的进程
     """
     
     # 调用您的核心定价引擎 (V3 并行版)
     current_fv = calculate_fair_value(
         CP_guess=cp_guess, 
         params=params, 
-        product_type=product_type # 这里将被传入 'Quanto'
+        product_type=product_type, # 这里将被传入 'Quanto'
+        seed=seed, # 每个猜想使用相同的随机数, 目标函数对 CP 是确定的
+        pool=pool
     )
     
     error = current_fv - target_fv
     
     print(f"  [Solver Step] 猜想 CP: {cp_guess: .6f}% -> FV: {current_fv/params['NOM'] * 100.0: .4f}% -> 误差: {error/params['NOM'] * 100.0: .4f}%")
+    record_solver_step('solve_for_cp', 'CP', cp_guess, current_fv, error, product_type=product_type, target_fv=target_fv, seed=seed)
     
     return error
 
 # --- 4. 主求解器函数 (与 solver_i.py 中完全相同) ---
-def solve_for_cp(params, product_type, target_margin, cp_min_guess=0.01, cp_max_guess=10.0):
+def solve_for_cp(params, product_type, target_margin, cp_min_guess=0.01, cp_max_guess=10.0, seed=None, pool=None):
     """
     一个完整的求解器函数，用于寻找 CP。
+    seed: 公共随机数 (CRN) 种子, 未给出时为本次求解生成一个新种子
+    pool: 可选的 PricingPool, 所有猜想 (以及多次求解) 共用
     """
     
+    # 每次求解只固定一次随机数, 所有猜想重复使用
+    if seed is None:
+        seed = np.random.SeedSequence().entropy
+    
     target_fv_pct = 1.0 - target_margin
     target_fv = params['NOM'] * target_fv_pct
     
@@ -76,19 +92,22 @@ def solve_for_cp(params, product_type, target_margin, cp_min_guess=0.01, cp_max_
     print(f"产品类型: {product_type}") # <--- 这里会打印 'Quanto'
     print(f"蒙特卡洛路径: {params['num_paths']} (已启用并行 + 对偶变量)")
     print(f"CP 搜索区间: [{cp_min_guess}%, {cp_max_guess}%]")
+    print(f"CRN 种子: {seed}")
     print("="*50)
     
     start_time = time.time()
     
     try:
-        found_cp = brentq(
-            objective_function,
-            a=cp_min_guess,
-            b=cp_max_guess,
-            args=(params, product_type, target_fv), # 关键: 传入 'Quanto'
-            xtol=1e-5,
-            rtol=1e-5
-        )
+        # AUTOCALL_PROFILE=<文件> 时对本次求解做性能分析 (见 telemetry.py)
+        with profiled_solve(f"solve_for_cp-{product_type}-{target_margin * 100:.2f}"):
+            found_cp = brentq(
+                objective_function,
+                a=cp_min_guess,
+                b=cp_max_guess,
+                args=(params, product_type, target_fv, seed, pool), # 关键: 传入 'Quanto'
+                xtol=1e-5,
+                rtol=1e-5
+            )
         
         end_time = time.time()
         print("--- 求解器完成 ---")
@@ -114,21 +133,35 @@ if __name__ == "__main__":
     print("本脚本将计算 Q3(i) 和 Q3(ii) (Quanto 版本) 的 *精确* 答案。")
     print("这可能需要几分钟时间。")
     
-    # --- 求解 Q3(i): Quanto, 1.20% 利润率 ---
-    # !! 使用 Quanto 参数 和 'Quanto' 类型 !!
-    cp_q3_i = solve_for_cp(
-        params=quanto_params_prod,
-        product_type='Quanto',       # <--- 关键
-        target_margin=0.0120     # 1.20%
-    )
-    
-    # --- 求解 Q3(ii): Quanto, 1.60% 利润率 ---
-    # !! 使用 Quanto 参数 和 'Quanto' 类型 !!
-    cp_q3_ii = solve_for_cp(
-        params=quanto_params_prod,
-        product_type='Quanto',       # <--- 关键
-        target_margin=0.0160    # 1.60%
-    )
+    if SOLVE_METHOD == 'direct':
+        # --- 用同一次模拟求解 Q3(i) 和 Q3(ii) ---
+        start_time = time.time()
+        cp_q3_i, cp_q3_ii = solve_cp_direct(
+            params=quanto_params_prod,
+            product_type='Quanto',       # <--- 关键
+            target_margin=[0.0120, 0.0160]  # 1.20% 和 1.60%
+        )
+        print(f"直接求解 (一次模拟) 用时: {time.time() - start_time: .2f} 秒.")
+    else:
+        # 只启动一次进程池, 两次求解的所有猜想都复用它
+        with PricingPool(quanto_params_prod, 'Quanto') as pricing_pool:
+            # --- 求解 Q3(i): Quanto, 1.20% 利润率 ---
+            # !! 使用 Quanto 参数 和 'Quanto' 类型 !!
+            cp_q3_i = solve_for_cp(
+                params=quanto_params_prod,
+                product_type='Quanto',       # <--- 关键
+                target_margin=0.0120,    # 1.20%
+                pool=pricing_pool
+            )
+            
+            # --- 求解 Q3(ii): Quanto, 1.60% 利润率 ---
+            # !! 使用 Quanto 参数 和 'Quanto' 类型 !!
+            cp_q3_ii = solve_for_cp(
+                params=quanto_params_prod,
+                product_type='Quanto',       # <--- 关键
+                target_margin=0.0160,   # 1.60%
+                pool=pricing_pool
+            )
 
     print("\n" + "="*60)
     print("--- Q3 最终答案 (300,000 路径, Quanto) ---")
@@ -0,0 +1,182 @@
+# F:\Learning_journal_at_CUHK\FTEC5610_Computational_Finance\Assignment\Assigenment2-3\telemetry.py
+# Instrumentation of the pricer and the solvers: structured records (JSONL) and an opt-in profiler.
+#
+# Telemetry is off by default and costs nothing then. It is switched on by the environment, so a solver script does not need to
+# be edited:
+#     AUTOCALL_TELEMETRY=solve.jsonl python solver_i.py
+# or from code with enable_telemetry('solve.jsonl'). Every line of the file is one JSON record with 'event', 'time' and 'pid':
+#   'pricing'     - one pricing call (one pool.map): the time of every phase summed over the workers
+#                   (rng: drawing the normals, paths: path generation, payoff: payoff evaluation, kernel: fused path + payoff
+#                   engines (numba, bridge, importance sampling), controls / greeks: their extra work, moments: the running sums),
+#                   the pool startup (a new multiprocessing.Pool), the IPC / pickling time (the wall time of the map that no
+#                   worker spent computing, plus the bytes of the tasks and the results), and the pairs, paths and time of every worker
+#   'pool_start'  - a PricingPool was started (cores, seconds)
+#   'solver_step' - one guess of a solver: solver, parameter, guess, fair value, stderr, error, wall time, paths
+#   'profile'     - a profiled solve wrote its statistics (path)
+#
+# The profiler hook wraps a whole solve in cProfile, the workers included: every pricing task of the solve is profiled in its
+# worker and the statistics come back with the results, so one .prof file holds the solver, the pickling and the path engine.
+#     AUTOCALL_PROFILE=solve.prof python solver_ii.py                              # every solve of the script
+#     AUTOCALL_PROFILE=solve.prof AUTOCALL_PROFILE_SOLVE=KI python solver_ii.py    # only the solves whose label contains 'KI'
+# The file of a solve is <stem>.<label>.prof next to the given path; read it with pstats or snakeviz.
+
+import contextlib
+import cProfile
+import json
+import os
+import pickle
+import pstats
+import time
+
+TELEMETRY_ENV = 'AUTOCALL_TELEMETRY' # JSONL file the records are appended to
+PROFILE_ENV = 'AUTOCALL_PROFILE' # base path of the .prof files of profiled solves
+PROFILE_SOLVE_ENV = 'AUTOCALL_PROFILE_SOLVE' # only profile the solves whose label contains this text
+
+# Phases of a worker chunk, in the order they are reported
+PHASES = ('rng', 'paths', 'payoff', 'kernel', 'controls', 'greeks', 'moments')
+
+# Functions printed after a profiled solve (by cumulative time)
+PROFILE_TOP = 15
+
+_telemetry = {'path': os.environ.get(TELEMETRY_ENV) or None}
+_profile = {'active': False, 'worker_stats': []}
+
+
+def enable_telemetry(path):
+    _telemetry['path'] = path
+
+
+def disable_telemetry():
+    _telemetry['path'] = None
+
+
+def telemetry_enabled():
+    return _telemetry['path'] is not None
+
+
+def profiling_active():
+    return _profile['active']
+
+
+# Append one record to the telemetry file (nothing when telemetry is off)
+def record(event, **fields):
+    if _telemetry['path'] is None:
+        return
+    entry = dict({'event': event, 'time': time.time(), 'pid': os.getpid()}, **fields)
+    with open(_telemetry['path'], 'a', encoding='utf-8') as telemetry_file:
+        telemetry_file.write(json.dumps(entry, default=float) + '\n')
+
+
+# One solver guess. fair_value is the PricingResult of the guess (its stderr, wall time and paths are recorded with it).
+def record_solver_step(solver, parameter, guess, fair_value, error, **fields):
+    record('solver_step', solver=solver, parameter=parameter, guess=guess, fair_value=float(fair_value), error=float(error),
+           stderr=getattr(fair_value, 'stderr', None), wall_time=getattr(fair_value, 'wall_time', None),
+           num_paths=getattr(fair_value, 'num_paths', None), **fields)
+
+
+# ------------------------------------------------------------------------------------------------------------------------------
+# Worker side
+
+# Add the time spent in the with-block to timings[name]; a no-op when timings is None (telemetry off)
+@contextlib.contextmanager
+def phase(timings, name):
+    if timings is None:
+        yield
+        return
+    start_time = time.perf_counter()
+    try:
+        yield
+    finally:
+        timings[name] = timings.get(name, 0.0) + time.perf_counter() - start_time
+
+
+# Wrap an iterator of normal blocks so the time of drawing every block is added to timings[name]
+def timed_blocks(blocks, timings, name='rng'):
+    iterator = iter(blocks)
+    while True:
+        with phase(timings, name):
+            block = next(iterator, None)
+        if block is None:
+            return
+        yield block
+
+
+# Run function(*args) under cProfile; returns (its result, the raw profile statistics, which pickle back to the parent)
+def run_profiled(function, *args):
+    profiler = cProfile.Profile()
+    result = profiler.runcall(function, *args)
+    profiler.create_stats()
+    return result, profiler.stats
+
+
+# ------------------------------------------------------------------------------------------------------------------------------
+# Parent side
+
+# pool_map(worker, args_list) with the records of this call. Returns the worker results without their 'telemetry' and
+# 'profile' entries. startup_time is the time it took to start the pool of this call (0 for a reused PricingPool).
+def instrumented_map(pool_map, worker, args_list, startup_time=0.0):
+    if not telemetry_enabled() and not profiling_active():
+        return pool_map(worker, args_list)
+
+    start_time = time.perf_counter()
+    task_bytes = len(pickle.dumps(args_list))
+    pickle_time = time.perf_counter() - start_time
+    start_time = time.perf_counter()
+    results = pool_map(worker, args_list)
+    map_time = time.perf_counter() - start_time
+
+    worker_records = [result.pop('telemetry') for result in results if 'telemetry' in result]
+    if profiling_active():
+        _profile['worker_stats'] += [result.pop('profile') for result in results if 'profile' in result]
+    if not telemetry_enabled():
+        return results
+
+    phases = {name: sum(worker['timings'].get(name, 0.0) for worker in worker_records) for name in PHASES}
+    slowest_worker = max((worker['chunk_time'] for worker in worker_records), default=0.0)
+    record('pricing', tasks=len(args_list), paths=sum(worker['paths'] for worker in worker_records),
+           startup_time=startup_time, map_time=map_time, ipc_time=max(map_time - slowest_worker, 0.0),
+           task_bytes=task_bytes, result_bytes=len(pickle.dumps(results)), task_pickle_time=pickle_time,
+           phases=phases, workers=worker_records)
+    return results
+
+
+# Profile the with-block (a whole solve) if AUTOCALL_PROFILE is set and the label passes AUTOCALL_PROFILE_SOLVE.
+# The statistics of the parent and of every worker task priced meanwhile go to <stem>.<label>.prof.
+@contextlib.contextmanager
+def profiled_solve(label):
+    base_path = os.environ.get(PROFILE_ENV)
+    only = os.environ.get(PROFILE_SOLVE_ENV)
+    if not base_path or (only and only not in label) or _profile['active']:
+        yield
+        return
+
+    _profile.update(active=True, worker_stats=[])
+    profiler = cProfile.Profile()
+    profiler.enable()
+    try:
+        yield
+    finally:
+        profiler.disable()
+        _profile['active'] = False
+        stats = pstats.Stats(profiler)
+        for worker_stats in _profile['worker_stats']:
+            stats.add(_RawProfile(worker_stats))
+        _profile['worker_stats'] = []
+
+        stem = os.path.splitext(base_path)[0]
+        safe_label = ''.join(char if char.isalnum() or char in '-_' else '_' for char in label)
+        path = f"{stem}.{safe_label}.prof"
+        stats.dump_stats(path)
+        print(f"  [Profile] {label}: {path}")
+        stats.sort_stats('cumulative').print_stats(PROFILE_TOP)
+        record('profile', label=label, path=path)
+
+
+# Raw statistics of a worker in the form pstats.Stats.add reads (an object with create_stats() and .stats)
+class _RawProfile:
+
+    def __init__(self, stats):
+        self.stats = stats
+
+    def create_stats(self):
+        pass
@@ -2,13 +2,12 @@
 # (This script is used to *validate* all final answers for Q1, Q2, Q3)
 
 import numpy as np
-import time
 import multiprocessing 
 import copy # For deep copying parameter dictionaries
 
 # --- 1. Import the *accelerated* core pricing function ---
 try:
-    from calculate_fair_value import calculate_fair_value
+    from calculate_fair_value import calculate_fair_value, PricingPool, SharedNormals
     print("Successfully imported 'calculate_fair_value' (V3-Parallel version).\n")
 except ImportError:
     print("="*50)
@@ -36,11 +35,16 @@ quanto_params_prod = {
     'r_d': 0.0169, 'r_f': 0.0287, 'sigma_fx': 0.074, 'rho': 0.42
 }
 
+# A run passes when the Fair Value is within this many standard errors of the target, i.e. the gap is explained by MC noise
+NOISE_Z_LIMIT = 3.0
+
 # --- 3. Define a general validation helper function ---
 
-def validate_run(description, cp_to_test, params, product_type, target_margin_pct):
+def validate_run(description, cp_to_test, params, product_type, target_margin_pct, pool=None, shared_normals=None):
     """
     Run one simulation and print the validation results
+    pool: optional PricingPool, reused instead of starting new workers for this run
+    shared_normals: optional SharedNormals, the pre-generated normals to price on
     """
     print("\n" + "="*60)
     print(f"--- Validating: {description} ---")
@@ -57,32 +61,35 @@ def validate_run(description, cp_to_test, params, product_type, target_margin_pc
     print(f"Path Count: {params['num_paths']}")
     print(f"Target Margin: {target_margin_pct:.2f}% (Target FV: {target_fv_pct:.4f}%)")
     
-    start_time = time.time()
-    
     # --- Running Pricer ---
+    # calculated_fv is a PricingResult: the fair value, with its standard error, CI, path count and wall time
     calculated_fv = calculate_fair_value(
         CP_guess=cp_to_test,
         params=params,
-        product_type=product_type
+        product_type=product_type,
+        pool=pool,
+        shared_normals=shared_normals
     )
     
-    end_time = time.time()
-    
     # --- Analyzing Results ---
     calculated_fv_pct = (calculated_fv / NOM) * 100.0
     calculated_margin_pct = 100.0 - calculated_fv_pct
     error_pct = calculated_fv_pct - target_fv_pct # (Error in FV)
+    stderr_pct = calculated_fv.stderr / NOM * 100.0
+    ci_low_pct, ci_high_pct = (bound / NOM * 100.0 for bound in calculated_fv.ci)
+    # How many standard errors the Fair Value is away from the target
+    error_z = (calculated_fv - target_fv) / calculated_fv.stderr
     
     print("-" * 60)
-    print(f"Validation Time: {end_time - start_time:.2f} seconds")
-    print(f"Calculated Fair Value (FV): {calculated_fv_pct:.4f}%")
+    print(f"Validation Time: {calculated_fv.wall_time:.2f} seconds")
+    print(f"Calculated Fair Value (FV): {calculated_fv_pct:.4f}% +/- {stderr_pct:.4f}% (95% CI: [{ci_low_pct:.4f}%, {ci_high_pct:.4f}%])")
     print(f"Calculated Margin: {calculated_margin_pct:.4f}%")
     print("-" * 60)
     print(f"==> Result: Target Margin {target_margin_pct:.2f}%, Actual Margin {calculated_margin_pct:.4f}%")
-    print(f"==> Fair Value Error (Actual - Target): {error_pct:.4f}%")
+    print(f"==> Fair Value Error (Actual - Target): {error_pct:.4f}% ({error_z:+.2f} standard errors)")
     
-    if abs(error_pct) > 0.02: # Allowing 0.02% error for MC noise
-        print("==> WARNING: Large error. Please check answers or MC noise.")
+    if abs(error_z) > NOISE_Z_LIMIT: # More than MC noise can explain
+        print(f"==> WARNING: The error is larger than {NOISE_Z_LIMIT:.0f} standard errors of MC noise. Please check the answers or the pricer.")
     else:
         print("==> Conclusion: Validation PASSED.")
     print("="*60)
@@ -110,49 +117,63 @@ if __name__ == "__main__":
     # --- End of Answer Definitions ---
     
     
-    # --- Q1 Validation ---
-    validate_run(
-        "Q1(i) [1.20% Margin]", 
-        CP_Q1_I, hkd_params_prod, "HKD", 1.20
-    )
-    validate_run(
-        "Q1(ii) [1.60% Margin]", 
-        CP_Q1_II, hkd_params_prod, "HKD", 1.60
-    )
-    
-    # --- Q2 Validation ---
-    # Exercise A (K0)
-    params_q2a = copy.deepcopy(hkd_params_prod)
-    params_q2a['K0'] = K0_Q2_A
-    validate_run(
-        "Q2(A) [1.20% Margin, new K0]",
-        CP_Q2, params_q2a, "HKD", 1.20
-    )
-    
-    # Exercise B (KI)
-    params_q2b = copy.deepcopy(hkd_params_prod)
-    params_q2b['KI'] = KI_Q2_B
-    validate_run(
-        "Q2(B) [1.20% Margin, new KI]",
-        CP_Q2, params_q2b, "HKD", 1.20
-    )
-    
-    # Exercise C (AC)
-    params_q2c = copy.deepcopy(hkd_params_prod)
-    params_q2c['AC'] = AC_Q2_C
-    validate_run(
-        "Q2(C) [1.20% Margin, new AC]",
-        CP_Q2, params_q2c, "HKD", 1.20
-    )
-    
-    # --- Q3 Validation ---
-    validate_run(
-        "Q3(i) [1.20% Margin, Quanto]",
-        CP_Q3_I, quanto_params_prod, "Quanto", 1.20
-    )
-    validate_run(
-        "Q3(ii) [1.60% Margin, Quanto]",
-        CP_Q3_II, quanto_params_prod, "Quanto", 1.60
-    )
+    # All seven runs are priced on the same normals, generated once into shared memory
+    # (the with-block unlinks the buffer, also when a run raises)
+    with SharedNormals(hkd_params_prod['num_paths'] // 2) as shared_normals:
+        # The five HKD runs share one pool of workers (the Q2 runs only send their changed parameter)
+        with PricingPool(hkd_params_prod, "HKD") as hkd_pool:
+            # --- Q1 Validation ---
+            validate_run(
+                "Q1(i) [1.20% Margin]", 
+                CP_Q1_I, hkd_params_prod, "HKD", 1.20,
+                pool=hkd_pool, shared_normals=shared_normals
+            )
+            validate_run(
+                "Q1(ii) [1.60% Margin]", 
+                CP_Q1_II, hkd_params_prod, "HKD", 1.60,
+                pool=hkd_pool, shared_normals=shared_normals
+            )
+    
+            # --- Q2 Validation ---
+            # Exercise A (K0)
+            params_q2a = copy.deepcopy(hkd_params_prod)
+            params_q2a['K0'] = K0_Q2_A
+            validate_run(
+                "Q2(A) [1.20% Margin, new K0]",
+                CP_Q2, params_q2a, "HKD", 1.20,
+                pool=hkd_pool, shared_normals=shared_normals
+            )
+    
+            # Exercise B (KI)
+            params_q2b = copy.deepcopy(hkd_params_prod)
+            params_q2b['KI'] = KI_Q2_B
+            validate_run(
+                "Q2(B) [1.20% Margin, new KI]",
+                CP_Q2, params_q2b, "HKD", 1.20,
+                pool=hkd_pool, shared_normals=shared_normals
+            )
+    
+            # Exercise C (AC)
+            params_q2c = copy.deepcopy(hkd_params_prod)
+            params_q2c['AC'] = AC_Q2_C
+            validate_run(
+                "Q2(C) [1.20% Margin, new AC]",
+                CP_Q2, params_q2c, "HKD", 1.20,
+                pool=hkd_pool, shared_normals=shared_normals
+            )
+    
+        # The two Quanto runs share another pool
+        with PricingPool(quanto_params_prod, "Quanto") as quanto_pool:
+            # --- Q3 Validation ---
+            validate_run(
+                "Q3(i) [1.20% Margin, Quanto]",
+                CP_Q3_I, quanto_params_prod, "Quanto", 1.20,
+                pool=quanto_pool, shared_normals=shared_normals
+            )
+            validate_run(
+                "Q3(ii) [1.60% Margin, Quanto]",
+                CP_Q3_II, quanto_params_prod, "Quanto", 1.60,
+                pool=quanto_pool, shared_normals=shared_normals
+            )
 
     print("\n--- All Validations Complete ---")
\ No newline at end of file
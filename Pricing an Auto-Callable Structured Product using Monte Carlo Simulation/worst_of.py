@@ -0,0 +1,207 @@
+# F:\Learning_journal_at_CUHK\FTEC5610_Computational_Finance\Assignment\Assigenment2-3\worst_of.py
+# Worst-of autocall on a basket of d underlyings with correlated GBM paths.
+#
+# The term sheet is the one of calculate_fair_value.py, with the barriers tested on the worst performer of the basket:
+#   performance_i(t) = S_i(t) / S0_i,   worst(t) = min_i performance_i(t)
+#   knock-in: worst < KI on some day,  auto-call: worst >= AC on an auto-call day,  redemption NOM * min(worst_T / K0, 1) if knocked in
+# So the single-asset payoff (payoff_components_block) is applied to the worst performance path with S0 = 1.
+#
+# Correlated shocks (generate_correlated_normals of the option notebooks, for d names): with the Cholesky factor L of the
+# correlation matrix (correlation = L L^T), W = L Z has the right correlation across the names. For a whole block this is one
+# batched matrix product of L with the tensor of independent normals. The tensor is laid out (pairs, d, N) rather than
+# (pairs, N, d): the cumulative product over the days then runs along contiguous memory, which halves the time of a block.
+# Every asset follows the Euler step of simulate_paths_block with its own volatility (and, for the Quanto, its own drift
+# r_f + rho_i sigma_i sigma_fx). A block holds DEFAULT_BLOCK_PAIRS // d pairs, so its memory stays at the budget of the
+# single-asset engine however many names there are.
+#
+#     basket_params = dict(hkd_params_prod, S0=np.array([11.08, 25.0, 40.0]), sigma_stock=np.array([0.60, 0.35, 0.45]),
+#                          correlation=np.array([[1.0, 0.5, 0.4], [0.5, 1.0, 0.6], [0.4, 0.6, 1.0]]))
+#     fv = calculate_worst_of_fair_value(3.45, basket_params, 'HKD', seed=42)
+
+import numpy as np
+import multiprocessing
+import time
+import tracemalloc # Used to measure the peak memory of one path block
+
+from calculate_fair_value import (DEFAULT_BLOCK_PAIRS, T_EXPIRY, N_STEPS, PricingResult, block_normal_generator, get_rates,
+                                  payoff_components_block)
+
+
+# Cholesky factor of the correlation matrix of the basket (d x d; the identity when params has no 'correlation')
+def basket_cholesky(params):
+    d = len(np.atleast_1d(params['S0']))
+    correlation = np.asarray(params.get('correlation', np.eye(d)), dtype=float)
+    if correlation.shape != (d, d):
+        raise ValueError(f"correlation must be a {d} x {d} matrix for {d} underlyings")
+    if not np.allclose(correlation, correlation.T) or not np.allclose(np.diag(correlation), 1.0):
+        raise ValueError("correlation must be symmetric with a unit diagonal")
+    try:
+        return np.linalg.cholesky(correlation)
+    except np.linalg.LinAlgError:
+        raise ValueError("correlation must be positive definite")
+
+
+# Yield the independent normals of num_pairs antithetic pairs, one (pairs_in_block, d, N) array per block.
+# Block streams are spawned from the seed by block index as in iter_normal_blocks (d = 1 gives the same numbers).
+# The seed is required: the callers draw a fresh one in the parent, so forked workers never share the global np.random state.
+def iter_basket_normal_blocks(num_pairs, d, block_pairs, seed, first_block=0, N=N_STEPS):
+    pairs_done = 0
+    block_index = first_block
+    while pairs_done < num_pairs:
+        pairs_in_block = min(block_pairs, num_pairs - pairs_done)
+        Z = block_normal_generator(seed, block_index).standard_normal((pairs_in_block, d, N))
+        yield Z
+        pairs_done += pairs_in_block
+        block_index += 1
+
+
+# Worst performance path of every path in a block.
+# W has shape (paths, d, N): the correlated shocks. r_g and sigma are per asset, shape (d, 1).
+# Returns (paths, N + 1) with column 0 = 1 (every performance starts at 1).
+def simulate_worst_of_block(W, r_g, sigma, dt):
+    # Refer to: dS = r_g S dt + \sigma S Z \sqrt{dt}, for every asset with its own drift and volatility
+    growth = 1.0 + r_g * dt + sigma * np.sqrt(dt) * W
+    np.cumprod(growth, axis=2, out=growth)
+    worst_paths = np.empty((W.shape[0], W.shape[2] + 1))
+    worst_paths[:, 0] = 1.0
+    np.min(growth, axis=1, out=worst_paths[:, 1:])
+    return worst_paths
+
+
+# Worker task: stream the antithetic pairs of one block range, keep the running affine moments of the pair PVs
+# (as run_simulation_chunk_vectorized: sum, sum_sq, count, a_sum, b_sum, a_sum_sq, ab_sum, b_sum_sq, peak_block_bytes)
+def run_worst_of_chunk(args):
+    num_pairs, CP_rate, r_g, r_disc, params, cholesky, seed, first_block, block_pairs = args
+    dt = T_EXPIRY / N_STEPS
+    sigma = np.atleast_1d(params['sigma_stock'])[:, None]
+    r_g = np.broadcast_to(np.atleast_1d(r_g)[:, None], sigma.shape)
+    payoff_params = dict(params, S0=1.0) # barriers and strike are levels of the worst performance
+    moments = {'sum': 0.0, 'sum_sq': 0.0, 'count': 0, 'a_sum': 0.0, 'b_sum': 0.0, 'a_sum_sq': 0.0, 'ab_sum': 0.0, 'b_sum_sq': 0.0}
+    peak_block_bytes = 0
+
+    # Measure the first block with tracemalloc (as run_simulation_chunk_vectorized); tracing that was already on is left on
+    was_tracing = tracemalloc.is_tracing()
+    if not was_tracing:
+        tracemalloc.start()
+    tracemalloc.reset_peak()
+    baseline_bytes = tracemalloc.get_traced_memory()[0]
+    try:
+        for Z in iter_basket_normal_blocks(num_pairs, len(sigma), block_pairs, seed, first_block):
+            W = cholesky @ Z # batched Cholesky multiply: (d, d) @ (pairs, d, N)
+            del Z
+            a, b = 0.0, 0.0
+            for w_block in (W, -W): # antithetic pair
+                principal_pv, coupon_annuity = payoff_components_block(simulate_worst_of_block(w_block, r_g, sigma, dt), r_disc, payoff_params)
+                a = a + 0.5 * principal_pv
+                b = b + 0.5 * coupon_annuity
+            del W
+            if moments['count'] == 0:
+                peak_block_bytes = tracemalloc.get_traced_memory()[1] - baseline_bytes
+                if not was_tracing:
+                    tracemalloc.stop()
+
+            pair_pv = a + CP_rate * b
+            moments['sum'] += np.sum(pair_pv)
+            moments['sum_sq'] += np.sum(pair_pv ** 2)
+            moments['count'] += a.shape[0]
+            moments['a_sum'] += np.sum(a)
+            moments['b_sum'] += np.sum(b)
+            moments['a_sum_sq'] += np.sum(a ** 2)
+            moments['ab_sum'] += np.sum(a * b)
+            moments['b_sum_sq'] += np.sum(b ** 2)
+    finally:
+        # An empty chunk or an exception in the first block: stop the tracing this function started
+        if not was_tracing and tracemalloc.is_tracing():
+            tracemalloc.stop()
+
+    moments['peak_block_bytes'] = peak_block_bytes
+    return moments
+
+
+# Fair value of the worst-of autocall.
+# params are those of calculate_fair_value, with S0 and sigma_stock given per asset (arrays of length d) and
+# 'correlation' the d x d correlation matrix (identity if missing); for the Quanto, rho may be a scalar or per asset.
+# block_pairs defaults to DEFAULT_BLOCK_PAIRS // d. Returns a PricingResult; its stats hold the moments of the run,
+# 'A' and 'B' (PV = A + CP_rate * B on these paths) and the peak memory of one block.
+def calculate_worst_of_fair_value(CP_guess, params, product_type='HKD', seed=None, num_cores=None, block_pairs=None):
+    start_time = time.time()
+    cholesky = basket_cholesky(params)
+    d = cholesky.shape[0]
+    block_pairs = block_pairs or max(1, DEFAULT_BLOCK_PAIRS // d)
+    num_cores = num_cores or multiprocessing.cpu_count()
+    r_g, r_disc = get_rates(params, product_type)
+    if seed is None:
+        # A fresh seed for this call (as build_pricing_tasks): each block has its own stream, so the workers never repeat each other
+        seed = np.random.SeedSequence().entropy
+
+    # Split the blocks over the workers (whole blocks, so the seeded numbers do not depend on the number of cores)
+    num_pairs = params['num_paths'] // 2
+    num_blocks = -(-num_pairs // block_pairs)
+    blocks_per_task = -(-num_blocks // num_cores)
+    args_list = []
+    for first_block in range(0, num_blocks, blocks_per_task):
+        pairs_to_run = min(blocks_per_task * block_pairs, num_pairs - first_block * block_pairs)
+        args_list.append((pairs_to_run, CP_guess / 100.0, r_g, r_disc, params, cholesky, seed, first_block, block_pairs))
+
+    if len(args_list) == 1:
+        results = [run_worst_of_chunk(args_list[0])]
+    else:
+        with multiprocessing.Pool(processes=len(args_list)) as pool:
+            results = pool.map(run_worst_of_chunk, args_list)
+
+    stats = {}
+    for result in results:
+        for key, value in result.items():
+            stats[key] = max(stats.get(key, 0), value) if key == 'peak_block_bytes' else stats.get(key, 0) + value
+    count = stats['count']
+    mean = stats['sum'] / count
+    stats['stderr'] = np.sqrt(max(stats['sum_sq'] / count - mean ** 2, 0.0) / count)
+    stats['A'] = stats['a_sum'] / count
+    stats['B'] = stats['b_sum'] / count
+    stats['block_pairs'] = block_pairs
+    stats['seed'] = seed
+    return PricingResult(mean, stats['stderr'], 2 * count, time.time() - start_time, stats)
+
+
+# Coupon (in %) that gives the target margin on the worst-of, from one pass: PV = A + CP_rate * B on fixed paths
+def solve_worst_of_cp(params, product_type, target_margin, seed=None, num_cores=None):
+    fv = calculate_worst_of_fair_value(0.0, params, product_type, seed=seed, num_cores=num_cores)
+    target_fv = params['NOM'] * (1.0 - target_margin)
+    return 100.0 * (target_fv - fv.stats['A']) / fv.stats['B']
+
+
+if __name__ == "__main__":
+
+    from calculate_fair_value import calculate_fair_value
+    multiprocessing.freeze_support()
+
+    hkd_params_prod = {
+        'NOM': 100000.0, 'r_f': 0.0287, 'sigma_stock': 0.6039, 'S0': 11.08,
+        'time_points': np.array([1/12, 2/12, 3/12, 4/12, 5/12, 0.5]),
+        'num_paths': 300000,
+        'K0': 0.96, 'KI': 0.92, 'AC': 0.99
+    }
+    seed = 20251017
+    CP1_VALUE = 3.458654
+
+    # 1. A basket of one name is the single-asset product: same seed, same paths, same price
+    single = calculate_fair_value(CP1_VALUE, hkd_params_prod, 'HKD', seed=seed)
+    basket_of_one = calculate_worst_of_fair_value(CP1_VALUE, dict(hkd_params_prod, S0=np.array([11.08]), sigma_stock=np.array([0.6039])),
+                                                  'HKD', seed=seed)
+    print(f"Single asset:       {single.summary()}")
+    print(f"Basket of one name: {basket_of_one.summary()}")
+
+    # 2. Worst-of 5 names at 1,000,000 paths, correlation 0.5 between every pair of names
+    d = 5
+    basket_params = dict(hkd_params_prod, num_paths=1000000,
+                         S0=np.array([11.08, 25.40, 38.90, 81.30, 312.0]),
+                         sigma_stock=np.array([0.6039, 0.35, 0.42, 0.28, 0.38]),
+                         correlation=np.full((d, d), 0.5) + 0.5 * np.eye(d))
+    fv = calculate_worst_of_fair_value(CP1_VALUE, basket_params, 'HKD', seed=seed)
+    print(f"\nWorst-of {d} names at CP = {CP1_VALUE}%: {fv.summary()}")
+    print(f"Peak memory per block ({fv.stats['block_pairs']} pairs x {d} names): {fv.stats['peak_block_bytes'] / 2**20:.1f} MB")
+
+    # The worst-of is worth less the less correlated the names are: the CP that gives a 1.2% margin
+    for correlation in (0.9, 0.5, 0.2):
+        params = dict(basket_params, num_paths=300000, correlation=np.full((d, d), correlation) + (1.0 - correlation) * np.eye(d))
+        print(f"Correlation {correlation:.1f}: CP for a 1.2% margin = {solve_worst_of_cp(params, 'HKD', 0.012, seed=seed):.4f}%")
@@ -0,0 +1,336 @@
+# benchmarks/benchmark_suite.py
+# Benchmark suite of the three projects of this repository, with JSON results that can be compared between commits.
+#
+#   1. autocall  - calculate_fair_value / PricingPool of "Pricing an Auto-Callable Structured Product using Monte Carlo Simulation":
+#                  several path counts, strong scaling (300,000 paths on more and more cores) and
+#                  weak scaling (150,000 paths per core)
+#   2. worst_of  - the worst-of Asian put engines: monte_carlo_euler_vectorized (calculate_by_step_simulation.ipynb),
+#                  monte_carlo_part_ii (calculate_directly.ipynb) and the worst-of spec of product_spec.py
+#   3. portfolio - the efficient frontier (part2.ipynb) and the ERC solve (part3_ERC.ipynb) at growing asset counts
+#
+# The notebook engines are benchmarked as they are written: load_notebook_functions executes their function definitions and
+# their parameter assignments, and skips the cells' plotting, CSV reading and printing. The portfolio benchmarks use a
+# random factor-model covariance of n assets (fixed seed), because the notebooks' CSV files only have 4-6 assets.
+#
+# Every benchmark is a function of one parameter that returns a dict of extra figures (e.g. the price, the paths per second).
+# It is run `repeat` times; the JSON keeps all the times, and the minimum is the figure that is compared between runs
+# (the least disturbed by other processes).
+#
+#     python benchmarks/benchmark_suite.py                                  # all benchmarks, results/<commit>.json
+#     python benchmarks/benchmark_suite.py --quick --filter autocall        # small sizes, one group
+#     python benchmarks/benchmark_suite.py --compare benchmarks/results/ae7d404.json
+# --compare flags every benchmark whose minimum time grew by more than REGRESSION_THRESHOLD and exits with status 1.
+
+import argparse
+import ast
+import json
+import multiprocessing
+import os
+import platform
+import subprocess
+import sys
+import time
+
+import numpy as np
+from scipy.optimize import minimize
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+AUTOCALL_DIR = os.path.join(REPO_ROOT, 'Pricing an Auto-Callable Structured Product using Monte Carlo Simulation')
+OPTION_NOTEBOOKS = os.path.join(REPO_ROOT, 'Option_Pricing_with_Monte_Carlo_scheme', 'calculation')
+PORTFOLIO_NOTEBOOKS = os.path.join(REPO_ROOT, 'MPT_Markowitz_model', '3_parts_calculation')
+RESULTS_DIR = os.path.join(REPO_ROOT, 'benchmarks', 'results')
+sys.path.insert(0, AUTOCALL_DIR)
+
+from calculate_fair_value import PricingPool # noqa: E402 (the autocall project is not a package)
+from product_spec import WORST_OF_ASIAN_PUT_SPEC, price_product # noqa: E402
+
+# A benchmark regresses when its minimum time is more than this fraction slower than in the baseline
+REGRESSION_THRESHOLD = 0.20
+
+# Runs of every benchmark (the minimum is reported)
+DEFAULT_REPEAT = 3
+
+SEED = 20251017
+CP1_VALUE = 3.458654
+HKD_PARAMS_PROD = {
+    'NOM': 100000.0, 'r_f': 0.0287, 'sigma_stock': 0.6039, 'S0': 11.08,
+    'time_points': np.array([1/12, 2/12, 3/12, 4/12, 5/12, 0.5]),
+    'num_paths': 300000,
+    'K0': 0.96, 'KI': 0.92, 'AC': 0.99
+}
+ASIAN_PARAMS = {'r_f': 0.0325, 'S0': np.array([11.08, 73.4]), 'sigma_stock': np.array([0.6039, 0.3481]),
+                'correlation': np.array([[1.0, 0.5456], [0.5456, 1.0]]), 'num_paths': 300000}
+
+# Modules a notebook cell may import here; the others (matplotlib, pandas) only serve plots and CSV files
+NOTEBOOK_IMPORTS = ('numpy', 'scipy', 'time')
+
+
+# ------------------------------------------------------------------------------------------------------------------------------
+# Notebook loading
+
+# The function definitions and the simple assignments (constants, np.* expressions of names already defined) of a notebook,
+# executed into one namespace in cell order. Cells that do not parse (shell / magic lines) are skipped.
+def load_notebook_functions(path):
+    with open(path, encoding='utf-8') as notebook_file:
+        cells = json.load(notebook_file)['cells']
+    namespace = {'__name__': 'notebook'}
+    for cell in cells:
+        if cell['cell_type'] != 'code':
+            continue
+        try:
+            tree = ast.parse(''.join(cell['source']))
+        except SyntaxError:
+            continue
+        for node in tree.body:
+            if is_notebook_definition(node, namespace):
+                exec(compile(ast.Module([node], []), path, 'exec'), namespace)
+    return namespace
+
+
+def is_notebook_definition(node, namespace):
+    if isinstance(node, ast.FunctionDef):
+        return True
+    if isinstance(node, (ast.Import, ast.ImportFrom)):
+        modules = [node.module] if isinstance(node, ast.ImportFrom) else [alias.name for alias in node.names]
+        return all(module.split('.')[0] in NOTEBOOK_IMPORTS for module in modules)
+    if isinstance(node, ast.Assign) and all(isinstance(target, ast.Name) for target in node.targets):
+        names = {name.id for name in ast.walk(node.value) if isinstance(name, ast.Name)}
+        calls = [call.func for call in ast.walk(node.value) if isinstance(call, ast.Call)]
+        numpy_only = all(isinstance(func, ast.Attribute) and ast.unparse(func).startswith('np.') for func in calls)
+        return numpy_only and all(name in namespace or name == 'np' for name in names)
+    return False
+
+
+# ------------------------------------------------------------------------------------------------------------------------------
+# Benchmarks: (name, group, parameter values, setup(parameter) -> state, run(state) -> dict of extra figures)
+
+# The core counts of the scaling benchmarks: powers of two up to the machine, and the machine itself
+def core_counts():
+    cores = multiprocessing.cpu_count()
+    return sorted({2 ** k for k in range(cores.bit_length()) if 2 ** k <= cores} | {cores})
+
+
+def setup_autocall(num_paths, num_cores):
+    params = dict(HKD_PARAMS_PROD, num_paths=num_paths)
+    pool = PricingPool(params, 'HKD', num_cores=num_cores)
+    pool.price(CP1_VALUE, seed=SEED, overrides={'num_paths': 2 * 8192}) # the workers import numpy before the clock starts
+    return {'pool': pool, 'params': params}
+
+
+def run_autocall(state):
+    fv = state['pool'].price(CP1_VALUE, seed=SEED)
+    return {'fair_value': fv.mean, 'stderr': fv.stderr, 'paths': fv.num_paths, 'paths_per_second': fv.num_paths / fv.wall_time}
+
+
+def teardown_autocall(state):
+    state['pool'].close()
+
+
+def setup_notebook_engine(path, function_name, num_paths):
+    return {'engine': load_notebook_functions(path)[function_name], 'num_paths': num_paths}
+
+
+def run_notebook_engine(state):
+    np.random.seed(42) # the notebooks draw from the global stream
+    price = state['engine'](state['num_paths'])[0]
+    return {'price': float(price), 'paths': state['num_paths']}
+
+
+def run_worst_of_spec(num_paths):
+    fv = price_product(WORST_OF_ASIAN_PUT_SPEC, dict(ASIAN_PARAMS, num_paths=num_paths), 'HKD', seed=SEED)
+    return {'price': 100.0 * fv.mean, 'paths': fv.num_paths}
+
+
+# Expected returns and a factor-model covariance of n assets (3 factors plus specific risk), fixed by the seed
+def random_portfolio(n, seed=SEED):
+    rng = np.random.default_rng(seed)
+    loadings = rng.normal(0.0, 0.15, (n, 3))
+    covariance = loadings @ loadings.T + np.diag(rng.uniform(0.01, 0.09, n))
+    expected_returns = rng.uniform(0.05, 0.30, n)
+    return expected_returns, covariance
+
+
+def setup_frontier(n):
+    expected_returns, covariance = random_portfolio(n)
+    namespace = load_notebook_functions(os.path.join(PORTFOLIO_NOTEBOOKS, 'part2.ipynb'))
+    return {'frontier': namespace['calculate_efficient_frontier'], 'expected_returns': expected_returns, 'covariance': covariance,
+            'return_range': np.linspace(expected_returns.min(), expected_returns.max(), 20)}
+
+
+def run_frontier(state):
+    frontier_returns, frontier_volatilities, _ = state['frontier'](state['expected_returns'], state['covariance'], state['return_range'])
+    return {'frontier_points': len(frontier_returns), 'min_volatility': float(min(frontier_volatilities, default=np.nan))}
+
+
+def setup_erc(n):
+    expected_returns, covariance = random_portfolio(n)
+    namespace = load_notebook_functions(os.path.join(PORTFOLIO_NOTEBOOKS, 'part3_ERC.ipynb'))
+    return {'objective': namespace['erc_objective_function'], 'covariance': covariance}
+
+
+# The ERC solve of part3_ERC.ipynb: COBYLA from equal weights, with the long-only and budget constraints as inequalities
+def run_erc(state):
+    covariance = state['covariance']
+    n = covariance.shape[0]
+    constraints = [{'type': 'ineq', 'fun': lambda w, i=i: w[i]} for i in range(n)]
+    constraints.append({'type': 'ineq', 'fun': lambda w: 1 - np.sum(w)})
+    constraints.append({'type': 'ineq', 'fun': lambda w: np.sum(w) - 1})
+    result = minimize(state['objective'], np.ones(n) / n, args=(covariance,), method='COBYLA', constraints=constraints,
+                      options={'maxiter': 2000})
+    weights = result.x / np.sum(result.x)
+    risk_contributions = weights * (covariance @ weights)
+    return {'success': bool(result.success), 'evaluations': int(result.nfev), 'objective': float(result.fun),
+            'risk_contribution_spread': float(np.ptp(risk_contributions) / np.mean(risk_contributions))}
+
+
+# The benchmarks of a run; quick=True uses small sizes (a check that everything runs, not a measurement)
+def build_benchmarks(quick=False):
+    cores = core_counts()
+    max_cores = cores[-1]
+    paths = (30000, 100000) if quick else (30000, 100000, 300000, 1000000)
+    strong_paths = 60000 if quick else 300000
+    weak_paths_per_core = 30000 if quick else 150000
+    notebook_paths = (10000, 30000) if quick else (10000, 100000, 300000)
+    asset_counts = (5, 10) if quick else (5, 10, 20, 40)
+    step_notebook = os.path.join(OPTION_NOTEBOOKS, 'calculate_by_step_simulation.ipynb')
+    direct_notebook = os.path.join(OPTION_NOTEBOOKS, 'calculate_directly.ipynb')
+
+    return [
+        ('autocall.paths', 'autocall', paths,
+         lambda num_paths: setup_autocall(num_paths, max_cores), run_autocall, teardown_autocall),
+        ('autocall.strong_scaling', 'autocall', cores,
+         lambda num_cores: setup_autocall(strong_paths, num_cores), run_autocall, teardown_autocall),
+        ('autocall.weak_scaling', 'autocall', cores,
+         lambda num_cores: setup_autocall(weak_paths_per_core * num_cores, num_cores), run_autocall, teardown_autocall),
+        ('worst_of.euler_vectorized', 'worst_of', notebook_paths,
+         lambda num_paths: setup_notebook_engine(step_notebook, 'monte_carlo_euler_vectorized', num_paths), run_notebook_engine, None),
+        ('worst_of.exact_three_dates', 'worst_of', notebook_paths,
+         lambda num_paths: setup_notebook_engine(direct_notebook, 'monte_carlo_part_ii', num_paths), run_notebook_engine, None),
+        ('worst_of.product_spec', 'worst_of', notebook_paths, lambda num_paths: num_paths, run_worst_of_spec, None),
+        ('portfolio.efficient_frontier', 'portfolio', asset_counts, setup_frontier, run_frontier, None),
+        ('portfolio.erc', 'portfolio', asset_counts, setup_erc, run_erc, None),
+    ]
+
+
+# ------------------------------------------------------------------------------------------------------------------------------
+# Running, storing and comparing
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=REPO_ROOT, capture_output=True, text=True,
+                              check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return 'unknown'
+
+
+def machine_info():
+    return {'platform': platform.platform(), 'processor': platform.processor(), 'cpu_count': multiprocessing.cpu_count(),
+            'python': platform.python_version(), 'numpy': np.__version__}
+
+
+# Run the benchmarks whose name contains name_filter. Returns the results dict that is stored as JSON:
+# {'commit', 'date', 'machine', 'quick', 'benchmarks': {'name[parameter]': {'name', 'group', 'parameter', 'times', 'min',
+#   'median', 'extra'}}}; derived scaling figures are added by add_scaling_figures.
+def run_benchmarks(name_filter=None, repeat=DEFAULT_REPEAT, quick=False, verbose=True):
+    results = {'commit': git_commit(), 'date': time.strftime('%Y-%m-%d %H:%M:%S'), 'machine': machine_info(), 'quick': quick,
+               'repeat': repeat, 'benchmarks': {}}
+    for name, group, parameters, setup, run, teardown in build_benchmarks(quick):
+        if name_filter and name_filter not in name:
+            continue
+        for parameter in parameters:
+            state = setup(parameter)
+            try:
+                times = []
+                for _ in range(repeat):
+                    start_time = time.perf_counter()
+                    extra = run(state)
+                    times.append(time.perf_counter() - start_time)
+            finally:
+                if teardown is not None:
+                    teardown(state)
+            key = f"{name}[{parameter}]"
+            results['benchmarks'][key] = {'name': name, 'group': group, 'parameter': parameter, 'times': times,
+                                          'min': min(times), 'median': float(np.median(times)), 'extra': extra}
+            if verbose:
+                print(f"{key:<40}{min(times):>10.4f} s  (median {np.median(times):.4f} s)")
+    add_scaling_figures(results)
+    return results
+
+
+# Strong scaling: speedup T(1 core) / T(k cores) on the same paths, and the efficiency speedup / k.
+# Weak scaling: efficiency T(1 core) / T(k cores) with k times the paths on k cores (1.0 is perfect).
+def add_scaling_figures(results):
+    benchmarks = results['benchmarks']
+    for name in ('autocall.strong_scaling', 'autocall.weak_scaling'):
+        base = benchmarks.get(f"{name}[1]")
+        if base is None:
+            continue
+        for record in benchmarks.values():
+            if record['name'] == name:
+                ratio = base['min'] / record['min']
+                if name == 'autocall.strong_scaling':
+                    record['extra']['speedup'] = ratio
+                    record['extra']['efficiency'] = ratio / record['parameter']
+                else:
+                    record['extra']['efficiency'] = ratio
+
+
+def save_results(results, path=None):
+    if path is None:
+        os.makedirs(RESULTS_DIR, exist_ok=True)
+        path = os.path.join(RESULTS_DIR, f"{results['commit']}{'-quick' if results['quick'] else ''}.json")
+    with open(path, 'w', encoding='utf-8') as results_file:
+        json.dump(results, results_file, indent=2, default=float)
+    return path
+
+
+# Compare two result sets benchmark by benchmark. Returns rows (key, baseline min, current min, ratio, regressed) for the
+# benchmarks present in both; regressed is True when current > baseline * (1 + threshold).
+def compare_results(baseline, current, threshold=REGRESSION_THRESHOLD):
+    rows = []
+    for key, record in current['benchmarks'].items():
+        if key in baseline['benchmarks']:
+            base_time = baseline['benchmarks'][key]['min']
+            ratio = record['min'] / base_time
+            rows.append((key, base_time, record['min'], ratio, ratio > 1.0 + threshold))
+    return rows
+
+
+def format_comparison(rows, baseline, current, threshold=REGRESSION_THRESHOLD):
+    header = f"{'benchmark':<40}{baseline['commit']:>12}{current['commit']:>12}{'ratio':>8}"
+    lines = [header, "-" * len(header)]
+    for key, base_time, current_time, ratio, regressed in rows:
+        flag = f"  REGRESSION (> {1.0 + threshold:.2f}x)" if regressed else ("  faster" if ratio < 1.0 - threshold else "")
+        lines.append(f"{key:<40}{base_time:>12.4f}{current_time:>12.4f}{ratio:>8.2f}{flag}")
+    if baseline['machine'] != current['machine']:
+        lines.append("Note: the two result sets come from different machines, the times are not comparable one to one.")
+    return "\n".join(lines)
+
+
+if __name__ == "__main__":
+
+    multiprocessing.freeze_support()
+
+    parser = argparse.ArgumentParser(description="Benchmark suite of the autocall pricer, the worst-of engines and the portfolio solvers")
+    parser.add_argument('--filter', help="only the benchmarks whose name contains this text (e.g. autocall, portfolio.erc)")
+    parser.add_argument('--repeat', type=int, default=DEFAULT_REPEAT, help="runs of every benchmark (the minimum is compared)")
+    parser.add_argument('--quick', action='store_true', help="small sizes, to check that the suite runs")
+    parser.add_argument('--output', help="JSON file of the results (default: benchmarks/results/<commit>.json)")
+    parser.add_argument('--compare', help="baseline JSON file; regressions make the script exit with status 1")
+    parser.add_argument('--threshold', type=float, default=REGRESSION_THRESHOLD, help="slowdown that counts as a regression")
+    args = parser.parse_args()
+
+    results = run_benchmarks(args.filter, args.repeat, args.quick)
+    for key, record in results['benchmarks'].items():
+        if 'efficiency' in record['extra']:
+            print(f"{key:<40}efficiency {record['extra']['efficiency']:.2f}"
+                  + (f", speedup {record['extra']['speedup']:.2f}" if 'speedup' in record['extra'] else ""))
+    print(f"Results saved to {save_results(results, args.output)}")
+
+    if args.compare:
+        with open(args.compare, encoding='utf-8') as baseline_file:
+            baseline = json.load(baseline_file)
+        rows = compare_results(baseline, results, args.threshold)
+        print("\n" + format_comparison(rows, baseline, results, args.threshold))
+        if any(row[4] for row in rows):
+            raise SystemExit(1)